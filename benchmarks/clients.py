@@ -0,0 +1,88 @@
+import asyncio
+from typing import Any
+from urllib.parse import urlparse
+
+ORIGIN = "http://localhost"
+
+
+class CommunicatorClient:
+    """Upload client driving the ASGI application in process, without any network in between."""
+
+    def __init__(self, application, path: str, client_address: tuple[str, int], timeout: float = 30):
+        from channels.testing import WebsocketCommunicator
+
+        async def with_client_address(scope, receive, send):
+            # The rate limiter and bandwidth shaper identify clients by address, which communicators don't set.
+            return await application({**scope, "client": client_address}, receive, send)
+
+        self.communicator = WebsocketCommunicator(with_client_address, path, headers=[(b"origin", ORIGIN.encode())])
+        self.timeout = timeout
+
+    async def connect(self):
+        connected, _ = await self.communicator.connect(timeout=self.timeout)
+        if not connected:
+            raise ConnectionError("The application refused the WebSocket connection.")
+
+    async def send_text(self, text: str):
+        await self.communicator.send_to(text_data=text)
+
+    async def send_bytes(self, data: bytes):
+        await self.communicator.send_to(bytes_data=data)
+
+    async def receive(self) -> str | bytes:
+        return await self.communicator.receive_from(timeout=self.timeout)
+
+    async def close(self):
+        await self.communicator.disconnect()
+
+
+class SocketClient:
+    """Upload client connecting to a running server over a real socket, with the autobahn client Daphne depends on."""
+
+    def __init__(self, url: str, timeout: float = 30):
+        self.url = url
+        self.timeout = timeout
+        # The autobahn protocol, imported on connection so that the module loads without autobahn.
+        self.protocol: Any = None
+        self.messages: asyncio.Queue[str | bytes | None] = asyncio.Queue()
+
+    async def connect(self):
+        from autobahn.asyncio.websocket import WebSocketClientFactory, WebSocketClientProtocol
+
+        loop = asyncio.get_running_loop()
+        opened = loop.create_future()
+        messages = self.messages
+
+        class QueueingProtocol(WebSocketClientProtocol):
+            def onOpen(self):
+                opened.set_result(self)
+
+            def onMessage(self, payload, isBinary):
+                messages.put_nowait(payload if isBinary else payload.decode())
+
+            def onClose(self, wasClean, code, reason):
+                if not opened.done():
+                    opened.set_exception(ConnectionError(f"WebSocket handshake failed: {reason}"))
+                messages.put_nowait(None)
+
+        factory = WebSocketClientFactory(self.url, origin=ORIGIN)
+        factory.protocol = QueueingProtocol
+        url = urlparse(self.url)
+        await loop.create_connection(factory, url.hostname, url.port or 80)
+        self.protocol = await asyncio.wait_for(opened, self.timeout)
+
+    async def send_text(self, text: str):
+        self.protocol.sendMessage(text.encode(), isBinary=False)
+
+    async def send_bytes(self, data: bytes):
+        self.protocol.sendMessage(data, isBinary=True)
+
+    async def receive(self) -> str | bytes:
+        payload = await asyncio.wait_for(self.messages.get(), self.timeout)
+        if payload is None:
+            raise ConnectionError("The server closed the WebSocket connection.")
+        return payload
+
+    async def close(self):
+        if self.protocol is not None:
+            self.protocol.sendClose()
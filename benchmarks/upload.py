@@ -0,0 +1,386 @@
+"""Upload benchmark for the WebSocket transfer path.
+
+Drives concurrent clients uploading generated files and reports throughput, per chunk acknowledgement latency and the
+resources used by the server, optionally saving the results as JSON to compare them between commits:
+
+    python -m benchmarks.upload --clients 16 --file-size 4096 --chunk-size 64 --output results.json
+    python -m benchmarks.upload --server daphne --workers 2 --binary --window --compare results.json
+"""
+
+import argparse
+import asyncio
+import base64
+import datetime
+import json
+import logging
+import math
+import os
+import random
+import resource
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from benchmarks.clients import CommunicatorClient, SocketClient
+from file_listener.frames import build_binary_chunk, parse_ack
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+WEBSOCKET_PATH = "/ws/file-transfer/"
+COMPARED_RESULTS = ("throughput_mb_s", "ack_latency_p50_ms", "ack_latency_p99_ms")
+
+
+class BenchmarkError(Exception):
+    pass
+
+
+@dataclass
+class UploadStats:
+    uploads: int = 0
+    bytes: int = 0
+    chunks: int = 0
+    errors: list[str] = field(default_factory=list)
+    ack_latencies: list[float] = field(default_factory=list)
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=8, help="concurrent connections (default: 8)")
+    parser.add_argument("--files", type=int, default=1, help="files uploaded one after the other per client")
+    parser.add_argument("--file-size", type=int, default=4096, help="size of each file in KB (default: 4096)")
+    parser.add_argument(
+        "--chunk-size", type=int, default=64, help="chunk size in KB, 0 follows the size the server recommends"
+    )
+    parser.add_argument("--binary", action="store_true", help="send binary frames instead of Base64 chunks")
+    parser.add_argument("--window", action="store_true", help="use the sliding window acknowledgements")
+    parser.add_argument("--compact-acks", action="store_true", help="receive binary acknowledgements, needs --binary")
+    parser.add_argument(
+        "--server",
+        choices=("inprocess", "daphne"),
+        default="inprocess",
+        help="run the application in the benchmark process, or start Daphne workers reached over sockets",
+    )
+    parser.add_argument("--workers", type=int, default=1, help="Daphne processes started, clients are spread evenly")
+    parser.add_argument("--port", type=int, default=8765, help="port of the first Daphne worker (default: 8765)")
+    parser.add_argument("--url", help="benchmark an already running server instead, e.g. ws://localhost:8000")
+    parser.add_argument(
+        "--in-memory",
+        action="store_true",
+        help=(
+            "use in-memory channel layer and cache stand-ins in process, rate limiting, upload locks, admission control"
+            " and post-processing still need REDIS_URL"
+        ),
+    )
+    parser.add_argument("--output", type=Path, help="save the results to this JSON file")
+    parser.add_argument("--compare", type=Path, help="compare the results with a JSON file saved by a previous run")
+    return parser.parse_args(argv)
+
+
+def get_server_environment(args: argparse.Namespace, save_directory: str) -> dict[str, str]:
+    """Settings letting the server accept the benchmark load, the rest come from the environment as usual."""
+    file_size_mb = math.ceil(args.file_size / 1024)
+    return {
+        "FILE_MAX_SIZE": str(file_size_mb),
+        "FILE_MAX_CONNECTION_PENDING_SIZE": str(file_size_mb),
+        "FILE_SAVE_DIRECTORY": save_directory,
+        "CHUNK_SIZE_MAX": str(max(args.chunk_size, int(os.environ.get("CHUNK_SIZE_MAX", 1024)))),
+        # Admission control would defer clients past its budgets, every client's file has to fit at once.
+        "ADMISSION_MAX_SIZE": str(max(args.clients * file_size_mb, int(os.environ.get("ADMISSION_MAX_SIZE", 1024)))),
+        "ADMISSION_NODE_MAX_SIZE": str(
+            max(args.clients * file_size_mb, int(os.environ.get("ADMISSION_NODE_MAX_SIZE", 4096)))
+        ),
+        # Post-processing results would interleave with the acknowledgements the clients wait for.
+        "FILE_POSTPROCESSORS": "{}",
+        # Every client shares the same address, the per IP limit would stop the benchmark after a few chunks.
+        "RATE_LIMIT_PER_PERIOD": str(10**9),
+        "DJANGO_SECRET_KEY": os.environ.get("DJANGO_SECRET_KEY", "benchmark"),
+    }
+
+
+def generate_payload(size: int) -> bytes:
+    # Hexadecimal text is cheap to generate and passes the content verification of `.txt` uploads.
+    return random.randbytes(size // 2 + 1).hex().encode()[:size]
+
+
+async def upload_file(client, file_name: str, payload: bytes, args: argparse.Namespace, stats: UploadStats):
+    await client.send_text(
+        json.dumps(
+            {
+                "type": "file_meta",
+                "file_name": file_name,
+                "file_size": len(payload),
+                "binary": args.binary,
+                "window": args.window,
+                "compact_acks": args.compact_acks,
+            }
+        )
+    )
+    meta = await receive_message(client)
+    if meta["type"] != "meta_received":
+        raise BenchmarkError(f"Unexpected answer to file_meta: {meta}")
+    chunk_size = args.chunk_size * 1024 or meta["chunk_size"]
+
+    offset = 0
+    seq = 0
+    in_flight: deque[tuple[int, float]] = deque()
+    while True:
+        while offset < len(payload) and len(in_flight) < meta["window"]:
+            chunk = payload[offset : offset + chunk_size]
+            if args.binary:
+                await client.send_bytes(build_binary_chunk(meta["transfer_id"], offset, chunk))
+            else:
+                message = {"type": "file_chunk", "transfer_id": meta["transfer_id"], "offset": offset, "seq": seq}
+                message["chunk"] = base64.b64encode(chunk).decode()
+                await client.send_text(json.dumps(message))
+            in_flight.append((seq, time.perf_counter()))
+            seq += 1
+            offset += len(chunk)
+
+        message = await receive_message(client)
+        if message["type"] == "chunk_size":
+            chunk_size = args.chunk_size * 1024 or message["chunk_size"]
+            continue
+        # Acknowledgements without a sequence number cover the oldest chunk in flight, file_received covers them all.
+        acked_seq = seq if message["type"] == "file_received" else message.get("seq", in_flight[0][0])
+        acked_at = time.perf_counter()
+        while in_flight and in_flight[0][0] <= acked_seq:
+            stats.ack_latencies.append(acked_at - in_flight.popleft()[1])
+            stats.chunks += 1
+        if message["type"] == "file_received":
+            stats.uploads += 1
+            stats.bytes += len(payload)
+            return
+
+
+async def receive_message(client) -> dict:
+    frame = await client.receive()
+    if isinstance(frame, bytes):
+        ack = parse_ack(frame)
+        return {"type": "chunk_received", "transfer_id": ack.transfer_id, "seq": ack.seq, "offset": ack.offset}
+    message = json.loads(frame)
+    if message["type"] == "error":
+        raise BenchmarkError(message["message"])
+    return message
+
+
+async def run_client(client, index: int, payload: bytes, args: argparse.Namespace, stats: UploadStats):
+    try:
+        await client.connect()
+        for file_index in range(args.files):
+            await upload_file(client, f"benchmark-{index}-{file_index}.txt", payload, args, stats)
+    except (BenchmarkError, ConnectionError, asyncio.TimeoutError) as e:
+        stats.errors.append(f"client {index}: {e!r}")
+    finally:
+        await client.close()
+
+
+async def run_clients(create_client, args: argparse.Namespace) -> tuple[UploadStats, float]:
+    stats = UploadStats()
+    clients = [create_client(index) for index in range(args.clients)]
+    payloads = [generate_payload(args.file_size * 1024) for _ in clients]
+    started_at = time.perf_counter()
+    await asyncio.gather(
+        *(
+            run_client(client, index, payload, args, stats)
+            for index, (client, payload) in enumerate(zip(clients, payloads))
+        )
+    )
+    return stats, time.perf_counter() - started_at
+
+
+def run_in_process(args: argparse.Namespace, environment: dict[str, str]) -> tuple[UploadStats, float, list[dict]]:
+    os.environ.update(environment)
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "file_receiver.settings")
+    import django
+    from django.conf import settings
+
+    django.setup()
+    if args.in_memory:
+        settings.CACHES = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+        settings.CHANNEL_LAYERS = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+    from file_receiver.asgi import application
+
+    # Per chunk log lines would be written by the clients' process too and weigh on the measurements.
+    logging.getLogger("django").setLevel(logging.WARNING)
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    stats, duration = asyncio.run(
+        run_clients(lambda index: CommunicatorClient(application, WEBSOCKET_PATH, ("127.0.0.1", 10000 + index)), args)
+    )
+    final_usage = resource.getrusage(resource.RUSAGE_SELF)
+    cpu_seconds = (final_usage.ru_utime + final_usage.ru_stime) - (usage.ru_utime + usage.ru_stime)
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    peak_rss = final_usage.ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+    worker = {
+        "name": "inprocess (includes the clients)",
+        "pid": os.getpid(),
+        "peak_rss_mb": round(peak_rss / 1024 / 1024, 1),
+        "cpu_seconds": round(cpu_seconds, 2),
+        "cpu_percent": round(100 * cpu_seconds / duration, 1),
+    }
+    return stats, duration, [worker]
+
+
+def run_against_daphne(args: argparse.Namespace, environment: dict[str, str]) -> tuple[UploadStats, float, list[dict]]:
+    ports = [args.port + index for index in range(args.workers)]
+    workers = [
+        subprocess.Popen(
+            [sys.executable, "-m", "daphne", "-p", str(port), "file_receiver.asgi:application"],
+            cwd=BASE_DIR,
+            env={**os.environ, **environment},
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        for port in ports
+    ]
+    try:
+        for port in ports:
+            wait_for_port(port)
+        cpu_times = [read_cpu_seconds(worker.pid) for worker in workers]
+        stats, duration = asyncio.run(
+            run_clients(lambda index: SocketClient(f"ws://127.0.0.1:{ports[index % len(ports)]}{WEBSOCKET_PATH}"), args)
+        )
+        results = []
+        for port, worker, initial_cpu_seconds in zip(ports, workers, cpu_times):
+            peak_rss, cpu_seconds = read_peak_rss(worker.pid), read_cpu_seconds(worker.pid)
+            if cpu_seconds is not None and initial_cpu_seconds is not None:
+                cpu_seconds -= initial_cpu_seconds
+            results.append(
+                {
+                    "name": f"daphne:{port}",
+                    "pid": worker.pid,
+                    "peak_rss_mb": round(peak_rss / 1024 / 1024, 1) if peak_rss is not None else None,
+                    "cpu_seconds": round(cpu_seconds, 2) if cpu_seconds is not None else None,
+                    "cpu_percent": round(100 * cpu_seconds / duration, 1) if cpu_seconds is not None else None,
+                }
+            )
+        return stats, duration, results
+    finally:
+        for worker in workers:
+            worker.terminate()
+            worker.wait()
+
+
+def run_against_url(args: argparse.Namespace) -> tuple[UploadStats, float, list[dict]]:
+    url = args.url.rstrip("/") + WEBSOCKET_PATH
+    stats, duration = asyncio.run(run_clients(lambda index: SocketClient(url), args))
+    # The processes behind the URL are unknown, their resources have to be watched separately.
+    return stats, duration, []
+
+
+def wait_for_port(port: int, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise BenchmarkError(f"Daphne didn't start listening on port {port} within {timeout} seconds.")
+
+
+def read_peak_rss(pid: int) -> int | None:
+    """Peak resident set size of a process in bytes, from /proc where available."""
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def read_cpu_seconds(pid: int) -> float | None:
+    """User and system CPU time of a process, from /proc where available."""
+    try:
+        with open(f"/proc/{pid}/stat") as stat:
+            # The command name may contain spaces, the fields to read are counted from the parenthesis closing it.
+            fields = stat.read().rsplit(")", 1)[1].split()
+    except OSError:
+        return None
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def get_git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=BASE_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def summarize(args: argparse.Namespace, stats: UploadStats, duration: float, workers: list[dict]) -> dict:
+    latencies = sorted(stats.ack_latencies)
+    percentiles = statistics.quantiles(latencies, n=100, method="inclusive") if len(latencies) > 1 else latencies * 99
+    return {
+        "commit": get_git_commit(),
+        "created_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "parameters": {
+            name: value if not isinstance(value, Path) else str(value)
+            for name, value in vars(args).items()
+            if name not in ("output", "compare")
+        },
+        "results": {
+            "uploads": stats.uploads,
+            "bytes": stats.bytes,
+            "chunks": stats.chunks,
+            "errors": stats.errors,
+            "duration_s": round(duration, 3),
+            "throughput_mb_s": round(stats.bytes / 1024 / 1024 / duration, 2) if duration else None,
+            "ack_latency_p50_ms": round(percentiles[49] * 1000, 3) if percentiles else None,
+            "ack_latency_p99_ms": round(percentiles[98] * 1000, 3) if percentiles else None,
+            "ack_latency_max_ms": round(latencies[-1] * 1000, 3) if latencies else None,
+        },
+        "workers": workers,
+    }
+
+
+def print_report(summary: dict, baseline: dict | None = None):
+    results = summary["results"]
+    print(f"{'commit:':<20}{summary['commit']}")
+    print(f"{'uploads:':<20}{results['uploads']} ({results['bytes']} bytes in {results['chunks']} chunks)")
+    print(f"{'duration_s:':<20}{results['duration_s']}")
+    for name in COMPARED_RESULTS:
+        line = f"{name + ':':<20}{results[name]}"
+        if baseline is not None and results[name] is not None and baseline["results"].get(name):
+            change = 100 * (results[name] - baseline["results"][name]) / baseline["results"][name]
+            line += f" ({change:+.1f}% from {baseline['results'][name]} at {baseline['commit']})"
+        print(line)
+    print(f"{'ack_latency_max_ms:':<20}{results['ack_latency_max_ms']}")
+    for worker in summary["workers"]:
+        print(
+            f"worker {worker['name']}: peak RSS {worker['peak_rss_mb']} MB, "
+            f"CPU {worker['cpu_seconds']} s ({worker['cpu_percent']}%)"
+        )
+    for error in results["errors"]:
+        print(f"error: {error}")
+
+
+def main(argv: list[str] | None = None) -> int:
+    args = parse_args(argv)
+    with tempfile.TemporaryDirectory(prefix="benchmark-uploads-") as save_directory:
+        environment = get_server_environment(args, save_directory)
+        if args.url:
+            stats, duration, workers = run_against_url(args)
+        elif args.server == "daphne":
+            stats, duration, workers = run_against_daphne(args, environment)
+        else:
+            stats, duration, workers = run_in_process(args, environment)
+
+    summary = summarize(args, stats, duration, workers)
+    baseline = json.loads(args.compare.read_text()) if args.compare else None
+    print_report(summary, baseline)
+    if args.output:
+        args.output.write_text(json.dumps(summary, indent=2) + "\n")
+    return 1 if stats.errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
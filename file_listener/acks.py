@@ -0,0 +1,54 @@
+import asyncio
+from typing import Awaitable, Callable
+
+
+class AckWindow:
+    """Cumulative acknowledgements for a transfer using the sliding window mode.
+
+    The client keeps up to `size` chunks in flight, the window acknowledges every `ack_every` chunks or once
+    `ack_interval` seconds passed since the first unacknowledged chunk, whichever comes first.
+    """
+
+    def __init__(self, send_ack: Callable[[int, int], Awaitable[None]], size: int, ack_every: int, ack_interval: float):
+        self.send_ack = send_ack
+        self.size = size
+        self.ack_every = min(ack_every, size)
+        self.ack_interval = ack_interval
+        self.next_seq = 0
+        self.acked_seq = -1
+        self.offset = 0
+        self.timer: asyncio.Task | None = None
+
+    @property
+    def pending(self) -> int:
+        return self.next_seq - 1 - self.acked_seq
+
+    def check_seq(self, seq: int | None):
+        """Validate the sequence number of an incoming chunk, chunks without one are numbered implicitly."""
+        if seq is not None and seq != self.next_seq:
+            raise ValueError(f"Unexpected chunk sequence number {seq}, expected {self.next_seq}.")
+
+    async def chunk_received(self, offset: int):
+        self.next_seq += 1
+        self.offset = offset
+
+        if self.pending >= self.ack_every:
+            await self.flush()
+        elif self.timer is None:
+            self.timer = asyncio.create_task(self._flush_later())
+
+    async def flush(self):
+        self.cancel()
+        if self.pending > 0:
+            self.acked_seq = self.next_seq - 1
+            await self.send_ack(self.acked_seq, self.offset)
+
+    def cancel(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.ack_interval)
+        self.timer = None
+        await self.flush()
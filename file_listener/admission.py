@@ -0,0 +1,181 @@
+import os
+import shutil
+import time
+import uuid
+from dataclasses import dataclass, field
+
+from file_listener.clients import LuaScript
+from file_listener.errors import AdmissionDeferredError
+from file_listener.executors import run_io
+from file_listener.metrics import RESERVED_BYTES
+
+# Reservations of a node are a hash of their sizes, a hash of the part of their sizes not allocated on disk yet and a
+# sorted set of their expiry times, reservations of a worker that died expire instead of holding the budget forever.
+# Returns whether the reservation was admitted and why not.
+RESERVE = LuaScript(
+    """
+    local time = redis.call("TIME")
+    local now = time[1] * 1000 + math.floor(time[2] / 1000)
+    for _, member in ipairs(redis.call("ZRANGEBYSCORE", KEYS[2], "-inf", now)) do
+        redis.call("HDEL", KEYS[1], member)
+        redis.call("HDEL", KEYS[3], member)
+    end
+    redis.call("ZREMRANGEBYSCORE", KEYS[2], "-inf", now)
+    local sizes = redis.call("HVALS", KEYS[1])
+    if #sizes >= tonumber(ARGV[3]) then
+        return {0, "node_transfers"}
+    end
+    local reserved = tonumber(ARGV[2])
+    for _, size in ipairs(sizes) do
+        reserved = reserved + tonumber(size)
+    end
+    if reserved > tonumber(ARGV[4]) then
+        return {0, "node_size"}
+    end
+    -- Allocated reservations are missing from the free disk space already, they aren't counted against it twice.
+    local unallocated = tonumber(ARGV[2])
+    for _, size in ipairs(redis.call("HVALS", KEYS[3])) do
+        unallocated = unallocated + tonumber(size)
+    end
+    if unallocated > tonumber(ARGV[5]) then
+        return {0, "disk"}
+    end
+    redis.call("HSET", KEYS[1], ARGV[1], ARGV[2])
+    redis.call("HSET", KEYS[3], ARGV[1], ARGV[2])
+    redis.call("ZADD", KEYS[2], now + tonumber(ARGV[6]), ARGV[1])
+    return {1, ""}
+    """
+)
+
+RENEW = LuaScript(
+    """
+    local time = redis.call("TIME")
+    redis.call("HSET", KEYS[1], ARGV[1], ARGV[2])
+    redis.call("HSET", KEYS[3], ARGV[1], ARGV[3])
+    redis.call("ZADD", KEYS[2], time[1] * 1000 + math.floor(time[2] / 1000) + tonumber(ARGV[4]), ARGV[1])
+    return 1
+    """
+)
+
+ALLOCATE = LuaScript(
+    """
+    if redis.call("HEXISTS", KEYS[3], ARGV[1]) == 1 then
+        return redis.call("HSET", KEYS[3], ARGV[1], 0)
+    end
+    return 0
+    """
+)
+
+RELEASE = LuaScript(
+    """
+    redis.call("HDEL", KEYS[1], ARGV[1])
+    redis.call("HDEL", KEYS[3], ARGV[1])
+    return redis.call("ZREM", KEYS[2], ARGV[1])
+    """
+)
+
+
+def get_free_disk_space(directory: str) -> int:
+    os.makedirs(directory, exist_ok=True)
+    return shutil.disk_usage(directory).free
+
+
+@dataclass
+class Reservation:
+    size: int
+    id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    renew_at: float = 0.0
+    allocated: bool = False
+
+
+class AdmissionController:
+    """Admits transfers while the declared sizes of the transfers in flight fit the process and node budgets.
+
+    The process budget is counted locally, the node budget in Redis and shared by every worker of the node along with
+    the free disk space of `directory`. Reservations count the whole declared size against the disk until the space
+    is allocated by preallocating the spool, which overestimates the disk space still needed by transfers part way
+    through without preallocation but never runs the disk full.
+    """
+
+    transfers = 0
+    reserved_size = 0
+
+    def __init__(
+        self,
+        key_prefix: str,
+        node_id: str,
+        directory: str,
+        max_transfers: int,
+        max_size: int,
+        node_max_transfers: int,
+        node_max_size: int,
+        disk_free_min: int,
+        timeout: float,
+        retry_after: int,
+    ):
+        self.keys = [
+            f"{key_prefix}{node_id}_sizes",
+            f"{key_prefix}{node_id}_expiries",
+            f"{key_prefix}{node_id}_unallocated",
+        ]
+        self.directory = directory
+        self.max_transfers = max_transfers
+        self.max_size = max_size
+        self.node_max_transfers = node_max_transfers
+        self.node_max_size = node_max_size
+        self.disk_free_min = disk_free_min
+        self.timeout = timeout
+        self.retry_after = retry_after
+
+    async def reserve(self, size: int) -> Reservation:
+        """Reserve `size` bytes for a new transfer, raising AdmissionDeferredError when over any budget."""
+        if AdmissionController.transfers >= self.max_transfers:
+            raise AdmissionDeferredError("process_transfers", self.retry_after)
+        if AdmissionController.reserved_size + size > self.max_size:
+            raise AdmissionDeferredError("process_size", self.retry_after)
+        reservation = Reservation(size)
+        # Counted before awaiting, so that concurrent connections of the process can't overbook it.
+        self._count(1, reservation.size)
+        try:
+            disk_budget = await run_io(get_free_disk_space, self.directory) - self.disk_free_min
+            admitted, reason = await RESERVE(
+                self.keys,
+                [reservation.id, size, self.node_max_transfers, self.node_max_size, disk_budget, self._timeout_ms],
+            )
+        except BaseException:
+            self._count(-1, -reservation.size)
+            raise
+        if not admitted:
+            self._count(-1, -reservation.size)
+            raise AdmissionDeferredError(reason.decode(), self.retry_after)
+        reservation.renew_at = time.monotonic() + self.timeout / 3
+        return reservation
+
+    async def renew(self, reservation: Reservation):
+        """Keep the reservation from expiring, Redis is only hit once a third of the timeout elapsed."""
+        if time.monotonic() < reservation.renew_at:
+            return
+        unallocated = 0 if reservation.allocated else reservation.size
+        await RENEW(self.keys, [reservation.id, reservation.size, unallocated, self._timeout_ms])
+        reservation.renew_at = time.monotonic() + self.timeout / 3
+
+    async def allocate(self, reservation: Reservation):
+        """Stop counting the reservation against the free disk space, once its whole size is allocated on disk."""
+        if reservation.allocated:
+            return
+        reservation.allocated = True
+        await ALLOCATE(self.keys, [reservation.id])
+
+    async def release(self, reservation: Reservation):
+        self._count(-1, -reservation.size)
+        await RELEASE(self.keys, [reservation.id])
+
+    @property
+    def _timeout_ms(self) -> int:
+        return int(self.timeout * 1000)
+
+    @staticmethod
+    def _count(transfers: int, size: int):
+        AdmissionController.transfers += transfers
+        AdmissionController.reserved_size += size
+        RESERVED_BYTES.inc(size)
@@ -0,0 +1,61 @@
+import hashlib
+from urllib.parse import parse_qs
+
+from channels.middleware import BaseMiddleware
+from channels.security.websocket import WebsocketDenier
+from django.apps import apps
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+
+def get_auth_middleware(inner):
+    """Wrap the WebSocket routes with the authentication selected by the WEBSOCKET_AUTH setting."""
+    if settings.WEBSOCKET_AUTH == "none":
+        return inner
+    if settings.WEBSOCKET_AUTH == "session":
+        if not apps.is_installed("django.contrib.sessions"):
+            raise ImproperlyConfigured("The session WEBSOCKET_AUTH mode needs the apps SOCKET_ONLY leaves out.")
+        # Resolves the session and user from the database on every connection.
+        from channels.auth import AuthMiddlewareStack
+
+        return AuthMiddlewareStack(inner)
+    if settings.WEBSOCKET_AUTH == "token":
+        return TokenAuthMiddleware(inner, settings.WEBSOCKET_AUTH_TOKENS)
+    raise ImproperlyConfigured(f"Unknown WEBSOCKET_AUTH mode: {settings.WEBSOCKET_AUTH}.")
+
+
+def get_token_digest(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+class TokenAuthMiddleware(BaseMiddleware):
+    """Accept connections presenting one of the configured tokens, without any database or cache lookup.
+
+    The token is sent as an `Authorization: Bearer` header, or as a `token` query parameter by browsers, which can't
+    set headers on WebSocket connections. Only digests of the tokens are kept and compared, so that the lookup time
+    doesn't depend on how much of a token matches.
+    """
+
+    def __init__(self, inner, tokens: list[str]):
+        super().__init__(inner)
+        if not tokens:
+            raise ImproperlyConfigured("WEBSOCKET_AUTH_TOKENS must not be empty with the token WEBSOCKET_AUTH mode.")
+        self.token_digests = frozenset(get_token_digest(token) for token in tokens)
+        self.denier = WebsocketDenier.as_asgi()
+
+    async def __call__(self, scope, receive, send):
+        token = self.get_token(scope)
+        if token is None or get_token_digest(token) not in self.token_digests:
+            return await self.denier(scope, receive, send)
+        return await super().__call__(scope, receive, send)
+
+    @staticmethod
+    def get_token(scope) -> str | None:
+        for name, value in scope.get("headers", ()):
+            if name == b"authorization":
+                scheme, _, token = value.decode("latin1").partition(" ")
+                if scheme.lower() == "bearer" and token:
+                    return token.strip()
+        if tokens := parse_qs(scope.get("query_string", b"").decode("latin1")).get("token"):
+            return tokens[0]
+        return None
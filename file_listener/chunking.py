@@ -0,0 +1,67 @@
+import time
+
+# Room left around the Base64 payload of a `file_chunk` message for its type, ids, offset, sequence number and checksum.
+CHUNK_MESSAGE_OVERHEAD = 1024
+
+
+def get_encoded_size(size: int) -> int:
+    """Length of the Base64 encoding of `size` bytes."""
+    return 4 * -(-size // 3)
+
+
+class ChunkSizer:
+    """Chunk sizes advertised to the client of a connection.
+
+    The recommended size is what the connection transfers in `target_duration` seconds at its observed throughput,
+    shrunk so that the chunks in flight of every transfer of the process fit in `memory_budget` bytes. The maximum
+    size doesn't change during the connection, chunks already in flight are never rejected after an adjustment.
+    """
+
+    # Transfers in progress across every connection of the process, the load recommended sizes are shrunk with.
+    active_transfers = 0
+
+    def __init__(
+        self,
+        min_size: int,
+        initial_size: int,
+        max_size: int,
+        target_duration: float,
+        memory_budget: int,
+        smoothing: float = 0.25,
+    ):
+        self.max_size = max_size
+        self.min_size = max(1, min(min_size, max_size))
+        self.initial_size = initial_size
+        self.target_duration = target_duration
+        self.memory_budget = memory_budget
+        self.smoothing = smoothing
+        self.throughput: float | None = None
+        self.last_received_at: float | None = None
+
+    @property
+    def max_message_size(self) -> int:
+        """Size of the largest text message carrying a chunk the connection accepts."""
+        return get_encoded_size(self.max_size) + CHUNK_MESSAGE_OVERHEAD
+
+    def observe(self, size: int, now: float | None = None):
+        """Account for a chunk of `size` bytes, updating the moving average of the connection's throughput."""
+        now = time.monotonic() if now is None else now
+        if self.last_received_at is not None and now > self.last_received_at:
+            rate = size / (now - self.last_received_at)
+            if self.throughput is None:
+                self.throughput = rate
+            else:
+                self.throughput += self.smoothing * (rate - self.throughput)
+        self.last_received_at = now
+
+    def pause(self):
+        """Stop measuring until the next chunk, the time the connection stays idle is not a slow transfer."""
+        self.last_received_at = None
+
+    def recommend(self, file_size: int, window: int = 1) -> int:
+        size = self.initial_size if self.throughput is None else int(self.throughput * self.target_duration)
+        memory_share = self.memory_budget // max(1, self.active_transfers) // window
+        size = max(self.min_size, min(size, memory_share, self.max_size))
+        # Rounding down to a power of two keeps small throughput variations from causing adjustments.
+        size = max(self.min_size, 1 << (size.bit_length() - 1))
+        return max(1, min(size, file_size))
@@ -0,0 +1,34 @@
+import asyncio
+import hashlib
+import weakref
+from typing import Awaitable, cast
+
+from django.conf import settings
+from redis import asyncio as aioredis
+from redis.exceptions import NoScriptError
+
+_clients: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, aioredis.Redis] = weakref.WeakKeyDictionary()
+
+
+def get_redis() -> aioredis.Redis:
+    """Return the async Redis client of the running event loop, asyncio connections can't be shared across loops."""
+    loop = asyncio.get_running_loop()
+    if (client := _clients.get(loop)) is None:
+        client = _clients[loop] = aioredis.from_url(settings.REDIS_URL)
+    return client
+
+
+class LuaScript:
+    """A Lua script executed atomically on Redis in a single round trip, by its digest once the server cached it."""
+
+    def __init__(self, source: str):
+        self.source = source
+        self.sha = hashlib.sha1(source.encode()).hexdigest()
+
+    async def __call__(self, keys: list[str], args: list):
+        client = get_redis()
+        # The client stubs type commands for both the sync and async clients.
+        try:
+            return await cast(Awaitable, client.evalsha(self.sha, len(keys), *keys, *args))
+        except NoScriptError:
+            return await cast(Awaitable, client.eval(self.source, len(keys), *keys, *args))
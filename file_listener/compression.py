@@ -0,0 +1,45 @@
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None  # type: ignore[assignment]
+
+# Window bits of the zlib formats, `deflate` is the zlib wrapped stream browsers produce with CompressionStream.
+ZLIB_WBITS = {"deflate": zlib.MAX_WBITS, "gzip": 16 + zlib.MAX_WBITS}
+
+
+def get_compressions() -> tuple[str, ...]:
+    """Chunk compressions clients can negotiate, zstd requires the zstandard package."""
+    return (*ZLIB_WBITS, "zstd") if zstandard is not None else tuple(ZLIB_WBITS)
+
+
+def decompress(data: bytes | memoryview, compression: str, max_size: int) -> bytes:
+    """Decompress a chunk compressed on its own, never producing more than `max_size` bytes.
+
+    Decompression stops as soon as the output exceeds `max_size`, a small chunk expanding to gigabytes never gets
+    further than that in memory.
+    """
+    if compression == "zstd":
+        return _decompress_zstd(data, max_size)
+    decompressor = zlib.decompressobj(ZLIB_WBITS[compression])
+    try:
+        output = decompressor.decompress(data, max_size + 1)
+    except zlib.error as e:
+        raise ValueError(f"Invalid {compression} chunk: {str(e)}.") from e
+    if len(output) > max_size:
+        raise ValueError(f"Decompressed chunk exceeds {max_size} bytes.")
+    if not decompressor.eof or decompressor.unused_data:
+        raise ValueError(f"Chunk is not a single complete {compression} stream.")
+    return output
+
+
+def _decompress_zstd(data: bytes | memoryview, max_size: int) -> bytes:
+    try:
+        with zstandard.ZstdDecompressor().stream_reader(data) as reader:
+            output = reader.read(max_size + 1)
+    except zstandard.ZstdError as e:
+        raise ValueError(f"Invalid zstd chunk: {str(e)}.") from e
+    if len(output) > max_size:
+        raise ValueError(f"Decompressed chunk exceeds {max_size} bytes.")
+    return output
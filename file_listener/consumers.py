@@ -1,81 +1,212 @@
+import asyncio
+import functools
 import json
 import logging
-from typing import Any
+import time
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable
 
 from channels.generic.websocket import AsyncWebsocketConsumer
 from django.conf import settings
 from django.core.cache import cache
-from django.utils import timezone
 
+from file_listener.acks import AckWindow
+from file_listener.admission import AdmissionController, Reservation
+from file_listener.chunking import ChunkSizer
+from file_listener.encoding import decode_message
 from file_listener.enums import MessageType
-from file_listener.errors import InvalidMessageTypeError, RateLimitExceededError
-from file_listener.handlers import FileTransferHandler, WebSocketMessageHandler
+from file_listener.errors import (
+    AdmissionDeferredError,
+    InvalidMessageTypeError,
+    RateLimitExceededError,
+    TransferError,
+    TransferRejectedError,
+)
+from file_listener.frames import CHUNK_HEADER, parse_binary_chunk
+from file_listener.handlers import (
+    UPLOAD_ID_PATTERN,
+    FileTransferHandler,
+    WebSocketMessageHandler,
+    check_file_size,
+    get_spool_directory,
+    get_upload_group,
+    get_upload_progress_key,
+)
+from file_listener.locks import UploadLock
+from file_listener.metrics import (
+    ACTIVE_CONNECTIONS,
+    ACTIVE_TRANSFERS,
+    CHUNK_DECODE_SECONDS,
+    DEFERRALS,
+    RATE_LIMIT_SECONDS,
+    RECEIVED_BYTES,
+    REJECTIONS,
+    UPLOADS,
+)
+from file_listener.processing import PostProcessingQueue
+from file_listener.rate_limit import BandwidthShaper, LeasedRateLimiter, RateLimiter
+from file_listener.reaper import SpoolReaper
 
 logger = logging.getLogger("django")
 
 Json = dict[str, Any]
 
+TAKEOVER_POLL_INTERVAL = 0.05
+
+
+async def run_cleanups(*cleanups: Awaitable):
+    """Await every cleanup step even when some fail, what they leave in Redis expires by itself."""
+    for cleanup in cleanups:
+        try:
+            await cleanup
+        except Exception as e:
+            logger.exception(f"Cleanup failed: {str(e)}")
+
 
 class FileTransferConsumer(AsyncWebsocketConsumer):
     def __init__(self):
         super().__init__()
         self.message_handler = WebSocketMessageHandler(self)
+        self.transfers: dict[int, FileTransferHandler] = {}
+        self.last_transfer_id = 0
+        self.watched_uploads: set[str] = set()
+        self.rate_limiter = self.get_rate_limiter()
+        self.bandwidth_shaper = BandwidthShaper(
+            settings.BANDWIDTH_KEY_PREFIX,
+            ip_rate=settings.BANDWIDTH_IP_RATE,
+            ip_burst=settings.BANDWIDTH_IP_BURST,
+            connection_rate=settings.BANDWIDTH_CONNECTION_RATE,
+            connection_burst=settings.BANDWIDTH_CONNECTION_BURST,
+        )
+        self.chunk_sizer = ChunkSizer(
+            min_size=settings.CHUNK_SIZE_MIN,
+            initial_size=settings.CHUNK_SIZE_INITIAL,
+            max_size=min(settings.CHUNK_SIZE_MAX, settings.FILE_MAX_SIZE),
+            target_duration=settings.CHUNK_TARGET_DURATION / 1000,
+            memory_budget=settings.CHUNK_MEMORY_BUDGET,
+        )
+        self.admission = AdmissionController(
+            settings.ADMISSION_KEY_PREFIX,
+            settings.ADMISSION_NODE_ID,
+            get_spool_directory(),
+            max_transfers=settings.ADMISSION_MAX_TRANSFERS,
+            max_size=settings.ADMISSION_MAX_SIZE,
+            node_max_transfers=settings.ADMISSION_NODE_MAX_TRANSFERS,
+            node_max_size=settings.ADMISSION_NODE_MAX_SIZE,
+            disk_free_min=settings.ADMISSION_DISK_FREE_MIN,
+            timeout=settings.UPLOAD_LOCK_TIMEOUT,
+            retry_after=settings.ADMISSION_RETRY_AFTER,
+        )
+        self.post_processing = PostProcessingQueue(
+            settings.POSTPROCESS_KEY_PREFIX,
+            settings.ADMISSION_NODE_ID,
+            settings.FILE_POSTPROCESSORS,
+            max_jobs=settings.POSTPROCESS_MAX_JOBS,
+            timeout=settings.POSTPROCESS_JOB_TIMEOUT,
+            max_attempts=settings.POSTPROCESS_MAX_ATTEMPTS,
+        )
+        self.spool_reaper = SpoolReaper(
+            get_spool_directory(), max_age=settings.UPLOAD_PROGRESS_TIMEOUT, interval=settings.TRANSFER_REAP_INTERVAL
+        )
+        self.reaping: asyncio.Task | None = None
         self.message_handlers = {
             MessageType.META.value: self.handle_file_meta,
             MessageType.CHUNK.value: self.handle_file_chunk,
+            MessageType.WATCH.value: self.handle_file_watch,
         }
 
     async def connect(self):
         logger.info("WebSocket connection established.")
         await self.accept()
+        ACTIVE_CONNECTIONS.inc()
+        self.post_processing.start()
 
     async def disconnect(self, code):
         logger.info(f"WebSocket disconnected with code: {code}")
+        ACTIVE_CONNECTIONS.dec()
+        if self.reaping is not None:
+            self.reaping.cancel()
+        await run_cleanups(
+            self.rate_limiter.release(self.scope["client"][0]),
+            *(self.suspend_transfer(file_handler) for file_handler in list(self.transfers.values())),
+            *(
+                self.channel_layer.group_discard(get_upload_group(upload_id), self.channel_name)
+                for upload_id in self.watched_uploads
+            ),
+        )
 
-    async def receive(self, text_data):
+    async def receive(self, text_data=None, bytes_data=None):
         try:
             await self.limit_rate()
-            text_data_json = json.loads(text_data)
+            self.check_message_size(text_data, bytes_data)
+            await self.shape_bandwidth(len(bytes_data) if bytes_data is not None else len(text_data))
+            if bytes_data is not None:
+                await self.handle_binary_chunk(bytes_data)
+                return
+            text_data_json = decode_message(text_data)
             message_type = text_data_json["type"]
             handler = await self.dispatch_handler(message_type)
             await handler(text_data_json)
         except json.JSONDecodeError:
             logger.error("Invalid JSON format.")
+            REJECTIONS.labels(reason="invalid_json").inc()
             await self.message_handler.send_error("Invalid JSON format")
         except KeyError as e:
             logger.error(f"Missing key in JSON: {str(e)}")
+            REJECTIONS.labels(reason="missing_key").inc()
             await self.message_handler.send_error(f"Missing key in JSON: {str(e)}")
         except InvalidMessageTypeError as e:
             logger.error(str(e))
+            REJECTIONS.labels(reason="invalid_type").inc()
             await self.message_handler.send_error(str(e))
+        except TransferError as e:
+            logger.error(f"Value error in transfer {e.transfer_id}: {str(e)}")
+            REJECTIONS.labels(reason="transfer").inc()
+            await self.message_handler.send_error(f"Value error: {str(e)}", transfer_id=e.transfer_id)
         except ValueError as e:
             logger.error(f"Value error: {str(e)}")
+            REJECTIONS.labels(reason="invalid_value").inc()
             await self.message_handler.send_error(f"Value error: {str(e)}")
+        except AdmissionDeferredError as e:
+            logger.warning(str(e))
+            DEFERRALS.labels(reason=e.reason).inc()
+            await self.message_handler.send_meta_deferred(e)
         except RateLimitExceededError as e:
             logger.error(str(e))
+            REJECTIONS.labels(reason="rate_limit").inc()
             await self.message_handler.send_error(str(e))
             await self.close(code=1008)
         except Exception as e:
             logger.exception(f"An unexpected error occurred: {str(e)}")
+            REJECTIONS.labels(reason="internal").inc()
             await self.message_handler.send_error(f"An error occurred: {str(e)}")
 
+    def get_rate_limiter(self) -> RateLimiter:
+        limiter_args = (settings.RATE_LIMIT_KEY_PREFIX, settings.RATE_LIMIT_PER_PERIOD, settings.RATE_LIMIT_PERIOD)
+        if settings.RATE_LIMIT_LEASE_SIZE > 1:
+            return LeasedRateLimiter(*limiter_args, lease_size=settings.RATE_LIMIT_LEASE_SIZE)
+        return RateLimiter(*limiter_args)
+
     async def limit_rate(self):
         user_ip = self.scope["client"][0]
-        key = f"{settings.RATE_LIMIT_KEY_PREFIX}{user_ip}"
-
-        current_time = timezone.now()
-        request_count, last_request_time = cache.get(key, (0, current_time))
-
-        if (current_time - last_request_time).total_seconds() > settings.RATE_LIMIT_PERIOD:
-            request_count = 0
-            last_request_time = current_time
-
-        if request_count >= settings.RATE_LIMIT_PER_PERIOD:
+        with RATE_LIMIT_SECONDS.time():
+            allowed = await self.rate_limiter.allow(user_ip)
+        if not allowed:
             logger.error(f"Rate limit exceeded for user IP: {user_ip}")
             raise RateLimitExceededError("Rate limit exceeded")
 
-        request_count += 1
-        cache.set(key, (request_count, last_request_time), timeout=60)
+    def check_message_size(self, text_data: str | None, bytes_data: bytes | None):
+        # Oversize chunks are refused before any decoding, they never cost more memory than the frame itself.
+        if bytes_data is not None:
+            if len(bytes_data) - CHUNK_HEADER.size > self.chunk_sizer.max_size:
+                raise ValueError(f"Chunk exceeds the maximum chunk size of {self.chunk_sizer.max_size} bytes.")
+        elif text_data is not None and len(text_data) > self.chunk_sizer.max_message_size:
+            raise ValueError(f"Message exceeds the maximum size of {self.chunk_sizer.max_message_size} bytes.")
+
+    async def shape_bandwidth(self, size: int):
+        # Holding the message back also delays its acknowledgement, which is what slows the client down.
+        if delay := await self.bandwidth_shaper.throttle(self.scope["client"][0], size):
+            await asyncio.sleep(delay)
 
     async def dispatch_handler(self, message_type: str):
         try:
@@ -84,14 +215,332 @@ class FileTransferConsumer(AsyncWebsocketConsumer):
             raise InvalidMessageTypeError(f"Invalid message type: {message_type}")
 
     async def handle_file_meta(self, data: Json):
-        self.file_handler = FileTransferHandler(file_name=data["file_name"], file_size=data["file_size"])
-        await self.message_handler.send_meta_received()
+        file_size = check_file_size(data["file_size"])
+        self.check_transfer_capacity(file_size)
+        if not self.transfers:
+            self.chunk_sizer.pause()
+        options = {
+            "transfer_id": self.last_transfer_id + 1,
+            "binary": bool(data.get("binary", False)),
+            "sha256": data.get("sha256"),
+            "compact_acks": bool(data.get("compact_acks", False)),
+            "compression": data.get("compression"),
+        }
+        if upload_id := data.get("upload_id"):
+            # An upload resumed on the same connection replaces the transfer that was carrying it.
+            for file_handler in list(self.transfers.values()):
+                if file_handler.upload_id == upload_id:
+                    await self.suspend_transfer(file_handler)
+            # Admission comes first, a deferred client doesn't take the upload away from the connection carrying it.
+            async with self.admitting(file_size) as reservation:
+                async with self.holding(await self.take_over_upload(upload_id)) as lock:
+                    file_handler = await FileTransferHandler.resume(upload_id, data["file_name"], file_size, **options)
+                    await self.register_transfer(file_handler, lock, reservation, window=bool(data.get("window")))
+        else:
+            file_handler = FileTransferHandler(file_name=data["file_name"], file_size=file_size, **options)
+            if await file_handler.save_existing_content():
+                UPLOADS.labels(outcome="deduplicated").inc()
+                self.last_transfer_id = file_handler.transfer_id
+                await self.message_handler.send_file_received(file_handler)
+                await self.post_process(file_handler)
+                return
+            async with self.admitting(file_handler.file_size) as reservation:
+                lock = self.get_upload_lock(file_handler.upload_id)
+                await lock.acquire()
+                async with self.holding(lock):
+                    await file_handler.save_progress()
+                    await self.register_transfer(file_handler, lock, reservation, window=bool(data.get("window")))
+        self.last_transfer_id = file_handler.transfer_id
+        await self.publish_progress(file_handler, "progress")
+        await self.message_handler.send_meta_received(file_handler)
+
+    async def register_transfer(
+        self, file_handler: FileTransferHandler, lock: UploadLock, reservation: Reservation, window: bool
+    ):
+        file_handler.lock = lock
+        file_handler.reservation = reservation
+        await self.allocate_disk(file_handler)
+        if window:
+            file_handler.ack_window = AckWindow(
+                functools.partial(self.message_handler.send_chunk_received, file_handler),
+                size=settings.TRANSFER_WINDOW_SIZE,
+                ack_every=settings.TRANSFER_ACK_EVERY,
+                ack_interval=settings.TRANSFER_ACK_INTERVAL / 1000,
+            )
+
+        window_size = file_handler.ack_window.size if file_handler.ack_window else 1
+        file_handler.chunk_size = self.chunk_sizer.recommend(file_handler.file_size, window_size)
+        file_handler.max_chunk_size = self.chunk_sizer.max_size
+        self.add_transfer(file_handler)
+
+    async def handle_file_watch(self, data: Json):
+        """Follow the progress of an upload, carried by this connection or any other on any worker."""
+        upload_id = data["upload_id"]
+        if not UPLOAD_ID_PATTERN.fullmatch(str(upload_id)):
+            raise ValueError(f"Invalid upload id: {upload_id}.")
+        if upload_id not in self.watched_uploads:
+            if len(self.watched_uploads) >= settings.FILE_MAX_WATCHED_UPLOADS:
+                raise ValueError(f"Too many watched uploads, at most {settings.FILE_MAX_WATCHED_UPLOADS} are allowed.")
+            await self.channel_layer.group_add(get_upload_group(upload_id), self.channel_name)
+            self.watched_uploads.add(upload_id)
+        progress = await cache.aget(get_upload_progress_key(upload_id))
+        if progress is None:
+            await self.message_handler.send_upload_progress({"upload_id": upload_id, "status": "unknown"})
+            return
+        await self.message_handler.send_upload_progress(
+            {
+                "upload_id": upload_id,
+                "status": "progress",
+                "received_size": progress["received_size"],
+                "file_size": progress["file_size"],
+            }
+        )
 
     async def handle_file_chunk(self, data: Json):
-        await self.file_handler.append_chunk(data["chunk"])
-        if self.file_handler.is_file_complete():
-            await self.file_handler.save_file()
-            file_extension = self.file_handler.get_file_extension()
-            await self.message_handler.send_file_received(file_extension, self.file_handler.file_name)
+        file_handler = self.get_transfer(data.get("transfer_id"))
+        await self.renew_transfer(file_handler)
+        received_size = file_handler.received_size
+        async with self.handling_transfer(file_handler):
+            if file_handler.ack_window is not None:
+                file_handler.ack_window.check_seq(data.get("seq"))
+            await file_handler.append_chunk(data["chunk"], offset=data.get("offset"), crc32=data.get("crc32"))
+        RECEIVED_BYTES.labels(encoding="base64").inc(file_handler.received_size - received_size)
+        await self.acknowledge_chunk(file_handler, file_handler.received_size - received_size)
+
+    async def handle_binary_chunk(self, frame: bytes):
+        with CHUNK_DECODE_SECONDS.labels(encoding="binary").time():
+            chunk = parse_binary_chunk(frame)
+        file_handler = self.get_transfer(chunk.transfer_id)
+        await self.renew_transfer(file_handler)
+        received_size = file_handler.received_size
+        async with self.handling_transfer(file_handler):
+            if not file_handler.binary:
+                raise ValueError(f"Binary mode was not negotiated for transfer {chunk.transfer_id}")
+            await file_handler.append_bytes(chunk.data, offset=chunk.offset, crc32=chunk.crc32)
+        RECEIVED_BYTES.labels(encoding="binary").inc(file_handler.received_size - received_size)
+        await self.acknowledge_chunk(file_handler, file_handler.received_size - received_size)
+
+    async def acknowledge_chunk(self, file_handler: FileTransferHandler, size: int):
+        self.chunk_sizer.observe(size)
+        ack_window = file_handler.ack_window
+        if file_handler.is_file_complete():
+            if ack_window is not None:
+                ack_window.cancel()
+            await file_handler.save_file()
+            await self.remove_transfer(file_handler, outcome="saved")
+            await self.message_handler.send_file_received(file_handler)
+            await self.post_process(file_handler)
+            return
+        await self.allocate_disk(file_handler)
+        # Watchers are updated as often as the progress is persisted, not for every chunk.
+        if file_handler.persisted_size == file_handler.received_size:
+            await self.publish_progress(file_handler, "progress")
+        # The adjustment is sent ahead of the acknowledgement so that it applies to the next chunks the client sends.
+        await self.adjust_chunk_size(file_handler)
+        if ack_window is not None:
+            await ack_window.chunk_received(file_handler.received_size)
         else:
-            await self.message_handler.send_chunk_received()
+            await self.message_handler.send_chunk_received(file_handler)
+
+    async def adjust_chunk_size(self, file_handler: FileTransferHandler):
+        window = file_handler.ack_window.size if file_handler.ack_window else 1
+        chunk_size = self.chunk_sizer.recommend(file_handler.file_size, window)
+        if chunk_size != file_handler.chunk_size:
+            file_handler.chunk_size = chunk_size
+            await self.message_handler.send_chunk_size(file_handler)
+
+    @asynccontextmanager
+    async def admitting(self, file_size: int):
+        """Reserve the declared size of a transfer, giving it back when the transfer fails to start."""
+        reservation = await self.admission.reserve(file_size)
+        try:
+            yield reservation
+        except BaseException:
+            await self.admission.release(reservation)
+            raise
+
+    async def allocate_disk(self, file_handler: FileTransferHandler):
+        # A preallocated spool is missing from the free disk space already, its reservation stops counting against it.
+        if file_handler.preallocated:
+            await self.admission.allocate(file_handler.reservation)
+
+    @asynccontextmanager
+    async def holding(self, lock: UploadLock):
+        """Hold the lock of an upload, releasing it when the transfer fails to start."""
+        try:
+            yield lock
+        except BaseException:
+            await lock.release()
+            raise
+
+    @asynccontextmanager
+    async def handling_transfer(self, file_handler: FileTransferHandler):
+        """Attach the transfer id to value errors raised while handling its chunks, aborting rejected transfers."""
+        try:
+            yield
+        except TransferError:
+            raise
+        except TransferRejectedError as e:
+            await self.abort_transfer(file_handler)
+            raise TransferError(str(e), file_handler.transfer_id) from e
+        except ValueError as e:
+            raise TransferError(str(e), file_handler.transfer_id) from e
+
+    def get_transfer(self, transfer_id: int | None) -> FileTransferHandler:
+        # Clients sending one file at a time may omit the transfer id, their chunks belong to the latest transfer.
+        if transfer_id is None:
+            transfer_id = self.last_transfer_id
+        try:
+            return self.transfers[transfer_id]
+        except KeyError:
+            raise ValueError(f"No file transfer in progress with id {transfer_id}, send file metadata first.")
+
+    def check_transfer_capacity(self, file_size: int):
+        if len(self.transfers) >= settings.FILE_MAX_CONCURRENT_TRANSFERS:
+            raise ValueError(
+                f"Too many concurrent transfers, at most {settings.FILE_MAX_CONCURRENT_TRANSFERS} are allowed."
+            )
+        pending_size = sum(handler.file_size - handler.received_size for handler in self.transfers.values())
+        if pending_size + file_size > settings.FILE_MAX_CONNECTION_PENDING_SIZE:
+            raise ValueError("Concurrent transfers exceed the maximum pending size allowed per connection.")
+
+    async def suspend_transfer(self, file_handler: FileTransferHandler, outcome: str = "suspended"):
+        if file_handler.ack_window is not None:
+            file_handler.ack_window.cancel()
+        try:
+            await file_handler.suspend()
+        finally:
+            await self.remove_transfer(file_handler, outcome=outcome)
+
+    async def abort_transfer(self, file_handler: FileTransferHandler):
+        if file_handler.ack_window is not None:
+            file_handler.ack_window.cancel()
+        try:
+            await file_handler.discard()
+        finally:
+            await self.remove_transfer(file_handler, outcome="aborted")
+
+    def add_transfer(self, file_handler: FileTransferHandler):
+        self.transfers[file_handler.transfer_id] = file_handler
+        ChunkSizer.active_transfers += 1
+        ACTIVE_TRANSFERS.inc()
+        if settings.TRANSFER_REAP_INTERVAL and (self.reaping is None or self.reaping.done()):
+            self.reaping = asyncio.create_task(self.schedule_reaping())
+
+    async def remove_transfer(self, file_handler: FileTransferHandler, outcome: str):
+        del self.transfers[file_handler.transfer_id]
+        ChunkSizer.active_transfers -= 1
+        ACTIVE_TRANSFERS.dec()
+        UPLOADS.labels(outcome=outcome).inc()
+        # Registered transfers always hold both.
+        assert file_handler.lock is not None and file_handler.reservation is not None
+        # The process budgets are given back before any Redis call, a failing one never leaves them behind.
+        await run_cleanups(
+            self.admission.release(file_handler.reservation),
+            file_handler.lock.release(),
+            self.publish_progress(file_handler, outcome),
+        )
+
+    def get_upload_lock(self, upload_id: str) -> UploadLock:
+        return UploadLock(settings.UPLOAD_LOCK_KEY_PREFIX, upload_id, self.channel_name, settings.UPLOAD_LOCK_TIMEOUT)
+
+    async def take_over_upload(self, upload_id: str) -> UploadLock:
+        """Become the owner of an upload, first asking the connection carrying it, on any worker, to suspend it."""
+        if not UPLOAD_ID_PATTERN.fullmatch(str(upload_id)):
+            raise ValueError(f"Invalid upload id: {upload_id}.")
+        lock = self.get_upload_lock(upload_id)
+        if (owner := await lock.acquire()) is None:
+            return lock
+        logger.info(f"Upload {upload_id} is carried by {owner}, requesting a takeover")
+        await self.channel_layer.send(owner, {"type": "upload.takeover", "upload_id": upload_id})
+        deadline = time.monotonic() + settings.UPLOAD_TAKEOVER_TIMEOUT / 1000
+        while await lock.acquire() is not None:
+            # An owner that died never answers, its lock has to expire first.
+            if time.monotonic() >= deadline:
+                raise ValueError(f"Upload {upload_id} is in progress on another connection, retry later.")
+            await asyncio.sleep(TAKEOVER_POLL_INTERVAL)
+        return lock
+
+    async def renew_transfer(self, file_handler: FileTransferHandler):
+        assert file_handler.lock is not None and file_handler.reservation is not None
+        await self.admission.renew(file_handler.reservation)
+        if await file_handler.lock.renew():
+            return
+        # The lock expired and another connection resumed the upload since, its spool and progress aren't ours anymore.
+        if file_handler.ack_window is not None:
+            file_handler.ack_window.cancel()
+        try:
+            await file_handler.release()
+        finally:
+            await self.remove_transfer(file_handler, outcome="taken_over")
+        raise TransferError(
+            f"Upload {file_handler.upload_id} continued on another connection.", file_handler.transfer_id
+        )
+
+    async def schedule_reaping(self):
+        # Reaping is sent through the channel layer so that it runs between messages, never halfway through a chunk.
+        # Connections without transfers have nothing to reap and stop sending it until their next transfer.
+        while True:
+            await asyncio.sleep(settings.TRANSFER_REAP_INTERVAL)
+            if not self.transfers:
+                return
+            try:
+                await self.channel_layer.send(self.channel_name, {"type": "transfers.reap"})
+            except Exception as e:
+                logger.error(f"Failed to schedule the reaping of stalled transfers: {str(e)}")
+
+    async def publish_progress(self, file_handler: FileTransferHandler, status: str):
+        await self.channel_layer.group_send(
+            get_upload_group(file_handler.upload_id),
+            {
+                "type": "upload.progress",
+                "upload_id": file_handler.upload_id,
+                "status": status,
+                "received_size": file_handler.received_size,
+                "file_size": file_handler.file_size,
+            },
+        )
+
+    async def post_process(self, file_handler: FileTransferHandler):
+        """Queue the processing of a saved file, it runs on the process pool after the client got `file_received`."""
+        if (path := file_handler.storage.get_path(file_handler.file_name)) is None:
+            return
+        job = await self.post_processing.submit(file_handler.upload_id, file_handler.file_name, path, self.channel_name)
+        if job is not None:
+            await self.message_handler.send_file_processed(job.get_event("queued"))
+
+    async def upload_processed(self, event: Json):
+        await self.message_handler.send_file_processed(event)
+
+    async def upload_progress(self, event: Json):
+        await self.message_handler.send_upload_progress(event)
+
+    async def transfers_reap(self, event: Json):
+        """Suspend the transfers that stalled, they stay resumable, and remove the spools of abandoned uploads.
+
+        The others keep their lock and reservation while they wait for the client's next chunk.
+        """
+        for file_handler in list(self.transfers.values()):
+            reason = file_handler.check_stalled(
+                settings.TRANSFER_IDLE_TIMEOUT, settings.TRANSFER_MIN_THROUGHPUT, settings.TRANSFER_REAP_INTERVAL
+            )
+            if reason is None:
+                try:
+                    await self.renew_transfer(file_handler)
+                except TransferError as e:
+                    await self.message_handler.send_error(str(e), transfer_id=e.transfer_id)
+                continue
+            logger.warning(f"Transfer {file_handler.transfer_id} stalled, {reason}, suspending it")
+            await self.suspend_transfer(file_handler, outcome="stalled")
+            await self.message_handler.send_error(f"Transfer stalled, {reason}", transfer_id=file_handler.transfer_id)
+        await self.spool_reaper.sweep()
+
+    async def upload_takeover(self, event: Json):
+        """Hand an upload resumed by another connection over to it, the progress is saved before the lock is released."""
+        for file_handler in list(self.transfers.values()):
+            if file_handler.upload_id == event["upload_id"]:
+                logger.info(f"Upload {file_handler.upload_id} resumed on another connection, suspending it")
+                await self.suspend_transfer(file_handler, outcome="taken_over")
+                await self.message_handler.send_error(
+                    "Upload continued on another connection", transfer_id=file_handler.transfer_id
+                )
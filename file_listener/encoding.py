@@ -0,0 +1,74 @@
+import functools
+import json
+from typing import Any
+
+from file_listener.enums import MessageType
+
+# Compact separators and no circular reference check, messages are flat dictionaries built by the server.
+JSON_ENCODER = json.JSONEncoder(separators=(",", ":"), check_circular=False)
+
+
+def encode_json(message: dict[str, Any]) -> str:
+    return JSON_ENCODER.encode(message)
+
+
+def encode_prefix(message: dict[str, Any]) -> str:
+    """Serialize the constant fields of a message once, leaving it open for the fields appended on every send."""
+    return encode_json(message)[:-1]
+
+
+CHUNK_KEY = '"chunk"'
+JSON_WHITESPACE = " \t\n\r"
+
+CHUNK_RECEIVED_PREFIX = encode_prefix({"type": MessageType.CHUNK_RECEIVED.value, "message": "Ready for next chunk"})
+
+
+@functools.lru_cache(maxsize=1024)
+def encode_chunk_received(transfer_id: int) -> str:
+    # Acknowledgements of a transfer without a window never change, they are serialized once per transfer id.
+    return f'{CHUNK_RECEIVED_PREFIX},"transfer_id":{transfer_id:d}}}'
+
+
+def encode_window_ack(transfer_id: int, seq: int, offset: int) -> str:
+    return f'{CHUNK_RECEIVED_PREFIX},"transfer_id":{transfer_id:d},"seq":{seq:d},"offset":{offset:d}}}'
+
+
+def decode_message(text: str) -> dict[str, Any]:
+    """Parse a text message, leaving the chunk of `file_chunk` messages out of the JSON parser.
+
+    Only the small header around the chunk is parsed, the chunk is sliced out of the message as is and decoded by the
+    file handler, instead of the parser scanning and copying it as a JSON string first.
+    """
+    if (bounds := find_chunk(text)) is None:
+        return json.loads(text)
+    start, end = bounds
+    message = json.loads(f"{text[: start - 1]}null{text[end + 1 :]}")
+    if not isinstance(message, dict):
+        raise json.JSONDecodeError("Expecting a JSON object", text, 0)
+    message["chunk"] = text[start:end]
+    return message
+
+
+def find_chunk(text: str) -> tuple[int, int] | None:
+    """Locate the string value of the `chunk` key with plain searches, which run at memory speed.
+
+    Base64 has neither quotes nor backslashes, so the value ends at the next quote. Values using JSON escapes (e.g.
+    `\\/`) are left to the JSON parser.
+    """
+    key = text.find(CHUNK_KEY)
+    if key == -1:
+        return None
+    position = key + len(CHUNK_KEY)
+    while position < len(text) and text[position] in JSON_WHITESPACE:
+        position += 1
+    if not text.startswith(":", position):
+        return None
+    position += 1
+    while position < len(text) and text[position] in JSON_WHITESPACE:
+        position += 1
+    if not text.startswith('"', position):
+        return None
+    end = text.find('"', position + 1)
+    if end == -1 or text.find("\\", position + 1, end) != -1:
+        return None
+    return position + 1, end
@@ -7,5 +7,10 @@ class MessageType(Enum):
     INVALID = "invalid"
     ERROR = "error"
     META_RECEIVED = "meta_received"
+    META_DEFERRED = "meta_deferred"
     CHUNK_RECEIVED = "chunk_received"
     FILE_RECEIVED = "file_received"
+    FILE_PROCESSED = "file_processed"
+    CHUNK_SIZE = "chunk_size"
+    WATCH = "file_watch"
+    UPLOAD_PROGRESS = "upload_progress"
@@ -4,3 +4,22 @@ class InvalidMessageTypeError(Exception):
 
 class RateLimitExceededError(Exception):
     pass
+
+
+class TransferError(ValueError):
+    def __init__(self, message: str, transfer_id: int):
+        super().__init__(message)
+        self.transfer_id = transfer_id
+
+
+class TransferRejectedError(ValueError):
+    """Raised when a transfer can't go on, the transfer is aborted instead of waiting for the chunk to be resent."""
+
+
+class AdmissionDeferredError(Exception):
+    """Raised when a transfer is over the server's budgets, the client should send its metadata again later."""
+
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(f"Transfer deferred, over the {reason} budget.")
+        self.reason = reason
+        self.retry_after = retry_after
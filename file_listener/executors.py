@@ -0,0 +1,46 @@
+import asyncio
+import functools
+import multiprocessing
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable
+
+from django.conf import settings
+
+_io_executor: ThreadPoolExecutor | None = None
+_process_executor: ProcessPoolExecutor | None = None
+
+
+def get_io_executor() -> ThreadPoolExecutor:
+    global _io_executor
+    if _io_executor is None:
+        _io_executor = ThreadPoolExecutor(max_workers=settings.FILE_IO_MAX_WORKERS, thread_name_prefix="file-io")
+    return _io_executor
+
+
+def get_process_executor() -> ProcessPoolExecutor:
+    """Return the pool running CPU heavy work in other processes, where it holds neither the GIL nor the event loop."""
+    global _process_executor
+    if _process_executor is None:
+        # Forking would copy the locks held by the I/O and logging threads of the server, children are spawned instead.
+        _process_executor = ProcessPoolExecutor(
+            max_workers=settings.POSTPROCESS_MAX_WORKERS, mp_context=multiprocessing.get_context("spawn")
+        )
+    return _process_executor
+
+
+def reset_process_executor():
+    """Drop a pool broken by a child process that died, the next call to `get_process_executor` starts a new one."""
+    global _process_executor
+    if _process_executor is not None:
+        _process_executor.shutdown(wait=False, cancel_futures=True)
+        _process_executor = None
+
+
+async def run_in(executor: Executor, func: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
+
+
+async def run_io(func: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+    """Run blocking disk work on the bounded I/O pool so it never stalls the event loop."""
+    return await run_in(get_io_executor(), func, *args, **kwargs)
@@ -0,0 +1,50 @@
+import struct
+from typing import NamedTuple
+
+# Binary chunk frames start with a fixed big-endian header: transfer id (u32), offset (u64), payload length (u32),
+# flags (u8) and the CRC32 of the payload (u32), which is only checked when the CRC32 flag is set.
+CHUNK_HEADER = struct.Struct("!IQIBI")
+FLAG_CRC32 = 0x01
+# Compact acknowledgements are binary frames made of the transfer id (u32), the sequence number of the last chunk
+# acknowledged (u32) and the offset of the first byte the server is missing (u64).
+ACK_FRAME = struct.Struct("!IIQ")
+
+
+class Ack(NamedTuple):
+    transfer_id: int
+    seq: int
+    offset: int
+
+
+class BinaryChunk(NamedTuple):
+    transfer_id: int
+    offset: int
+    data: memoryview
+    crc32: int | None
+
+
+def parse_binary_chunk(frame: bytes) -> BinaryChunk:
+    if len(frame) < CHUNK_HEADER.size:
+        raise ValueError(f"Binary frame is shorter than the {CHUNK_HEADER.size} bytes chunk header.")
+
+    transfer_id, offset, length, flags, crc32 = CHUNK_HEADER.unpack_from(frame)
+    # Slicing a memoryview does not copy, the payload is handed to the file handler as a view over the frame.
+    data = memoryview(frame)[CHUNK_HEADER.size :]
+    if len(data) != length:
+        raise ValueError(f"Binary frame declares {length} bytes but carries {len(data)}.")
+    return BinaryChunk(transfer_id, offset, data, crc32 if flags & FLAG_CRC32 else None)
+
+
+def build_binary_chunk(transfer_id: int, offset: int, data: bytes, crc32: int | None = None) -> bytes:
+    flags = FLAG_CRC32 if crc32 is not None else 0
+    return CHUNK_HEADER.pack(transfer_id, offset, len(data), flags, crc32 or 0) + data
+
+
+def build_ack(transfer_id: int, seq: int, offset: int) -> bytes:
+    return ACK_FRAME.pack(transfer_id, seq, offset)
+
+
+def parse_ack(frame: bytes) -> Ack:
+    if len(frame) != ACK_FRAME.size:
+        raise ValueError(f"Acknowledgement frames are {ACK_FRAME.size} bytes long, got {len(frame)}.")
+    return Ack(*ACK_FRAME.unpack(frame))
@@ -1,92 +1,415 @@
-import base64
-import json
+import binascii
+import errno
+import hashlib
 import logging
 import os
+import re
+import time
+import uuid
+import zlib
+from typing import Any, BinaryIO
 
 from channels.generic.websocket import AsyncWebsocketConsumer
 from django.conf import settings
+from django.core.cache import cache
 
+from file_listener.acks import AckWindow
+from file_listener.admission import Reservation
+from file_listener.compression import decompress, get_compressions
+from file_listener.encoding import encode_chunk_received, encode_json, encode_window_ack
 from file_listener.enums import MessageType
+from file_listener.errors import AdmissionDeferredError, TransferRejectedError
+from file_listener.executors import run_io
+from file_listener.frames import build_ack
+from file_listener.locks import UploadLock
+from file_listener.metrics import (
+    CHUNK_DECODE_SECONDS,
+    COMPRESSED_BYTES,
+    DISK_WRITE_SECONDS,
+    UPLOAD_DURATION_SECONDS,
+)
+from file_listener.sniffing import SNIFF_SIZE, ContentSniffer
+from file_listener.storage import get_storage
 
 logger = logging.getLogger("django")
 
+SPOOL_BLOCK_SIZE = 1024 * 1024
+UPLOAD_ID_PATTERN = re.compile(r"[0-9a-f]{32}")
+SHA256_PATTERN = re.compile(r"[0-9a-f]{64}")
+
 
 class WebSocketMessageHandler:
     def __init__(self, consumer: AsyncWebsocketConsumer):
         self.consumer = consumer
 
-    async def send_error(self, message: str):
-        logger.error(f"Sending error message: {message}")
-        text_data = {"type": MessageType.ERROR.value, "message": message}
-        await self.consumer.send(text_data=json.dumps(text_data))
+    async def send_error(self, message: str, transfer_id: int | None = None):
+        # The error was logged where it was raised already.
+        logger.debug(f"Sending error message: {message}")
+        text_data: dict[str, Any] = {"type": MessageType.ERROR.value, "message": message}
+        if transfer_id is not None:
+            text_data["transfer_id"] = transfer_id
+        await self.consumer.send(text_data=encode_json(text_data))
 
-    async def send_meta_received(self):
+    async def send_meta_received(self, file_handler: "FileTransferHandler"):
         logger.info("File metadata received, ready to accept file.")
         await self.consumer.send(
-            text_data=json.dumps(
+            text_data=encode_json(
                 {
                     "type": MessageType.META_RECEIVED.value,
                     "message": "Ready to receive file",
+                    "transfer_id": file_handler.transfer_id,
+                    "upload_id": file_handler.upload_id,
+                    "offset": file_handler.received_size,
+                    "binary": file_handler.binary,
+                    "window": file_handler.ack_window.size if file_handler.ack_window else 1,
+                    "compact_acks": file_handler.compact_acks,
+                    "compression": file_handler.compression,
+                    "chunk_size": file_handler.chunk_size,
+                    "max_chunk_size": file_handler.max_chunk_size,
+                }
+            )
+        )
+
+    async def send_meta_deferred(self, error: AdmissionDeferredError):
+        await self.consumer.send(
+            text_data=encode_json(
+                {
+                    "type": MessageType.META_DEFERRED.value,
+                    "message": "Server busy, send the file metadata again later",
+                    "reason": error.reason,
+                    "retry_after": error.retry_after,
                 }
             )
         )
 
-    async def send_chunk_received(self):
-        logger.info("Chunk received, ready for the next chunk.")
+    async def send_chunk_size(self, file_handler: "FileTransferHandler"):
+        logger.info(f"Chunk size of transfer {file_handler.transfer_id} adjusted to {file_handler.chunk_size} bytes")
         await self.consumer.send(
-            text_data=json.dumps(
+            text_data=encode_json(
                 {
-                    "type": MessageType.CHUNK_RECEIVED.value,
-                    "message": "Ready for next chunk",
+                    "type": MessageType.CHUNK_SIZE.value,
+                    "message": "Chunk size adjusted",
+                    "transfer_id": file_handler.transfer_id,
+                    "chunk_size": file_handler.chunk_size,
+                    "max_chunk_size": file_handler.max_chunk_size,
                 }
             )
         )
 
-    async def send_file_received(self, file_extension: str, file_name: str):
-        logger.info(f"File received: {file_name} with extension: {file_extension}")
+    async def send_chunk_received(
+        self, file_handler: "FileTransferHandler", seq: int | None = None, offset: int | None = None
+    ):
+        # Sliding window acknowledgements are cumulative, they cover every chunk up to `seq`.
+        if file_handler.compact_acks:
+            if seq is None or offset is None:
+                seq, offset = file_handler.received_chunks - 1, file_handler.received_size
+            await self.consumer.send(bytes_data=build_ack(file_handler.transfer_id, seq, offset))
+        elif seq is None or offset is None:
+            await self.consumer.send(text_data=encode_chunk_received(file_handler.transfer_id))
+        else:
+            await self.consumer.send(text_data=encode_window_ack(file_handler.transfer_id, seq, offset))
+
+    async def send_upload_progress(self, progress: dict):
+        await self.consumer.send(text_data=encode_json({**progress, "type": MessageType.UPLOAD_PROGRESS.value}))
+
+    async def send_file_processed(self, event: dict):
+        await self.consumer.send(text_data=encode_json({**event, "type": MessageType.FILE_PROCESSED.value}))
+
+    async def send_file_received(self, file_handler: "FileTransferHandler"):
+        file_name = file_handler.file_name
+        file_extension = file_handler.get_file_extension()
+        logger.debug(f"File received: {file_name} with extension: {file_extension}")
         await self.consumer.send(
-            text_data=json.dumps(
+            text_data=encode_json(
                 {
                     "type": MessageType.FILE_RECEIVED.value,
                     "message": f"File {file_name} received successfully and file extension is `{file_extension}`",
                     "extension": file_extension,
+                    "detected_type": file_handler.detected_type,
+                    "sha256": file_handler.sha256,
+                    "deduplicated": file_handler.deduplicated,
+                    "transfer_id": file_handler.transfer_id,
                 }
             )
         )
 
 
+def get_upload_progress_key(upload_id: str) -> str:
+    return f"{settings.UPLOAD_PROGRESS_KEY_PREFIX}{upload_id}"
+
+
+def get_upload_group(upload_id: str) -> str:
+    """Channel layer group of the connections following an upload, whichever worker carries it."""
+    return f"upload_{upload_id}"
+
+
+def check_file_size(file_size: Any) -> int:
+    """Validate a file size declared by a client, it sizes the budgets and preallocations of the transfer."""
+    if not isinstance(file_size, int) or isinstance(file_size, bool) or file_size < 0:
+        raise ValueError(f"Invalid file size: {file_size}.")
+    if file_size > settings.FILE_MAX_SIZE:
+        raise ValueError(f"File size {file_size // 1024 // 1024}MB exceeds the maximum allowed size.")
+    return file_size
+
+
+def get_spool_directory() -> str:
+    return settings.FILE_SPOOL_DIRECTORY or settings.FILE_SAVE_DIRECTORY
+
+
+def get_spool_path(upload_id: str) -> str:
+    return os.path.join(get_spool_directory(), f".{upload_id}.part")
+
+
 class FileTransferHandler:
-    def __init__(self, file_name: str, file_size: int):
+    def __init__(
+        self,
+        file_name: str,
+        file_size: int,
+        transfer_id: int = 0,
+        binary: bool = False,
+        upload_id: str | None = None,
+        sha256: str | None = None,
+        compact_acks: bool = False,
+        compression: str | None = None,
+    ):
         self.file_name = file_name
         self.file_size = file_size
+        self.transfer_id = transfer_id
+        self.binary = binary
+        self.compact_acks = compact_acks
+        self.compression = compression
+        self.upload_id = upload_id or uuid.uuid4().hex
+        self.expected_sha256 = sha256.lower() if sha256 else None
+        self.hasher = hashlib.sha256()
         self.received_size = 0
-        self.content = b""
+        self.persisted_size = 0
+        self.deduplicated = False
+        self.spool: BinaryIO | None = None
+        self.preallocated = False
+        self.ack_window: AckWindow | None = None
+        self.lock: UploadLock | None = None
+        self.reservation: Reservation | None = None
+        self.chunk_size: int | None = None
+        self.max_chunk_size: int | None = None
+        self.started_at = self.last_chunk_at = self.checkpoint_at = time.monotonic()
+        self.resumed_size = 0
+        self.checkpoint_size = 0
+        self.received_chunks = 0
 
-        if self.file_size > settings.FILE_MAX_SIZE:
-            raise ValueError(f"File size {self.file_size // 1024 // 1024}MB exceeds the maximum allowed size.")
+        if self.compact_acks and not self.binary:
+            raise ValueError("Compact acknowledgements require the binary mode.")
+        if self.compression is not None and self.compression not in get_compressions():
+            raise ValueError(f"Unsupported compression: {self.compression}.")
+        if not UPLOAD_ID_PATTERN.fullmatch(self.upload_id):
+            raise ValueError(f"Invalid upload id: {self.upload_id}.")
+        if self.expected_sha256 is not None and not SHA256_PATTERN.fullmatch(self.expected_sha256):
+            raise ValueError(f"Invalid SHA-256 digest: {sha256}.")
+        check_file_size(self.file_size)
         if (extension := self.get_file_extension()) not in settings.FILE_ALLOWED_EXTENSIONS:
             raise ValueError(f"Invalid file extension: {extension}.")
         self._sanitize_file_name()
+        self.sniffer = ContentSniffer(extension) if settings.FILE_VERIFY_CONTENT else None
+        # By default the spool lives next to its final destination so that `save_file` can move it into place
+        # with an atomic rename instead of copying it across file systems.
+        self.spool_path = get_spool_path(self.upload_id)
+        self.storage = get_storage()
+        self.writer = self.storage.open_writer(self.upload_id, self.file_name, self.spool_path)
+
+    @classmethod
+    async def resume(
+        cls,
+        upload_id: str,
+        file_name: str,
+        file_size: int,
+        transfer_id: int = 0,
+        binary: bool = False,
+        sha256: str | None = None,
+        compact_acks: bool = False,
+        compression: str | None = None,
+    ) -> "FileTransferHandler":
+        handler = cls(
+            file_name,
+            file_size,
+            transfer_id=transfer_id,
+            binary=binary,
+            upload_id=upload_id,
+            sha256=sha256,
+            compact_acks=compact_acks,
+            compression=compression,
+        )
+        progress = await cache.aget(get_upload_progress_key(handler.upload_id))
+        if progress is None:
+            raise ValueError(f"Unknown or expired upload id: {upload_id}.")
+        if (progress["file_name"], progress["file_size"]) != (handler.file_name, handler.file_size):
+            raise ValueError(f"File metadata does not match upload {upload_id}.")
+        if handler.expected_sha256 is None:
+            handler.expected_sha256 = progress["sha256"]
+        elif progress["sha256"] not in (None, handler.expected_sha256):
+            raise ValueError(f"SHA-256 digest does not match upload {upload_id}.")
+
+        handler.received_size = await run_io(handler._reopen_spool, progress["received_size"])
+        await handler._replay_spool()
+        handler.persisted_size = handler.resumed_size = handler.checkpoint_size = handler.received_size
+        logger.info(f"Resuming upload {upload_id} at offset {handler.received_size}")
+        return handler
+
+    async def append_chunk(self, chunk: str, offset: int | None = None, crc32: int | None = None):
+        with CHUNK_DECODE_SECONDS.labels(encoding="base64").time():
+            chunk_bytes = await self._decode_b64_chunk(chunk)
+        await self.append_bytes(chunk_bytes, offset=offset, crc32=crc32)
 
-    async def append_chunk(self, chunk: str):
-        chunk_bytes = await self._decode_b64_chunk(chunk)
-        self.content += chunk_bytes
-        self.received_size += len(chunk_bytes)
+    async def append_bytes(self, data: bytes | memoryview, offset: int | None = None, crc32: int | None = None):
+        if self.compression is not None:
+            data = await self._decompress_chunk(data)
+        if offset is not None and offset != self.received_size:
+            raise ValueError(f"Unexpected chunk offset {offset}, expected {self.received_size}.")
+        if crc32 is not None and zlib.crc32(data) != crc32:
+            raise ValueError(f"Chunk checksum mismatch at offset {self.received_size}, resend the chunk.")
+        if self.received_size + len(data) > self.file_size:
+            raise ValueError(f"Chunk exceeds the declared file size of {self.file_size} bytes.")
+        # Only one chunk every LOG_CHUNK_SAMPLE_RATE is logged, a line per chunk would cost more than the chunk itself.
+        sample_rate = settings.LOG_CHUNK_SAMPLE_RATE
+        if sample_rate and self.received_chunks % sample_rate == 0 and logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                f"Transfer {self.transfer_id} received chunk {self.received_chunks} of {len(data)} bytes "
+                f"at offset {self.received_size}"
+            )
+        if self.sniffer is not None:
+            self.sniffer.feed(data)
+            if not self.sniffer.is_done and self.received_size + len(data) == self.file_size:
+                self.sniffer.verify()
+
+        # Progress is only persisted after the spool is flushed, so the stored offset never runs ahead of the data.
+        persist = self.received_size + len(data) - self.persisted_size >= settings.UPLOAD_PROGRESS_SAVE_INTERVAL
+        await run_io(self._write_to_spool, data, persist or self.writer.reads_spool)
+        await self.writer.write(data)
+        self.received_size += len(data)
+        self.received_chunks += 1
+        self.last_chunk_at = time.monotonic()
+        if persist:
+            await self.save_progress()
+        if self.is_file_complete() and self.expected_sha256 not in (None, self.sha256):
+            raise TransferRejectedError("File checksum mismatch, the received file is corrupted.")
 
     async def _decode_b64_chunk(self, chunk: str) -> bytes:
-        return base64.b64decode(chunk)
+        # Decoding the ASCII string directly skips the bytes copy `base64.b64decode` makes of it first.
+        return binascii.a2b_base64(chunk)
+
+    async def _decompress_chunk(self, data: bytes | memoryview) -> bytes:
+        # Chunks are compressed one by one, so that a resumed upload doesn't need the state of a stream. A chunk never
+        # expands past the rest of the file nor past the largest chunk the client was told to send.
+        max_size = self.file_size - self.received_size
+        if self.max_chunk_size is not None:
+            max_size = min(max_size, self.max_chunk_size)
+        COMPRESSED_BYTES.labels(compression=self.compression).inc(len(data))
+        with CHUNK_DECODE_SECONDS.labels(encoding=self.compression).time():
+            return await run_io(decompress, data, self.compression, max_size)
+
+    @property
+    def sha256(self) -> str:
+        # Deduplicated files are never transferred, their digest is the one the client declared.
+        if self.deduplicated:
+            # Only content matching a declared digest is deduplicated.
+            assert self.expected_sha256 is not None
+            return self.expected_sha256
+        return self.hasher.hexdigest()
+
+    @property
+    def detected_type(self) -> str | None:
+        return self.sniffer.detected_type if self.sniffer is not None else None
 
     def is_file_complete(self) -> bool:
         return self.received_size >= self.file_size
 
+    def check_stalled(self, idle_timeout: float, min_throughput: int, period: float) -> str | None:
+        """Reason to give up on the transfer when it stalled, None while it makes progress.
+
+        A transfer stalls when no chunk arrived for `idle_timeout` seconds, or when it received less than
+        `min_throughput` bytes per second since the previous check at least `period` seconds ago. Either limit is
+        disabled by 0.
+        """
+        now = time.monotonic()
+        if idle_timeout and now - self.last_chunk_at >= idle_timeout:
+            return f"no chunk received for {idle_timeout} seconds"
+        elapsed = now - self.checkpoint_at
+        if elapsed < period:
+            return None
+        throughput = (self.received_size - self.checkpoint_size) / elapsed
+        self.checkpoint_at, self.checkpoint_size = now, self.received_size
+        if min_throughput and throughput < min_throughput:
+            return f"throughput of {throughput:.0f} bytes per second below {min_throughput}"
+        return None
+
+    async def save_progress(self):
+        progress = {
+            "file_name": self.file_name,
+            "file_size": self.file_size,
+            "received_size": self.received_size,
+            "sha256": self.expected_sha256,
+        }
+        await cache.aset(get_upload_progress_key(self.upload_id), progress, timeout=settings.UPLOAD_PROGRESS_TIMEOUT)
+        self.persisted_size = self.received_size
+
     async def save_file(self):
-        file_path = os.path.join(settings.FILE_SAVE_DIRECTORY, self.file_name)
-        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        logger.debug(f"Saving file {self.file_name}")
+        await run_io(self._commit_spool)
+        self.file_name = await self.writer.commit(self.spool_path, self.sha256, self.file_name)
+        await cache.adelete(get_upload_progress_key(self.upload_id))
+        self.log_summary()
+
+    def log_summary(self):
+        """Log a single record for the whole upload, with the figures of this session as structured fields."""
+        duration = time.monotonic() - self.started_at
+        transferred_size = self.received_size - self.resumed_size
+        throughput = transferred_size / duration / 1024 / 1024 if duration > 0 else 0.0
+        UPLOAD_DURATION_SECONDS.observe(duration)
+        logger.info(
+            f"Upload {self.upload_id} saved as {self.file_name}: {transferred_size} bytes in {self.received_chunks} "
+            f"chunks, {duration:.3f}s ({throughput:.2f} MB/s)",
+            extra={
+                "upload_id": self.upload_id,
+                "file_name": self.file_name,
+                "file_size": self.file_size,
+                "resumed_from": self.resumed_size,
+                "chunks": self.received_chunks,
+                "duration": round(duration, 6),
+                "throughput": round(throughput, 3),
+            },
+        )
+
+    async def save_existing_content(self) -> bool:
+        """Save the file without transferring it when the storage already holds the content the client declared."""
+        if self.expected_sha256 is None or not await self.storage.has_content(self.expected_sha256, self.file_size):
+            return False
+        if self.sniffer is not None:
+            self.sniffer.feed(await self.storage.read_head(self.expected_sha256, SNIFF_SIZE))
+            if not self.sniffer.is_done:
+                self.sniffer.verify()
+
+        self.file_name = await self.storage.link(self.expected_sha256, self.file_name)
+        self.deduplicated = True
+        logger.info(f"File content already stored, saved {self.file_name} without transfer")
+        return True
 
-        logger.info(f"Saving file to {file_path}")
-        with open(file_path, "wb") as f:
-            f.write(self.content)
-        logger.info(f"File saved successfully: {file_path}")
+    async def suspend(self):
+        """Keep a partially received file on disk so the client can resume it with its upload id."""
+        if self.spool is not None:
+            await run_io(self._close_spool, trim=True)
+        # The spool holds everything received so far, the storage is fed again from it when the upload resumes.
+        await self.writer.abort()
+        await self.save_progress()
+
+    async def release(self):
+        """Let go of an upload another connection carries now, leaving its spool and progress to that connection."""
+        if self.spool is not None:
+            await run_io(self._close_spool)
+        await self.writer.abort()
+
+    async def discard(self):
+        """Drop a partially received file, removing its spool and progress."""
+        await run_io(self._remove_spool)
+        await self.writer.abort()
+        await cache.adelete(get_upload_progress_key(self.upload_id))
 
     def get_file_extension(self) -> str:
         extension = os.path.splitext(self.file_name)[1][1:]
@@ -94,3 +417,88 @@ class FileTransferHandler:
 
     def _sanitize_file_name(self):
         self.file_name = "".join(char for char in self.file_name if char.isalnum() or char in [".", "_", "-"])
+
+    def _open_spool(self) -> BinaryIO:
+        os.makedirs(get_spool_directory(), exist_ok=True)
+        self.spool = spool = open(self.spool_path, "wb")
+        self._preallocate_spool(spool)
+        return spool
+
+    def _get_spool(self) -> BinaryIO:
+        return self.spool if self.spool is not None else self._open_spool()
+
+    def _reopen_spool(self, received_size: int) -> int:
+        if not os.path.exists(self.spool_path):
+            return 0
+        self.spool = spool = open(self.spool_path, "r+b")
+        # Anything past the persisted offset was never acknowledged as durable, the client sends it again.
+        received_size = min(received_size, os.fstat(spool.fileno()).st_size)
+        spool.truncate(received_size)
+        self._preallocate_spool(spool)
+        spool.seek(received_size)
+        return received_size
+
+    def _preallocate_spool(self, spool: BinaryIO):
+        # Reserving the declared size up front keeps the spool contiguous on disk and fails early when it's full.
+        if not settings.FILE_SPOOL_PREALLOCATE or not self.file_size or not hasattr(os, "posix_fallocate"):
+            return
+        try:
+            os.posix_fallocate(spool.fileno(), 0, self.file_size)
+            self.preallocated = True
+        except OSError as e:
+            if e.errno == errno.ENOSPC:
+                raise TransferRejectedError("Not enough disk space left to receive the file.") from e
+            # File systems without preallocation support, the spool just grows as chunks arrive.
+            if e.errno not in (errno.EOPNOTSUPP, errno.EINVAL):
+                raise
+
+    async def _replay_spool(self):
+        """Feed the part received before an interruption to the hasher, sniffer and storage writer again."""
+        offset = 0
+        while offset < self.received_size:
+            block = await run_io(self._read_spool, offset, min(SPOOL_BLOCK_SIZE, self.received_size - offset))
+            if self.sniffer is not None:
+                self.sniffer.feed(block)
+            await self.writer.write(block)
+            offset += len(block)
+
+    def _read_spool(self, offset: int, size: int) -> bytes:
+        # Only resumed uploads are replayed, their spool was reopened.
+        assert self.spool is not None
+        block = os.pread(self.spool.fileno(), size, offset)
+        # Hash state can't be persisted, it is restored by hashing the spool again.
+        self.hasher.update(block)
+        return block
+
+    def _write_to_spool(self, data: bytes | memoryview, flush: bool = False):
+        spool = self._get_spool()
+        with DISK_WRITE_SECONDS.labels(operation="write").time():
+            spool.write(data)
+        # Hashing here keeps it off the event loop, hashlib releases the GIL for buffers this size.
+        self.hasher.update(data)
+        if flush:
+            with DISK_WRITE_SECONDS.labels(operation="flush").time():
+                spool.flush()
+
+    def _commit_spool(self):
+        spool = self._get_spool()
+        spool.truncate(self.received_size)
+        with DISK_WRITE_SECONDS.labels(operation="fsync").time():
+            spool.flush()
+            os.fsync(spool.fileno())
+        self._close_spool()
+
+    def _close_spool(self, trim: bool = False):
+        if self.spool is None:
+            return
+        # Suspended uploads give the space preallocated for the rest of the file back until they are resumed.
+        if trim:
+            self.spool.truncate(self.received_size)
+        self.spool.close()
+        self.spool = None
+
+    def _remove_spool(self):
+        if self.spool is not None:
+            self._close_spool()
+        if os.path.exists(self.spool_path):
+            os.remove(self.spool_path)
@@ -0,0 +1,76 @@
+import time
+
+from file_listener.clients import LuaScript
+
+# Takes or extends the lock for ARGV[1], returning nothing on success and the current owner otherwise.
+ACQUIRE_LOCK = LuaScript(
+    """
+    local owner = redis.call("GET", KEYS[1])
+    if owner and owner ~= ARGV[1] then
+        return owner
+    end
+    redis.call("SET", KEYS[1], ARGV[1], "PX", ARGV[2])
+    return false
+    """
+)
+
+# Extends the lock for ARGV[1], taking it again if it expired meanwhile, only fails when another owner holds it.
+RENEW_LOCK = LuaScript(
+    """
+    local owner = redis.call("GET", KEYS[1])
+    if owner and owner ~= ARGV[1] then
+        return 0
+    end
+    redis.call("SET", KEYS[1], ARGV[1], "PX", ARGV[2])
+    return 1
+    """
+)
+
+RELEASE_LOCK = LuaScript(
+    """
+    if redis.call("GET", KEYS[1]) == ARGV[1] then
+        return redis.call("DEL", KEYS[1])
+    end
+    return 0
+    """
+)
+
+
+class UploadLock:
+    """Ownership of an upload shared by every worker through Redis, only its owner writes the spool and progress.
+
+    The owner is the channel name of the consumer carrying the upload, so another worker can ask it to hand the
+    upload over through the channel layer. The lock expires after `timeout` seconds without renewal, an upload
+    carried by a worker that died can be taken over once it does.
+    """
+
+    def __init__(self, key_prefix: str, upload_id: str, owner: str, timeout: float):
+        self.key = f"{key_prefix}{upload_id}"
+        self.owner = owner
+        self.timeout = timeout
+        self.renew_at = 0.0
+
+    async def acquire(self) -> str | None:
+        """Take the lock, returning None on success and the channel name of the current owner otherwise."""
+        owner = await ACQUIRE_LOCK([self.key], [self.owner, int(self.timeout * 1000)])
+        if owner is not None:
+            return owner.decode()
+        self.renew_at = time.monotonic() + self.timeout / 3
+        return None
+
+    async def renew(self) -> bool:
+        """Extend the lock, returning False when another owner took it over after it expired.
+
+        A lock that expired without anyone taking it over is taken again, a client pausing longer than the timeout
+        keeps its upload. Redis is only hit once a third of the timeout elapsed since the last renewal, not for every
+        chunk.
+        """
+        if time.monotonic() < self.renew_at:
+            return True
+        if not await RENEW_LOCK([self.key], [self.owner, int(self.timeout * 1000)]):
+            return False
+        self.renew_at = time.monotonic() + self.timeout / 3
+        return True
+
+    async def release(self):
+        await RELEASE_LOCK([self.key], [self.owner])
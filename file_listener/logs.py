@@ -0,0 +1,48 @@
+import atexit
+import json
+import logging
+import logging.handlers
+
+# Attributes every log record has, anything else was passed with `extra` and belongs in the structured output.
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", logging.INFO, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """Format records as one JSON object per line, including the fields passed with `extra`."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "module": record.module,
+            "message": record.getMessage(),
+        }
+        data.update((key, value) for key, value in vars(record).items() if key not in RECORD_ATTRIBUTES)
+        if record.exc_info:
+            data["exception"] = self.formatException(record.exc_info)
+        return json.dumps(data, default=str)
+
+
+class QueueListener(logging.handlers.QueueListener):
+    """Queue listener starting with the logging configuration, writing records from its own thread.
+
+    `dictConfig` creates the listener of a queue handler but leaves starting it to the application, Django configures
+    logging before any application code runs so the listener starts itself.
+    """
+
+    running: "QueueListener | None" = None
+
+    def __init__(self, queue, *handlers, respect_handler_level: bool = False):
+        super().__init__(queue, *handlers, respect_handler_level=respect_handler_level)
+        # Django configures logging again when loading the ASGI application, the previous listener would sit idle.
+        if QueueListener.running is None:
+            atexit.register(QueueListener.stop_running)
+        else:
+            QueueListener.running.stop()
+        QueueListener.running = self
+        self.start()
+
+    @classmethod
+    def stop_running(cls):
+        """Write the records still queued before the process exits."""
+        cls.running.stop()
@@ -0,0 +1,50 @@
+import atexit
+import os
+
+from django.conf import settings
+from prometheus_client import Counter, Gauge, Histogram, multiprocess
+
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+DURATION_BUCKETS = (0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 600.0, 1800.0)
+
+if settings.PROMETHEUS_MULTIPROC_DIR:
+    # The gauges of a process are left out of the aggregated values once it exits, the counters keep counting.
+    atexit.register(multiprocess.mark_process_dead, os.getpid(), settings.PROMETHEUS_MULTIPROC_DIR)
+
+CHUNK_DECODE_SECONDS = Histogram(
+    "file_transfer_chunk_decode_seconds",
+    "Time spent decoding chunks into bytes.",
+    ("encoding",),
+    buckets=LATENCY_BUCKETS,
+)
+RATE_LIMIT_SECONDS = Histogram(
+    "file_transfer_rate_limit_seconds", "Latency of the Redis rate limit check.", buckets=LATENCY_BUCKETS
+)
+DISK_WRITE_SECONDS = Histogram(
+    "file_transfer_disk_write_seconds",
+    "Latency of spool file writes and syncs, in the I/O threads.",
+    ("operation",),
+    buckets=LATENCY_BUCKETS,
+)
+UPLOAD_DURATION_SECONDS = Histogram(
+    "file_transfer_upload_duration_seconds", "Time from the file metadata to the saved file.", buckets=DURATION_BUCKETS
+)
+RECEIVED_BYTES = Counter("file_transfer_received_bytes_total", "Chunk bytes received.", ("encoding",))
+COMPRESSED_BYTES = Counter(
+    "file_transfer_compressed_bytes_total", "Compressed chunk bytes received, before decompression.", ("compression",)
+)
+UPLOADS = Counter("file_transfer_uploads_total", "Uploads by outcome.", ("outcome",))
+REJECTIONS = Counter("file_transfer_rejections_total", "Messages rejected with an error, by reason.", ("reason",))
+DEFERRALS = Counter(
+    "file_transfer_deferrals_total", "File metadata deferred by admission control, by reason.", ("reason",)
+)
+# Gauges add up the values of the running processes in multiprocess mode.
+RESERVED_BYTES = Gauge(
+    "file_transfer_reserved_bytes", "Declared size of the admitted transfers.", multiprocess_mode="livesum"
+)
+ACTIVE_CONNECTIONS = Gauge(
+    "file_transfer_active_connections", "WebSocket connections currently open.", multiprocess_mode="livesum"
+)
+ACTIVE_TRANSFERS = Gauge(
+    "file_transfer_active_transfers", "Transfers currently in progress.", multiprocess_mode="livesum"
+)
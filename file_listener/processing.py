@@ -0,0 +1,182 @@
+import asyncio
+import json
+import logging
+import os
+import uuid
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import asdict, dataclass
+
+from channels.layers import get_channel_layer
+from django.utils.module_loading import import_string
+
+from file_listener.clients import LuaScript
+from file_listener.executors import get_process_executor, reset_process_executor, run_in
+from file_listener.handlers import get_upload_group
+
+logger = logging.getLogger("django")
+
+# Jobs are kept in a hash until they complete, a sorted set holds their lease expiry times (0 while queued).
+ENQUEUE_JOB = LuaScript(
+    """
+    redis.call("HSET", KEYS[2], ARGV[1], ARGV[2])
+    return redis.call("ZADD", KEYS[1], 0, ARGV[1])
+    """
+)
+
+# Leases up to ARGV[2] jobs, queued ones or ones whose worker died while running them, for ARGV[1] milliseconds.
+# Jobs that were leased ARGV[3] times already are dropped, they keep crashing the worker processes.
+CLAIM_JOBS = LuaScript(
+    """
+    local time = redis.call("TIME")
+    local now = time[1] * 1000 + math.floor(time[2] / 1000)
+    local jobs = {}
+    for _, id in ipairs(redis.call("ZRANGEBYSCORE", KEYS[1], "-inf", now, "LIMIT", 0, ARGV[2])) do
+        local job = redis.call("HGET", KEYS[2], id)
+        if job and redis.call("HINCRBY", KEYS[3], id, 1) <= tonumber(ARGV[3]) then
+            redis.call("ZADD", KEYS[1], now + tonumber(ARGV[1]), id)
+            table.insert(jobs, job)
+        else
+            redis.call("ZREM", KEYS[1], id)
+            redis.call("HDEL", KEYS[2], id)
+            redis.call("HDEL", KEYS[3], id)
+        end
+    end
+    return jobs
+    """
+)
+
+COMPLETE_JOB = LuaScript(
+    """
+    redis.call("ZREM", KEYS[1], ARGV[1])
+    redis.call("HDEL", KEYS[3], ARGV[1])
+    return redis.call("HDEL", KEYS[2], ARGV[1])
+    """
+)
+
+# Extends the lease of running job ARGV[1] by ARGV[2] milliseconds, unless it was completed or dropped meanwhile.
+RENEW_LEASE = LuaScript(
+    """
+    local time = redis.call("TIME")
+    local now = time[1] * 1000 + math.floor(time[2] / 1000)
+    return redis.call("ZADD", KEYS[1], "XX", "CH", now + tonumber(ARGV[2]), ARGV[1])
+    """
+)
+
+
+@dataclass
+class Job:
+    id: str
+    upload_id: str
+    file_name: str
+    path: str
+    processor: str
+    reply_channel: str
+
+    def get_event(self, status: str, **fields) -> dict:
+        return {
+            "type": "upload.processed",
+            "upload_id": self.upload_id,
+            "file_name": self.file_name,
+            "status": status,
+            **fields,
+        }
+
+
+class PostProcessingQueue:
+    """Runs the processor of each saved file's extension on the process pool, with the pending jobs kept in Redis.
+
+    Jobs are queued per node, the saved files they process are only on the node's storage. At most `max_jobs` jobs
+    run at once per server process, the others wait in Redis for a process of the node with room to claim them. Each
+    server process polls Redis every third of `timeout` seconds to claim them. Running jobs are leased for `timeout`
+    seconds and the lease is renewed while they run, the jobs of a process that stopped are claimed again by the others
+    once their lease expires. Progress is sent to the connection that uploaded the file, if it's still there, and to
+    the connections watching the upload.
+    """
+
+    running = 0
+    poller: asyncio.Task | None = None
+    tasks: set[asyncio.Task] = set()
+
+    def __init__(
+        self, key_prefix: str, node_id: str, processors: dict[str, str], max_jobs: int, timeout: int, max_attempts: int
+    ):
+        self.keys = [f"{key_prefix}{node_id}_leases", f"{key_prefix}{node_id}_jobs", f"{key_prefix}{node_id}_attempts"]
+        self.processors = processors
+        self.max_jobs = max_jobs
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+
+    async def submit(self, upload_id: str, file_name: str, path: str, reply_channel: str) -> Job | None:
+        """Queue the processing of a saved file, returning None when its extension has no processor."""
+        extension = os.path.splitext(file_name)[1][1:].lower()
+        if (processor := self.processors.get(extension)) is None:
+            return None
+        job = Job(uuid.uuid4().hex, upload_id, file_name, path, processor, reply_channel)
+        await ENQUEUE_JOB(self.keys, [job.id, json.dumps(asdict(job))])
+        await self.dispatch()
+        return job
+
+    def start(self):
+        """Start polling the pending jobs, once per server process."""
+        poller = PostProcessingQueue.poller
+        if not self.processors or (poller is not None and not poller.done()):
+            return
+        PostProcessingQueue.poller = asyncio.create_task(self.poll())
+
+    async def poll(self):
+        # Claims the jobs queued while every process was full and the ones left by a process that stopped.
+        while True:
+            try:
+                await self.dispatch()
+            except Exception as e:
+                logger.error(f"Claiming post-processing jobs failed: {str(e)}")
+            await asyncio.sleep(self.timeout / 3)
+
+    async def dispatch(self):
+        capacity = self.max_jobs - PostProcessingQueue.running
+        if capacity <= 0:
+            return
+        for data in await CLAIM_JOBS(self.keys, [self.timeout * 1000, capacity, self.max_attempts]):
+            job = Job(**json.loads(data))
+            PostProcessingQueue.running += 1
+            task = asyncio.create_task(self.run(job))
+            # The event loop only keeps weak references to tasks.
+            PostProcessingQueue.tasks.add(task)
+            task.add_done_callback(PostProcessingQueue.tasks.discard)
+
+    async def run(self, job: Job):
+        try:
+            await self.notify(job, job.get_event("started"))
+            renewal = asyncio.create_task(self.renew_lease(job))
+            try:
+                result = await run_in(get_process_executor(), import_string(job.processor), job.path)
+                event = job.get_event("done", result=result)
+            except BrokenProcessPool:
+                # The job stays leased, it is claimed again once the lease expires unless it crashed too often.
+                logger.error(f"Post-processing worker died while processing {job.file_name}")
+                reset_process_executor()
+                return
+            except Exception as e:
+                logger.exception(f"Post-processing of {job.file_name} failed: {str(e)}")
+                event = job.get_event("failed", error=str(e))
+            finally:
+                renewal.cancel()
+            await COMPLETE_JOB(self.keys, [job.id])
+            await self.notify(job, event)
+        finally:
+            PostProcessingQueue.running -= 1
+        await self.dispatch()
+
+    async def renew_lease(self, job: Job):
+        # Jobs running longer than the lease timeout must not be claimed by another process meanwhile.
+        while True:
+            await asyncio.sleep(self.timeout / 3)
+            try:
+                await RENEW_LEASE(self.keys, [job.id, self.timeout * 1000])
+            except Exception as e:
+                logger.error(f"Renewing the lease of {job.file_name} failed: {str(e)}")
+
+    async def notify(self, job: Job, event: dict):
+        channel_layer = get_channel_layer()
+        await channel_layer.send(job.reply_channel, event)
+        await channel_layer.group_send(get_upload_group(job.upload_id), event)
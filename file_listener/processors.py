@@ -0,0 +1,99 @@
+"""Post-processing of saved files, run in worker processes.
+
+Processors take the path of a saved file and return a JSON serializable result sent to the client. They run outside
+the server process, so they must not depend on Django or on any state of the server.
+"""
+
+import codecs
+import os
+import re
+import struct
+from typing import Any
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+READ_BLOCK_SIZE = 1024 * 1024
+THUMBNAIL_SIZE = (256, 256)
+THUMBNAIL_DIRECTORY = ".thumbnails"
+
+# JPEG start of frame markers carry the dimensions, the others in the C0-CF range are tables.
+JPEG_FRAME_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+PDF_PAGE_COUNT = re.compile(rb"/Type\s*/Pages\b[^>]*?/Count\s+(\d+)|/Count\s+(\d+)[^>]*?/Type\s*/Pages\b")
+PDF_PAGE = re.compile(rb"/Type\s*/Page(?![A-Za-z])")
+TEXT_BOMS = (
+    (codecs.BOM_UTF32_LE, "utf-32"),
+    (codecs.BOM_UTF32_BE, "utf-32"),
+    (codecs.BOM_UTF8, "utf-8-sig"),
+    (codecs.BOM_UTF16_LE, "utf-16"),
+    (codecs.BOM_UTF16_BE, "utf-16"),
+)
+# Tried in order, latin-1 decodes anything so it always ends the detection.
+TEXT_ENCODINGS = ("ascii", "utf-8", "cp1252", "latin-1")
+
+
+def get_image_size(head: bytes) -> tuple[int, int] | None:
+    """Read the dimensions of a PNG, GIF or JPEG image from its first bytes."""
+    if head.startswith(b"\x89PNG\r\n\x1a\n") and head[12:16] == b"IHDR":
+        return struct.unpack(">II", head[16:24])
+    if head.startswith((b"GIF87a", b"GIF89a")):
+        return struct.unpack("<HH", head[6:10])
+    if head.startswith(b"\xff\xd8"):
+        position = 2
+        while position + 9 <= len(head):
+            if head[position] != 0xFF:
+                return None
+            marker = head[position + 1]
+            if marker in JPEG_FRAME_MARKERS:
+                height, width = struct.unpack(">HH", head[position + 5 : position + 9])
+                return width, height
+            position += 2 + struct.unpack(">H", head[position + 2 : position + 4])[0]
+    return None
+
+
+def image_info(path: str) -> dict:
+    """Dimensions of an image, with a thumbnail next to it when Pillow is installed."""
+    with open(path, "rb") as f:
+        # JPEG frame headers can come after large metadata segments.
+        size = get_image_size(f.read(256 * 1024))
+    result: dict[str, Any] = {"width": size[0], "height": size[1]} if size else {"width": None, "height": None}
+    if Image is not None:
+        directory, file_name = os.path.split(path)
+        thumbnail_name = os.path.join(THUMBNAIL_DIRECTORY, f"{file_name}.png")
+        os.makedirs(os.path.join(directory, THUMBNAIL_DIRECTORY), exist_ok=True)
+        with Image.open(path) as image:
+            image.thumbnail(THUMBNAIL_SIZE)
+            image.save(os.path.join(directory, thumbnail_name), "PNG")
+        result["thumbnail"] = thumbnail_name
+    return result
+
+
+def pdf_info(path: str) -> dict:
+    """Number of pages of a PDF, from its page tree root or by counting page objects when it has none in clear."""
+    with open(path, "rb") as f:
+        content = f.read()
+    counts = [int(first or second) for first, second in PDF_PAGE_COUNT.findall(content)]
+    # The root of the page tree counts every page, the other nodes only a part of them.
+    pages = max(counts) if counts else len(PDF_PAGE.findall(content))
+    return {"pages": pages}
+
+
+def text_info(path: str) -> dict:
+    """Encoding and number of lines of a text file, decoded block by block."""
+    with open(path, "rb") as f:
+        head = f.read(4)
+    encodings = [encoding for bom, encoding in TEXT_BOMS if head.startswith(bom)][:1] or TEXT_ENCODINGS
+    for encoding in encodings:
+        decoder = codecs.getincrementaldecoder(encoding)()
+        lines = 0
+        try:
+            with open(path, "rb") as f:
+                while block := f.read(READ_BLOCK_SIZE):
+                    lines += decoder.decode(block).count("\n")
+                decoder.decode(b"", final=True)
+        except UnicodeDecodeError:
+            continue
+        return {"encoding": encoding, "lines": lines}
+    return {"encoding": None, "lines": None}
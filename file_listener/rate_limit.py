@@ -0,0 +1,151 @@
+import time
+from dataclasses import dataclass
+
+from file_listener.clients import LuaScript
+
+# Fixed window counter, the window starts with the first message and expires after `period` seconds.
+INCREMENT_WINDOW = LuaScript(
+    """
+    local count = redis.call("INCR", KEYS[1])
+    if count == 1 then
+        redis.call("EXPIRE", KEYS[1], ARGV[1])
+    end
+    return count
+    """
+)
+
+# Grants up to ARGV[1] tokens of the window at once, returning how many were granted and the window's remaining time.
+LEASE_TOKENS = LuaScript(
+    """
+    local count = tonumber(redis.call("GET", KEYS[1]) or "0")
+    local granted = math.min(tonumber(ARGV[1]), tonumber(ARGV[2]) - count)
+    if granted <= 0 then
+        return {0, redis.call("PTTL", KEYS[1])}
+    end
+    if redis.call("INCRBY", KEYS[1], granted) == granted then
+        redis.call("EXPIRE", KEYS[1], ARGV[3])
+    end
+    return {granted, redis.call("PTTL", KEYS[1])}
+    """
+)
+
+RETURN_TOKENS = LuaScript(
+    """
+    if redis.call("EXISTS", KEYS[1]) == 1 then
+        return redis.call("DECRBY", KEYS[1], ARGV[1])
+    end
+    return 0
+    """
+)
+
+# GCRA over the shared per identifier byte budget, returns the milliseconds to wait before the bytes conform.
+SHAPE_BANDWIDTH = LuaScript(
+    """
+    local time = redis.call("TIME")
+    local now = time[1] * 1000 + time[2] / 1000
+    local rate = tonumber(ARGV[1]) / 1000
+    local tat = math.max(tonumber(redis.call("GET", KEYS[1]) or now), now) + tonumber(ARGV[3]) / rate
+    redis.call("SET", KEYS[1], string.format("%.3f", tat), "PX", math.ceil(tat - now) + 1000)
+    return math.ceil(math.max(0, tat - tonumber(ARGV[2]) / rate - now))
+    """
+)
+
+
+@dataclass
+class TokenLease:
+    tokens: int
+    expires_at: float
+
+    @property
+    def is_expired(self) -> bool:
+        return time.monotonic() >= self.expires_at
+
+
+class RateLimiter:
+    def __init__(self, key_prefix: str, limit: int, period: int):
+        self.key_prefix = key_prefix
+        self.limit = limit
+        self.period = period
+
+    def get_key(self, identifier: str) -> str:
+        return f"{self.key_prefix}{identifier}"
+
+    async def allow(self, identifier: str) -> bool:
+        """Count a message against the identifier's window, shared by every worker through Redis."""
+        count = await INCREMENT_WINDOW([self.get_key(identifier)], [self.period])
+        return count <= self.limit
+
+    async def release(self, identifier: str):
+        pass
+
+
+class LeasedRateLimiter(RateLimiter):
+    """Rate limiter spending tokens leased in batches from the shared window locally.
+
+    Redis is only hit once a lease runs out or its window expires, which divides Redis round trips by `lease_size`.
+    Tokens leased by a connection can't be spent by others, so the global limit is enforced approximately but never
+    exceeded.
+    """
+
+    def __init__(self, key_prefix: str, limit: int, period: int, lease_size: int):
+        super().__init__(key_prefix, limit, period)
+        self.lease_size = lease_size
+        self.leases: dict[str, TokenLease] = {}
+
+    async def allow(self, identifier: str) -> bool:
+        lease = self.leases.get(identifier)
+        if lease is None or lease.tokens <= 0 or lease.is_expired:
+            lease = self.leases[identifier] = await self._lease(identifier)
+        if lease.tokens <= 0:
+            return False
+        lease.tokens -= 1
+        return True
+
+    async def release(self, identifier: str):
+        """Give unspent tokens back to the window so a closing connection doesn't waste them."""
+        lease = self.leases.pop(identifier, None)
+        if lease is not None and lease.tokens > 0 and not lease.is_expired:
+            await RETURN_TOKENS([self.get_key(identifier)], [lease.tokens])
+
+    async def _lease(self, identifier: str) -> TokenLease:
+        granted, ttl = await LEASE_TOKENS([self.get_key(identifier)], [self.lease_size, self.limit, self.period])
+        return TokenLease(tokens=granted, expires_at=time.monotonic() + max(ttl, 0) / 1000)
+
+
+class TokenBucket:
+    """Local GCRA bucket allowing `burst` bytes at once and `rate` bytes per second sustained."""
+
+    def __init__(self, rate: int, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.theoretical_arrival = 0.0
+
+    def consume(self, size: int) -> float:
+        """Account `size` bytes and return the seconds to wait before they conform to the rate."""
+        now = time.monotonic()
+        self.theoretical_arrival = max(self.theoretical_arrival, now) + size / self.rate
+        return max(0.0, self.theoretical_arrival - self.burst / self.rate - now)
+
+
+class BandwidthShaper:
+    """Computes how long to hold a connection back so it stays within its own and its IP's byte rates.
+
+    Rather than rejecting, callers delay processing and acknowledging, applying backpressure to the client.
+    A rate of 0 disables the corresponding limit.
+    """
+
+    def __init__(self, key_prefix: str, ip_rate: int, ip_burst: int, connection_rate: int, connection_burst: int):
+        self.key_prefix = key_prefix
+        self.ip_rate = ip_rate
+        self.ip_burst = ip_burst
+        self.connection_bucket = TokenBucket(connection_rate, connection_burst) if connection_rate else None
+
+    def get_key(self, identifier: str) -> str:
+        return f"{self.key_prefix}{identifier}"
+
+    async def throttle(self, identifier: str, size: int) -> float:
+        delay = self.connection_bucket.consume(size) if self.connection_bucket else 0.0
+        if self.ip_rate:
+            ip_delay = await SHAPE_BANDWIDTH([self.get_key(identifier)], [self.ip_rate, self.ip_burst, size])
+            delay = max(delay, ip_delay / 1000)
+        return delay
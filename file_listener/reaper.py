@@ -0,0 +1,68 @@
+import logging
+import os
+import re
+import time
+
+from django.core.cache import cache
+
+from file_listener.executors import run_io
+from file_listener.handlers import get_upload_progress_key
+
+logger = logging.getLogger("django")
+
+SPOOL_NAME_PATTERN = re.compile(r"\.([0-9a-f]{32})\.part")
+
+
+class SpoolReaper:
+    """Removes the spool files of uploads abandoned for good, the ones that can't be resumed anymore.
+
+    An upload can be resumed as long as its progress is kept in Redis, its spool is removed once the progress expired
+    and the spool wasn't written for `max_age` seconds either. Every other trace of an abandoned upload, its progress,
+    lock and admission reservation, expires from Redis by itself. The spool directory is swept at most once every
+    `interval` seconds per server process.
+    """
+
+    sweep_at = 0.0
+
+    def __init__(self, directory: str, max_age: int, interval: int):
+        self.directory = directory
+        self.max_age = max_age
+        self.interval = interval
+
+    async def sweep(self) -> int:
+        """Remove the abandoned spool files, returning how many were removed."""
+        if time.monotonic() < SpoolReaper.sweep_at:
+            return 0
+        SpoolReaper.sweep_at = time.monotonic() + self.interval
+        removed = 0
+        for upload_id in await run_io(self._find_stale_spools):
+            if await cache.aget(get_upload_progress_key(upload_id)) is not None:
+                continue
+            if await run_io(self._remove_spool, upload_id):
+                logger.info(f"Removed the spool of abandoned upload {upload_id}")
+                removed += 1
+        return removed
+
+    def _find_stale_spools(self) -> list[str]:
+        if not os.path.isdir(self.directory):
+            return []
+        stale_at = time.time() - self.max_age
+        upload_ids = []
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if not (match := SPOOL_NAME_PATTERN.fullmatch(entry.name)):
+                    continue
+                try:
+                    if entry.stat().st_mtime < stale_at:
+                        upload_ids.append(match.group(1))
+                except FileNotFoundError:
+                    continue
+        return upload_ids
+
+    def _remove_spool(self, upload_id: str) -> bool:
+        # Every worker of the node sweeps the same directory, another one may have removed it already.
+        try:
+            os.remove(os.path.join(self.directory, f".{upload_id}.part"))
+        except FileNotFoundError:
+            return False
+        return True
@@ -0,0 +1,58 @@
+from file_listener.errors import TransferRejectedError
+
+# Magic bytes at the start of the formats we know, keyed by the detected type reported to clients.
+SIGNATURES = {
+    "pdf": (b"%PDF-",),
+    "png": (b"\x89PNG\r\n\x1a\n",),
+    "jpeg": (b"\xff\xd8\xff",),
+    "gif": (b"GIF87a", b"GIF89a"),
+}
+TEXT_BOMS = (b"\xef\xbb\xbf", b"\xff\xfe", b"\xfe\xff")
+KNOWN_TYPES = {*SIGNATURES, "txt"}
+EXTENSION_TYPES = {"jpg": "jpeg"}
+SNIFF_SIZE = 512
+
+
+def detect_type(head: bytes) -> str | None:
+    for detected_type, signatures in SIGNATURES.items():
+        if head.startswith(signatures):
+            return detected_type
+    # Text has no signature, it is recognized by the absence of NUL bytes unless it starts with a UTF-16 BOM.
+    if head.startswith(TEXT_BOMS) or b"\x00" not in head:
+        return "txt"
+    return None
+
+
+class ContentSniffer:
+    """Detects the type of a file from its first bytes as its chunks stream through.
+
+    Only the first `SNIFF_SIZE` bytes are buffered, the type is verified against the file extension as soon as they
+    arrived so mislabeled uploads are rejected before the rest of the file is transferred.
+    """
+
+    def __init__(self, extension: str):
+        self.expected_type = EXTENSION_TYPES.get(extension, extension)
+        self.head = bytearray()
+        self.detected_type: str | None = None
+
+    @property
+    def is_done(self) -> bool:
+        return len(self.head) >= SNIFF_SIZE
+
+    def feed(self, data: bytes | memoryview):
+        if self.is_done:
+            return
+        self.head += data[: SNIFF_SIZE - len(self.head)]
+        if self.is_done:
+            self.verify()
+
+    def verify(self):
+        """Check the bytes buffered so far, called once the head is full or the file ended before filling it."""
+        self.detected_type = detect_type(bytes(self.head))
+        # Extensions without a known signature can't be verified, they are accepted as long as the content isn't one
+        # of the formats we do recognize.
+        verifiable = self.expected_type in KNOWN_TYPES or self.detected_type in SIGNATURES
+        if verifiable and self.detected_type != self.expected_type:
+            raise TransferRejectedError(
+                f"File content ({self.detected_type or 'unknown'}) does not match its extension."
+            )
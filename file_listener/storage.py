@@ -0,0 +1,270 @@
+import asyncio
+import errno
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+from file_listener.executors import run_in, run_io
+
+try:
+    import boto3
+except ImportError:
+    boto3 = None
+
+
+def get_storage() -> "Storage":
+    return import_string(settings.FILE_STORAGE_BACKEND)()
+
+
+def move_file(source: str, destination: str):
+    """Rename `source` to `destination`, copying it over when FILE_SPOOL_DIRECTORY is on another file system."""
+    try:
+        os.replace(source, destination)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.move(source, destination)
+
+
+class ContentAddressedStore:
+    """Stores every distinct content once, as a blob named after its SHA-256 digest.
+
+    Saved files are hard links to their blob, so uploading the same content again costs no extra disk space and
+    files sharing a name never overwrite each other's content.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.blob_directory = os.path.join(directory, ".blobs")
+
+    def get_blob_path(self, digest: str) -> str:
+        return os.path.join(self.blob_directory, digest[:2], digest)
+
+    def has_blob(self, digest: str, size: int) -> bool:
+        try:
+            return os.path.getsize(self.get_blob_path(digest)) == size
+        except FileNotFoundError:
+            return False
+
+    def read_blob_head(self, digest: str, size: int) -> bytes:
+        with open(self.get_blob_path(digest), "rb") as f:
+            return f.read(size)
+
+    def store(self, path: str, digest: str, file_name: str) -> str:
+        """Move the file at `path` into the store and link it as `file_name`, returning the name it was saved as."""
+        blob_path = self.get_blob_path(digest)
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        if os.path.exists(blob_path):
+            os.remove(path)
+        else:
+            move_file(path, blob_path)
+        return self.link(digest, file_name)
+
+    def link(self, digest: str, file_name: str) -> str:
+        """Link an existing blob as `file_name`, suffixing the name when it is taken by different content."""
+        blob_path = self.get_blob_path(digest)
+        name, extension = os.path.splitext(file_name)
+        candidate, counter = file_name, 0
+        while True:
+            file_path = os.path.join(self.directory, candidate)
+            try:
+                os.link(blob_path, file_path)
+                return candidate
+            except FileExistsError:
+                if os.path.samefile(file_path, blob_path):
+                    return candidate
+            counter += 1
+            candidate = f"{name}-{counter}{extension}"
+
+
+class StorageWriter:
+    """Receives the chunks of one upload as they arrive, then saves or drops the upload."""
+
+    # Writers reading the upload back from the spool need every chunk flushed to it before `write` is called.
+    reads_spool = False
+
+    async def write(self, data: bytes | memoryview):
+        pass
+
+    async def commit(self, spool_path: str, digest: str, file_name: str) -> str:
+        """Save the complete upload, whose content is also in the closed spool file, returning its saved name."""
+        raise NotImplementedError
+
+    async def abort(self):
+        pass
+
+
+class Storage:
+    """Destination of uploads, selected with the FILE_STORAGE_BACKEND setting."""
+
+    def open_writer(self, upload_id: str, file_name: str, spool_path: str) -> StorageWriter:
+        """Start saving an upload, whose chunks are written to `spool_path` before the writer receives them."""
+        raise NotImplementedError
+
+    async def has_content(self, digest: str, size: int) -> bool:
+        return False
+
+    async def read_head(self, digest: str, size: int) -> bytes:
+        raise NotImplementedError
+
+    async def link(self, digest: str, file_name: str) -> str:
+        """Save already stored content under another name, returning the name it was saved as."""
+        raise NotImplementedError
+
+    def get_path(self, file_name: str) -> str | None:
+        """Local path of a saved file, None when the backend doesn't keep a local copy."""
+        return None
+
+
+class LocalStorageWriter(StorageWriter):
+    def __init__(self, storage: "LocalStorage"):
+        self.storage = storage
+
+    async def commit(self, spool_path: str, digest: str, file_name: str) -> str:
+        # The spool already is the local copy of the upload, it only has to be moved into place.
+        if self.storage.store is not None:
+            return await run_io(self.storage.store.store, spool_path, digest, file_name)
+        await run_io(move_file, spool_path, os.path.join(self.storage.directory, file_name))
+        return file_name
+
+
+class LocalStorage(Storage):
+    def __init__(self):
+        self.directory = settings.FILE_SAVE_DIRECTORY
+        self.store = ContentAddressedStore(self.directory) if settings.FILE_DEDUPLICATE else None
+
+    def open_writer(self, upload_id: str, file_name: str, spool_path: str) -> StorageWriter:
+        return LocalStorageWriter(self)
+
+    async def has_content(self, digest: str, size: int) -> bool:
+        return self.store is not None and await run_io(self.store.has_blob, digest, size)
+
+    async def read_head(self, digest: str, size: int) -> bytes:
+        return await run_io(self.store.read_blob_head, digest, size)
+
+    async def link(self, digest: str, file_name: str) -> str:
+        return await run_io(self.store.link, digest, file_name)
+
+    def get_path(self, file_name: str) -> str | None:
+        return os.path.join(self.directory, file_name)
+
+
+class S3StorageWriter(StorageWriter):
+    """Streams an upload to a multipart upload, pushing parts concurrently while the next ones are received.
+
+    Every byte is in the spool already, parts are tracked as spool offsets and only read back while they are uploaded.
+    At most `max_concurrency` parts are in flight at once, bounding the memory used by an upload.
+    """
+
+    reads_spool = True
+
+    def __init__(self, storage: "S3Storage", key: str, spool_path: str):
+        self.storage = storage
+        self.key = key
+        self.spool_path = spool_path
+        self.multipart_id: str | None = None
+        self.size = 0
+        self.part_offset = 0
+        self.part_tasks: list[asyncio.Task] = []
+        self.semaphore = asyncio.Semaphore(storage.max_concurrency)
+
+    async def write(self, data: bytes | memoryview):
+        self.size += len(data)
+        if self.size - self.part_offset >= self.storage.part_size:
+            await self._push_part()
+
+    async def commit(self, spool_path: str, digest: str, file_name: str) -> str:
+        if self.size > self.part_offset or not self.part_tasks:
+            await self._push_part()
+        parts = await asyncio.gather(*self.part_tasks)
+        await self.storage.run(
+            self.storage.client.complete_multipart_upload,
+            Bucket=self.storage.bucket,
+            Key=self.key,
+            UploadId=self.multipart_id,
+            MultipartUpload={"Parts": parts},
+        )
+        await run_io(os.remove, spool_path)
+        return file_name
+
+    async def abort(self):
+        await asyncio.gather(*self.part_tasks, return_exceptions=True)
+        if self.multipart_id is not None:
+            await self.storage.run(
+                self.storage.client.abort_multipart_upload,
+                Bucket=self.storage.bucket,
+                Key=self.key,
+                UploadId=self.multipart_id,
+            )
+            self.multipart_id = None
+
+    async def _push_part(self):
+        if self.multipart_id is None:
+            response = await self.storage.run(
+                self.storage.client.create_multipart_upload, Bucket=self.storage.bucket, Key=self.key
+            )
+            self.multipart_id = response["UploadId"]
+        offset, self.part_offset = self.part_offset, self.size
+        await self.semaphore.acquire()
+        self.part_tasks.append(
+            asyncio.create_task(self._upload_part(len(self.part_tasks) + 1, offset, self.size - offset))
+        )
+
+    async def _upload_part(self, part_number: int, offset: int, size: int) -> dict:
+        try:
+            body = await run_io(self._read_part, offset, size)
+            response = await self.storage.run(
+                self.storage.client.upload_part,
+                Bucket=self.storage.bucket,
+                Key=self.key,
+                UploadId=self.multipart_id,
+                PartNumber=part_number,
+                Body=body,
+            )
+            return {"PartNumber": part_number, "ETag": response["ETag"]}
+        finally:
+            self.semaphore.release()
+
+    def _read_part(self, offset: int, size: int) -> bytes:
+        with open(self.spool_path, "rb") as f:
+            f.seek(offset)
+            return f.read(size)
+
+
+class S3Storage(Storage):
+    """Stores uploads in an S3 compatible bucket under `<prefix><upload id>/<file name>`, requires boto3."""
+
+    _clients: dict = {}
+    _executors: dict = {}
+
+    def __init__(self):
+        if not settings.FILE_STORAGE_S3_BUCKET:
+            raise ImproperlyConfigured("FILE_STORAGE_S3_BUCKET must be set to use the S3 storage backend.")
+        if boto3 is None:
+            raise ImproperlyConfigured("The S3 storage backend requires boto3 to be installed.")
+        self.bucket = settings.FILE_STORAGE_S3_BUCKET
+        self.prefix = settings.FILE_STORAGE_S3_PREFIX
+        self.endpoint_url = settings.FILE_STORAGE_S3_ENDPOINT_URL or None
+        # S3 rejects parts smaller than 5MB, except for the last one.
+        self.part_size = max(settings.FILE_STORAGE_S3_PART_SIZE, 5 * 1024 * 1024)
+        self.max_concurrency = settings.FILE_STORAGE_S3_MAX_CONCURRENCY
+
+    @property
+    def client(self):
+        # boto3 clients are thread safe and costly to create, they are shared by every upload.
+        if (client := self._clients.get(self.endpoint_url)) is None:
+            client = self._clients[self.endpoint_url] = boto3.client("s3", endpoint_url=self.endpoint_url)
+        return client
+
+    async def run(self, func, **kwargs):
+        # Network calls get their own pool, a slow bucket must not hold back the disk writes of other uploads.
+        if (executor := self._executors.get(self.endpoint_url)) is None:
+            executor = self._executors[self.endpoint_url] = ThreadPoolExecutor(thread_name_prefix="s3-upload")
+        return await run_in(executor, func, **kwargs)
+
+    def open_writer(self, upload_id: str, file_name: str, spool_path: str) -> StorageWriter:
+        return S3StorageWriter(self, f"{self.prefix}{upload_id}/{file_name}", spool_path)
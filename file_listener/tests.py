@@ -1,25 +1,66 @@
+import asyncio
 import base64
-from datetime import timedelta
+import gzip
+import hashlib
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+import zlib
 from unittest.mock import patch
 
 import pytest
+from channels.auth import AuthMiddlewareStack
+from channels.generic.websocket import AsyncWebsocketConsumer
+from channels.layers import get_channel_layer
 from channels.routing import URLRouter
 from channels.testing import WebsocketCommunicator
 from django.conf import settings
 from django.core.cache import cache
-from django.urls import re_path
-from django.utils import timezone
+from django.core.exceptions import ImproperlyConfigured
+from django.urls import re_path, resolve
+from prometheus_client import REGISTRY
 
+from file_listener.acks import AckWindow
+from file_listener.admission import AdmissionController
+from file_listener.auth import TokenAuthMiddleware, get_auth_middleware
+from file_listener.chunking import ChunkSizer
+from file_listener.clients import get_redis
 from file_listener.consumers import FileTransferConsumer
 from file_listener.enums import MessageType
-from file_listener.errors import InvalidMessageTypeError, RateLimitExceededError
+from file_listener.errors import (
+    AdmissionDeferredError,
+    InvalidMessageTypeError,
+    RateLimitExceededError,
+    TransferRejectedError,
+)
+from file_listener.executors import run_io
+from file_listener.encoding import decode_message, encode_chunk_received, encode_window_ack
+from file_listener.frames import build_ack, build_binary_chunk, parse_ack, parse_binary_chunk
 from file_listener.handlers import FileTransferHandler
+from file_listener.locks import UploadLock
+from file_listener.logs import JsonFormatter
+from file_listener.processing import CLAIM_JOBS, Job, PostProcessingQueue
+from file_listener.processors import get_image_size, pdf_info, text_info
+from file_listener.metrics import ACTIVE_TRANSFERS, UPLOADS
+from file_listener.rate_limit import LEASE_TOKENS, BandwidthShaper, LeasedRateLimiter, RateLimiter, TokenBucket
+from file_listener.reaper import SpoolReaper
+from file_listener.sniffing import SNIFF_SIZE, ContentSniffer
+from file_listener.storage import ContentAddressedStore, S3Storage, get_storage
+
+
+def get_sample(name: str, **labels) -> float:
+    return REGISTRY.get_sample_value(name, labels) or 0
 
 
 @pytest.mark.asyncio
 class TestTransferHandlerTestSuite:
     @pytest.fixture(autouse=True)
-    async def setup(self):
+    async def setup(self, settings, tmp_path):
+        settings.FILE_SAVE_DIRECTORY = str(tmp_path)
+        self.save_directory = tmp_path
         self.handler = FileTransferHandler("test.txt", 100)
         yield
         cache.clear()
@@ -28,6 +69,11 @@ class TestTransferHandlerTestSuite:
         with pytest.raises(ValueError):
             FileTransferHandler("test.txt", settings.FILE_MAX_SIZE + 1)
 
+    async def test_initialize_with_invalid_file_size(self):
+        for file_size in [-1, 10.5, "10", True, None]:
+            with pytest.raises(ValueError, match="Invalid file size"):
+                FileTransferHandler("test.txt", file_size)
+
     async def test_initialize_with_invalid_extension(self):
         with pytest.raises(ValueError):
             FileTransferHandler("test.doc", 100)
@@ -46,6 +92,15 @@ class TestTransferHandlerTestSuite:
 
         assert self.handler.received_size == 9
 
+    async def test_append_chunk_streams_to_spool_file(self):
+        await self.handler.append_chunk(base64.b64encode(b"test ").decode("utf-8"))
+        await self.handler.append_chunk(base64.b64encode(b"data").decode("utf-8"))
+        self.handler.spool.flush()
+
+        with open(self.handler.spool_path, "rb") as f:
+            assert f.read(self.handler.received_size) == b"test data"
+        assert os.path.dirname(self.handler.spool_path) == str(self.save_directory)
+
     async def test_decode_chunk(self):
         chunk = base64.b64encode(b"test data").decode("utf-8")
         decoded_chunk = await self.handler._decode_b64_chunk(chunk)
@@ -59,18 +114,668 @@ class TestTransferHandlerTestSuite:
         self.handler.received_size = 100
         assert self.handler.is_file_complete()
 
-    @patch("file_listener.handlers.open")
-    @patch("file_listener.handlers.os.makedirs")
-    async def test_save_file(self, mock_makedirs, mock_open):
-        self.handler.content = b"test content"
+    async def test_append_bytes_with_unexpected_offset(self):
+        with pytest.raises(ValueError):
+            await self.handler.append_bytes(b"test data", offset=5)
+
+    async def test_append_bytes_exceeding_file_size(self):
+        with pytest.raises(ValueError):
+            await self.handler.append_bytes(b"0" * 101)
+
+    async def test_append_compressed_chunks(self):
+        handler = FileTransferHandler("test.txt", 18, compression="deflate")
+        await handler.append_bytes(zlib.compress(b"test data "), crc32=zlib.crc32(b"test data "))
+        await handler.append_chunk(base64.b64encode(zlib.compress(b"test dat")).decode("utf-8"), offset=10)
+        handler.spool.flush()
+
+        with open(handler.spool_path, "rb") as f:
+            assert f.read() == b"test data test dat"
+
+    async def test_append_gzip_chunk(self):
+        handler = FileTransferHandler("test.txt", 9, compression="gzip")
+        await handler.append_bytes(gzip.compress(b"test data"))
+
+        assert handler.is_file_complete()
+
+    async def test_compressed_chunk_expanding_past_file_size(self):
+        handler = FileTransferHandler("test.txt", 100, compression="deflate")
+        with pytest.raises(ValueError, match="exceeds 100 bytes"):
+            await handler.append_bytes(zlib.compress(b"0" * 1024 * 1024))
+        assert handler.received_size == 0
+
+    async def test_compressed_chunk_expanding_past_max_chunk_size(self):
+        handler = FileTransferHandler("test.txt", 100, compression="deflate")
+        handler.max_chunk_size = 10
+        with pytest.raises(ValueError, match="exceeds 10 bytes"):
+            await handler.append_bytes(zlib.compress(b"0" * 50))
+
+    async def test_truncated_compressed_chunk(self):
+        handler = FileTransferHandler("test.txt", 100, compression="deflate")
+        with pytest.raises(ValueError, match="complete deflate stream"):
+            await handler.append_bytes(zlib.compress(b"test data")[:-4])
+        with pytest.raises(ValueError, match="Invalid deflate chunk"):
+            await handler.append_bytes(b"test data")
+
+    async def test_append_zstd_chunks(self):
+        zstandard = pytest.importorskip("zstandard")
+        handler = FileTransferHandler("test.txt", 18, compression="zstd")
+        await handler.append_bytes(zstandard.ZstdCompressor().compress(b"test data "))
+        await handler.append_bytes(zstandard.ZstdCompressor(write_content_size=False).compress(b"test dat"))
+        handler.spool.flush()
+
+        assert handler.is_file_complete()
+        with open(handler.spool_path, "rb") as f:
+            assert f.read() == b"test data test dat"
+
+    async def test_zstd_chunk_expanding_past_file_size(self):
+        zstandard = pytest.importorskip("zstandard")
+        handler = FileTransferHandler("test.txt", 100, compression="zstd")
+        with pytest.raises(ValueError, match="exceeds 100 bytes"):
+            await handler.append_bytes(zstandard.ZstdCompressor().compress(b"0" * 1024 * 1024))
+        with pytest.raises(ValueError, match="exceeds 100 bytes"):
+            await handler.append_bytes(zstandard.ZstdCompressor(write_content_size=False).compress(b"0" * 101))
+        assert handler.received_size == 0
+
+    async def test_initialize_with_unsupported_compression(self):
+        with pytest.raises(ValueError, match="Unsupported compression"):
+            FileTransferHandler("test.txt", 100, compression="brotli")
+
+    async def test_save_file(self):
+        await self.handler.append_chunk(base64.b64encode(b"test content").decode("utf-8"))
+        spool_path = self.handler.spool_path
+        await self.handler.save_file()
+
+        with open(self.save_directory / "test.txt", "rb") as f:
+            assert f.read() == b"test content"
+        assert not os.path.exists(spool_path)
+
+    async def test_save_file_logs_upload_summary(self, caplog):
+        handler = FileTransferHandler("test.txt", 12)
+        await handler.append_bytes(b"test ")
+        await handler.append_bytes(b"content")
+        with caplog.at_level(logging.INFO, logger="django"):
+            await handler.save_file()
+
+        [summary] = [record for record in caplog.records if getattr(record, "upload_id", None) == handler.upload_id]
+        assert summary.file_size == 12
+        assert summary.chunks == 2
+        assert summary.duration > 0
+
+    async def test_chunk_debug_logs_are_sampled(self, settings, caplog):
+        settings.LOG_CHUNK_SAMPLE_RATE = 2
+        with caplog.at_level(logging.DEBUG, logger="django"):
+            for _ in range(3):
+                await self.handler.append_bytes(b"test")
+
+        assert len([record for record in caplog.records if "received chunk" in record.getMessage()]) == 2
+
+    async def test_save_duplicate_content_once(self):
+        for file_name in ["first.txt", "second.txt"]:
+            handler = FileTransferHandler(file_name, 12)
+            await handler.append_bytes(b"test content")
+            await handler.save_file()
+
+        first, second = self.save_directory / "first.txt", self.save_directory / "second.txt"
+        assert os.path.samefile(first, second)
+        assert os.path.samefile(first, handler.storage.store.get_blob_path(hashlib.sha256(b"test content").hexdigest()))
+
+    async def test_save_file_with_taken_name(self):
+        for content in [b"first", b"other"]:
+            handler = FileTransferHandler("test.txt", 5)
+            await handler.append_bytes(content)
+            await handler.save_file()
+
+        assert handler.file_name == "test-1.txt"
+        assert (self.save_directory / "test.txt").read_bytes() == b"first"
+        assert (self.save_directory / "test-1.txt").read_bytes() == b"other"
+
+    async def test_save_existing_content(self):
+        await self.handler.append_bytes(b"test content")
         await self.handler.save_file()
-        mock_makedirs.assert_called_once()
-        mock_open.assert_called_once()
+
+        handler = FileTransferHandler("copy.txt", 12, sha256=hashlib.sha256(b"test content").hexdigest())
+        assert await handler.save_existing_content()
+        assert handler.deduplicated
+        assert (self.save_directory / "copy.txt").read_bytes() == b"test content"
+
+    async def test_save_existing_content_unknown_digest(self):
+        handler = FileTransferHandler("copy.txt", 12, sha256=hashlib.sha256(b"test content").hexdigest())
+        assert not await handler.save_existing_content()
+
+    async def test_save_file_without_deduplication(self, settings):
+        settings.FILE_DEDUPLICATE = False
+        for content in [b"first", b"other"]:
+            handler = FileTransferHandler("test.txt", 5)
+            await handler.append_bytes(content)
+            await handler.save_file()
+
+        assert handler.file_name == "test.txt"
+        assert os.listdir(self.save_directory) == ["test.txt"]
+        assert (self.save_directory / "test.txt").read_bytes() == b"other"
+
+    async def test_discard(self):
+        await self.handler.append_chunk(base64.b64encode(b"test content").decode("utf-8"))
+        spool_path = self.handler.spool_path
+        await self.handler.discard()
+
+        assert not os.path.exists(spool_path)
+        assert os.listdir(self.save_directory) == []
+
+    async def test_suspend_and_resume(self):
+        await self.handler.append_chunk(base64.b64encode(b"test ").decode("utf-8"))
+        await self.handler.suspend()
+
+        handler = await FileTransferHandler.resume(self.handler.upload_id, "test.txt", 100)
+        assert handler.received_size == 5
+
+        await handler.append_bytes(b"data", offset=5)
+        handler.spool.flush()
+        with open(handler.spool_path, "rb") as f:
+            assert f.read(handler.received_size) == b"test data"
+
+    async def test_resume_truncates_unpersisted_data(self, settings):
+        settings.UPLOAD_PROGRESS_SAVE_INTERVAL = 5
+        await self.handler.save_progress()
+        await self.handler.append_bytes(b"01234")
+        await self.handler.append_bytes(b"567")
+        self.handler.spool.close()
+
+        handler = await FileTransferHandler.resume(self.handler.upload_id, "test.txt", 100)
+        assert handler.received_size == 5
+
+    async def test_spool_in_shared_directory(self, settings, tmp_path_factory):
+        settings.FILE_SPOOL_DIRECTORY = str(tmp_path_factory.mktemp("spool"))
+        handler = FileTransferHandler("test.txt", 4)
+        await handler.append_bytes(b"data")
+
+        assert os.path.dirname(handler.spool_path) == settings.FILE_SPOOL_DIRECTORY
+        await handler.save_file()
+        assert os.listdir(settings.FILE_SPOOL_DIRECTORY) == []
+        with open(self.save_directory / "test.txt", "rb") as f:
+            assert f.read() == b"data"
+
+    @pytest.mark.skipif(not hasattr(os, "posix_fallocate"), reason="posix_fallocate is not available")
+    async def test_spool_is_preallocated(self):
+        await self.handler.append_bytes(b"test ")
+        assert os.fstat(self.handler.spool.fileno()).st_size == 100
+
+        await self.handler.suspend()
+        assert os.path.getsize(self.handler.spool_path) == 5
+        handler = await FileTransferHandler.resume(self.handler.upload_id, "test.txt", 100)
+        assert os.fstat(handler.spool.fileno()).st_size == 100
+
+    async def test_spool_without_preallocation(self, settings):
+        settings.FILE_SPOOL_PREALLOCATE = False
+        await self.handler.append_bytes(b"test ")
+        self.handler.spool.flush()
+
+        assert os.fstat(self.handler.spool.fileno()).st_size == 5
+
+    async def test_check_stalled_without_chunks(self):
+        assert self.handler.check_stalled(60, 0, 10) is None
+
+        self.handler.last_chunk_at -= 60
+        assert "no chunk received" in self.handler.check_stalled(60, 0, 10)
+
+    async def test_check_stalled_below_throughput_floor(self):
+        self.handler.checkpoint_at -= 10
+        await self.handler.append_bytes(b"test data")
+        assert "below 1024" in self.handler.check_stalled(60, 1024, 10)
+
+        self.handler.checkpoint_at -= 10
+        await self.handler.append_bytes(b"0" * 91)
+        assert self.handler.check_stalled(60, 9, 10) is None
+
+    async def test_resume_unknown_upload_id(self):
+        with pytest.raises(ValueError):
+            await FileTransferHandler.resume("0" * 32, "test.txt", 100)
+
+    async def test_resume_with_mismatched_metadata(self):
+        await self.handler.save_progress()
+        with pytest.raises(ValueError):
+            await FileTransferHandler.resume(self.handler.upload_id, "other.txt", 100)
+
+    async def test_initialize_with_invalid_upload_id(self):
+        with pytest.raises(ValueError):
+            FileTransferHandler("test.txt", 100, upload_id="../../etc/passwd")
+
+    async def test_append_bytes_rejects_mismatched_content_before_writing(self):
+        handler = FileTransferHandler("test.txt", 1024)
+        with pytest.raises(TransferRejectedError):
+            await handler.append_bytes(b"\x89PNG\r\n\x1a\n" + b"\x00" * SNIFF_SIZE)
+
+        assert handler.received_size == 0
+        assert not os.path.exists(handler.spool_path)
+
+    async def test_resume_sniffs_received_head(self):
+        await self.handler.append_bytes(b"test data")
+        await self.handler.suspend()
+
+        handler = await FileTransferHandler.resume(self.handler.upload_id, "test.txt", 100)
+        assert handler.sniffer.head == b"test data"
+
+    async def test_append_bytes_with_mismatched_crc32(self):
+        with pytest.raises(ValueError):
+            await self.handler.append_bytes(b"test data", crc32=zlib.crc32(b"test date"))
+        assert self.handler.received_size == 0
+
+        await self.handler.append_bytes(b"test data", crc32=zlib.crc32(b"test data"))
+        assert self.handler.received_size == 9
+
+    async def test_matching_sha256(self):
+        handler = FileTransferHandler("test.txt", 9, sha256=hashlib.sha256(b"test data").hexdigest())
+        await handler.append_bytes(b"test data")
+
+        assert handler.sha256 == hashlib.sha256(b"test data").hexdigest()
+
+    async def test_mismatched_sha256_is_rejected(self):
+        handler = FileTransferHandler("test.txt", 9, sha256=hashlib.sha256(b"test date").hexdigest())
+        with pytest.raises(TransferRejectedError):
+            await handler.append_bytes(b"test data")
+
+    async def test_resume_restores_hash_state(self):
+        handler = FileTransferHandler("test.txt", 9, sha256=hashlib.sha256(b"test data").hexdigest())
+        await handler.append_bytes(b"test ")
+        await handler.suspend()
+
+        handler = await FileTransferHandler.resume(handler.upload_id, "test.txt", 9)
+        await handler.append_bytes(b"data")
+        assert handler.sha256 == handler.expected_sha256
+
+    async def test_initialize_with_invalid_sha256(self):
+        with pytest.raises(ValueError):
+            FileTransferHandler("test.txt", 100, sha256="not-a-digest")
+
+    async def test_disk_writes_run_on_io_executor(self):
+        with patch("file_listener.handlers.run_io", wraps=run_io) as mock_run_io:
+            await self.handler.append_chunk(base64.b64encode(b"test content").decode("utf-8"))
+            await self.handler.save_file()
+
+        called_functions = [call.args[0] for call in mock_run_io.call_args_list]
+        assert called_functions == [self.handler._write_to_spool, self.handler._commit_spool]
 
     async def test_get_file_extension(self):
         assert self.handler.get_file_extension() == "txt"
 
 
+class TestContentSniffer:
+    def test_detects_type_once_head_is_complete(self):
+        sniffer = ContentSniffer("pdf")
+        sniffer.feed(b"%PDF-1.7\n")
+        assert sniffer.detected_type is None
+
+        sniffer.feed(b"0" * SNIFF_SIZE)
+        assert sniffer.detected_type == "pdf"
+
+    def test_rejects_mismatched_content_early(self):
+        sniffer = ContentSniffer("txt")
+        with pytest.raises(TransferRejectedError):
+            sniffer.feed(b"GIF89a" + b"\x00" * SNIFF_SIZE)
+
+    def test_verify_short_file(self):
+        sniffer = ContentSniffer("txt")
+        sniffer.feed(b"short text")
+        sniffer.verify()
+        assert sniffer.detected_type == "txt"
+
+    def test_jpg_extension_matches_jpeg_content(self):
+        sniffer = ContentSniffer("jpg")
+        sniffer.feed(b"\xff\xd8\xff\xe0" + b"\x00" * SNIFF_SIZE)
+        assert sniffer.detected_type == "jpeg"
+
+    def test_unknown_extension_is_not_verified(self):
+        sniffer = ContentSniffer("csv")
+        sniffer.feed(b"\x00\x01" * SNIFF_SIZE)
+        assert sniffer.detected_type is None
+
+
+class TestProcessors:
+    def test_image_sizes(self):
+        png = b"\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR" + (640).to_bytes(4, "big") + (480).to_bytes(4, "big")
+        gif = b"GIF89a" + (32).to_bytes(2, "little") + (16).to_bytes(2, "little")
+        jpeg = b"\xff\xd8\xff\xe0\x00\x04\x00\x00\xff\xc0\x00\x11\x08" + (300).to_bytes(2, "big") + (200).to_bytes(2, "big")
+
+        assert get_image_size(png) == (640, 480)
+        assert get_image_size(gif) == (32, 16)
+        assert get_image_size(jpeg) == (200, 300)
+        assert get_image_size(b"not an image") is None
+
+    def test_pdf_page_count(self, tmp_path):
+        path = tmp_path / "test.pdf"
+        path.write_bytes(b"%PDF-1.4 1 0 obj << /Type /Pages /Kids [2 0 R 3 0 R] /Count 2 >> endobj")
+        assert pdf_info(str(path)) == {"pages": 2}
+
+        path.write_bytes(b"%PDF-1.4 << /Type /Page >> << /Type/Page /Parent 1 0 R >>")
+        assert pdf_info(str(path)) == {"pages": 2}
+
+    @pytest.mark.parametrize(
+        "content, encoding",
+        [
+            (b"plain\ntext\n", "ascii"),
+            ("caf\u00e9\n".encode("utf-8"), "utf-8"),
+            ("caf\u00e9 \u20ac\n".encode("cp1252"), "cp1252"),
+            ("caf\u00e9\n".encode("utf-16"), "utf-16"),
+        ],
+    )
+    def test_text_encoding(self, tmp_path, content, encoding):
+        path = tmp_path / "test.txt"
+        path.write_bytes(content)
+        assert text_info(str(path))["encoding"] == encoding
+
+
+@pytest.mark.asyncio
+class TestPostProcessingQueue:
+    @pytest.fixture(autouse=True)
+    async def setup(self, monkeypatch, tmp_path):
+        monkeypatch.setattr(PostProcessingQueue, "running", 0)
+        monkeypatch.setattr(PostProcessingQueue, "poller", None)
+        self.path = tmp_path / "test.txt"
+        self.path.write_bytes(b"text\n")
+        self.channel_layer = get_channel_layer()
+        self.reply_channel = await self.channel_layer.new_channel()
+        yield
+        if PostProcessingQueue.poller is not None:
+            PostProcessingQueue.poller.cancel()
+            await asyncio.gather(PostProcessingQueue.poller, return_exceptions=True)
+        await asyncio.gather(*PostProcessingQueue.tasks)
+        cache.clear()
+
+    def get_queue(
+        self, max_jobs: int = 1, max_attempts: int = 3, timeout: int = 30, node_id: str = "node-1"
+    ) -> PostProcessingQueue:
+        processors = {"txt": "file_listener.processors.text_info"}
+        return PostProcessingQueue(
+            "test_postprocess_", node_id, processors, max_jobs, timeout=timeout, max_attempts=max_attempts
+        )
+
+    async def receive(self) -> dict:
+        return await asyncio.wait_for(self.channel_layer.receive(self.reply_channel), 10)
+
+    async def test_runs_on_the_process_pool(self):
+        job = await self.get_queue().submit("a" * 32, "test.txt", str(self.path), self.reply_channel)
+
+        assert (await self.receive())["status"] == "started"
+        event = await self.receive()
+        assert (event["status"], event["upload_id"]) == ("done", job.upload_id)
+        assert event["result"] == {"encoding": "ascii", "lines": 1}
+
+    async def test_extensions_without_processor(self):
+        assert await self.get_queue().submit("a" * 32, "test.pdf", str(self.path), self.reply_channel) is None
+
+    async def test_failed_processing(self):
+        await self.get_queue().submit("a" * 32, "test.txt", str(self.path.with_name("missing.txt")), self.reply_channel)
+
+        assert (await self.receive())["status"] == "started"
+        event = await self.receive()
+        assert event["status"] == "failed"
+        assert "missing.txt" in event["error"]
+
+    async def test_queued_jobs_are_claimed_by_processes_with_room(self):
+        await self.get_queue(max_jobs=0).submit("a" * 32, "test.txt", str(self.path), self.reply_channel)
+        assert not PostProcessingQueue.tasks
+
+        queue = self.get_queue()
+        queue.start()
+        queue.start()
+        assert (await self.receive())["status"] == "started"
+        assert (await self.receive())["status"] == "done"
+        assert not PostProcessingQueue.poller.done()
+
+    async def test_jobs_are_only_claimed_on_their_node(self):
+        await self.get_queue(max_jobs=0).submit("a" * 32, "test.txt", str(self.path), self.reply_channel)
+
+        await self.get_queue(node_id="node-2").dispatch()
+        assert not PostProcessingQueue.tasks
+        await self.get_queue().dispatch()
+        assert (await self.receive())["status"] == "started"
+        assert (await self.receive())["status"] == "done"
+
+    async def test_running_jobs_keep_their_lease(self):
+        queue = self.get_queue(max_jobs=0, timeout=1)
+        await queue.submit("a" * 32, "test.txt", str(self.path), self.reply_channel)
+        job = Job(**json.loads((await CLAIM_JOBS(queue.keys, [1000, 1, 3]))[0]))
+
+        renewal = asyncio.create_task(queue.renew_lease(job))
+        await asyncio.sleep(1.5)
+        assert await CLAIM_JOBS(queue.keys, [1000, 1, 3]) == []
+        renewal.cancel()
+        await asyncio.sleep(1.1)
+        assert len(await CLAIM_JOBS(queue.keys, [1000, 1, 3])) == 1
+
+    async def test_jobs_crashing_too_often_are_dropped(self):
+        queue = self.get_queue(max_jobs=0, max_attempts=1)
+        await queue.submit("a" * 32, "test.txt", str(self.path), self.reply_channel)
+        # A worker that died right after claiming the job, with a lease that already expired.
+        assert len(await CLAIM_JOBS(queue.keys, [0, 1, 1])) == 1
+        await asyncio.sleep(0.01)
+
+        assert await CLAIM_JOBS(queue.keys, [0, 1, 1]) == []
+        assert await get_redis().hlen(queue.keys[1]) == 0
+
+
+class TestJsonFormatter:
+    def test_format_includes_extra_fields(self):
+        record = logging.LogRecord("django", logging.INFO, __file__, 1, "Upload %s saved", ("abc",), None)
+        record.upload_id = "abc"
+        record.duration = 1.5
+
+        data = json.loads(JsonFormatter().format(record))
+
+        assert data["message"] == "Upload abc saved"
+        assert data["level"] == "INFO"
+        assert (data["upload_id"], data["duration"]) == ("abc", 1.5)
+
+
+class TestBinaryFrames:
+    def test_parse_binary_chunk(self):
+        chunk = parse_binary_chunk(build_binary_chunk(3, 1024, b"test data"))
+
+        assert chunk.transfer_id == 3
+        assert chunk.offset == 1024
+        assert bytes(chunk.data) == b"test data"
+
+    def test_parse_binary_chunk_with_crc32(self):
+        chunk = parse_binary_chunk(build_binary_chunk(3, 0, b"test data", crc32=zlib.crc32(b"test data")))
+        assert chunk.crc32 == zlib.crc32(b"test data")
+
+        chunk = parse_binary_chunk(build_binary_chunk(3, 0, b"test data"))
+        assert chunk.crc32 is None
+
+    def test_parse_binary_chunk_shorter_than_header(self):
+        with pytest.raises(ValueError):
+            parse_binary_chunk(b"\x00\x01")
+
+    def test_parse_binary_chunk_with_mismatched_length(self):
+        with pytest.raises(ValueError):
+            parse_binary_chunk(build_binary_chunk(1, 0, b"test data")[:-1])
+
+    def test_parse_ack(self):
+        ack = parse_ack(build_ack(2, 7, 65536))
+        assert (ack.transfer_id, ack.seq, ack.offset) == (2, 7, 65536)
+
+    def test_parse_ack_with_wrong_size(self):
+        with pytest.raises(ValueError):
+            parse_ack(build_ack(2, 7, 65536) + b"\0")
+
+
+class TestEncoding:
+    def test_encode_chunk_received(self):
+        assert json.loads(encode_chunk_received(3)) == {
+            "type": MessageType.CHUNK_RECEIVED.value,
+            "message": "Ready for next chunk",
+            "transfer_id": 3,
+        }
+
+    def test_encode_window_ack(self):
+        assert json.loads(encode_window_ack(3, 5, 1024)) == {
+            "type": MessageType.CHUNK_RECEIVED.value,
+            "message": "Ready for next chunk",
+            "transfer_id": 3,
+            "seq": 5,
+            "offset": 1024,
+        }
+
+    def test_decode_message_slices_chunk_out(self):
+        chunk = base64.b64encode(os.urandom(1024)).decode("utf-8")
+        text = json.dumps({"type": MessageType.CHUNK.value, "chunk": chunk, "offset": 0})
+
+        with patch("file_listener.encoding.json.loads", wraps=json.loads) as loads_mock:
+            message = decode_message(text)
+        assert message == json.loads(text)
+        assert all(chunk not in call.args[0] for call in loads_mock.call_args_list)
+
+    def test_decode_message_with_whitespace_around_chunk(self):
+        text = f'{{"chunk" :\n "{base64.b64encode(b"test").decode("utf-8")}" , "type": "{MessageType.CHUNK.value}"}}'
+        assert decode_message(text) == json.loads(text)
+
+    def test_decode_message_with_escaped_chunk(self):
+        text = '{"type": "file_chunk", "chunk": "ab\\/cd"}'
+        assert decode_message(text)["chunk"] == "ab/cd"
+
+    def test_decode_message_without_chunk(self):
+        assert decode_message('{"type": "file_meta"}') == {"type": "file_meta"}
+
+    def test_decode_message_with_invalid_json(self):
+        with pytest.raises(json.JSONDecodeError):
+            decode_message('{"type": "file_chunk", "chunk": "dGVzdA=="')
+        with pytest.raises(json.JSONDecodeError):
+            decode_message('["chunk": "dGVzdA=="]')
+
+
+@pytest.mark.asyncio
+class TestAckWindow:
+    @pytest.fixture(autouse=True)
+    async def setup(self):
+        self.acks = []
+
+        async def send_ack(seq, offset):
+            self.acks.append((seq, offset))
+
+        self.window = AckWindow(send_ack, size=8, ack_every=2, ack_interval=0.01)
+
+    async def test_acknowledges_every_n_chunks(self):
+        await self.window.chunk_received(10)
+        assert self.acks == []
+
+        await self.window.chunk_received(20)
+        assert self.acks == [(1, 20)]
+
+    async def test_acknowledges_after_interval(self):
+        await self.window.chunk_received(10)
+        await asyncio.sleep(0.05)
+
+        assert self.acks == [(0, 10)]
+
+    async def test_check_seq_out_of_order(self):
+        self.window.check_seq(0)
+        with pytest.raises(ValueError):
+            self.window.check_seq(1)
+
+    async def test_ack_every_is_capped_by_window_size(self):
+        window = AckWindow(self.window.send_ack, size=2, ack_every=4, ack_interval=0.01)
+        assert window.ack_every == 2
+
+
+@pytest.mark.asyncio
+class TestS3Storage:
+    @pytest.fixture(autouse=True)
+    async def setup(self, settings, tmp_path, monkeypatch):
+        for variable in ["AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY", "AWS_SESSION_TOKEN"]:
+            monkeypatch.setenv(variable, "testing")
+        monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+        settings.FILE_SAVE_DIRECTORY = str(tmp_path)
+        settings.FILE_MAX_SIZE = 20 * 1024 * 1024
+        settings.FILE_STORAGE_BACKEND = "file_listener.storage.S3Storage"
+        settings.FILE_STORAGE_S3_BUCKET = "uploads"
+        settings.FILE_STORAGE_S3_PART_SIZE = 5 * 1024 * 1024
+        yield
+        S3Storage._clients.clear()
+        cache.clear()
+
+    @pytest.fixture
+    def s3(self):
+        boto3 = pytest.importorskip("boto3")
+        moto = pytest.importorskip("moto")
+        with moto.mock_aws():
+            S3Storage._clients.clear()
+            self.s3 = boto3.client("s3")
+            self.s3.create_bucket(Bucket="uploads")
+            yield self.s3
+
+    @pytest.mark.usefixtures("s3")
+    async def test_parts_are_uploaded_while_receiving(self):
+        content = os.urandom(12 * 1024 * 1024)
+        handler = FileTransferHandler("test.txt", len(content))
+        handler.sniffer = None
+        for offset in range(0, len(content), 1024 * 1024):
+            await handler.append_bytes(content[offset : offset + 1024 * 1024])
+        assert len(handler.writer.part_tasks) == 2
+
+        await handler.save_file()
+        stored = self.s3.get_object(Bucket="uploads", Key=f"{handler.upload_id}/test.txt")
+        assert stored["Body"].read() == content
+        assert not os.path.exists(handler.spool_path)
+
+    @pytest.mark.usefixtures("s3")
+    async def test_parts_are_read_back_from_the_spool(self, settings):
+        settings.FILE_VERIFY_CONTENT = False
+        content = os.urandom(11 * 1024 * 1024)
+        handler = FileTransferHandler("test.txt", len(content))
+        await handler.append_bytes(content[: 6 * 1024 * 1024])
+        await handler.suspend()
+
+        handler = await FileTransferHandler.resume(handler.upload_id, "test.txt", len(content))
+        assert (handler.writer.size, len(handler.writer.part_tasks)) == (6 * 1024 * 1024, 1)
+        await handler.append_bytes(content[6 * 1024 * 1024 :])
+        await handler.save_file()
+
+        stored = self.s3.get_object(Bucket="uploads", Key=f"{handler.upload_id}/test.txt")
+        assert stored["Body"].read() == content
+
+    @pytest.mark.usefixtures("s3")
+    async def test_discard_aborts_multipart_upload(self):
+        handler = FileTransferHandler("test.txt", 6 * 1024 * 1024)
+        await handler.append_bytes(b"0" * 6 * 1024 * 1024)
+        await handler.discard()
+
+        assert self.s3.list_multipart_uploads(Bucket="uploads").get("Uploads", []) == []
+
+    async def test_missing_bucket_setting(self, settings):
+        settings.FILE_STORAGE_S3_BUCKET = ""
+        with pytest.raises(ImproperlyConfigured, match="FILE_STORAGE_S3_BUCKET"):
+            get_storage()
+
+
+class TestMetrics:
+    def test_labelled_counter(self):
+        saved_uploads = get_sample("file_transfer_uploads_total", outcome="saved")
+        UPLOADS.labels(outcome="saved").inc(2)
+
+        assert get_sample("file_transfer_uploads_total", outcome="saved") == saved_uploads + 2
+
+    def test_metrics_endpoint(self, rf):
+        response = resolve("/metrics").func(rf.get("/metrics"))
+
+        assert response.status_code == 200
+        assert response["Content-Type"].startswith("text/plain; version=")
+        assert "# TYPE file_transfer_chunk_decode_seconds histogram" in response.content.decode()
+
+    def test_metrics_endpoint_aggregates_processes(self, rf, settings, tmp_path):
+        settings.PROMETHEUS_MULTIPROC_DIR = str(tmp_path)
+        script = (
+            "import django; django.setup(); from file_listener.metrics import ACTIVE_CONNECTIONS, UPLOADS;"
+            "ACTIVE_CONNECTIONS.inc(); UPLOADS.labels(outcome='saved').inc(2)"
+        )
+        environment = {**os.environ, "PROMETHEUS_MULTIPROC_DIR": str(tmp_path)}
+        for _ in range(2):
+            subprocess.run([sys.executable, "-c", script], env=environment, cwd=settings.BASE_DIR, check=True)
+
+        content = resolve("/metrics").func(rf.get("/metrics")).content.decode()
+        assert 'file_transfer_uploads_total{outcome="saved"} 4.0' in content
+        # The connections of the processes that exited are no longer counted.
+        assert "file_transfer_active_connections" not in content
+
+
 class ScopeMiddleWare:
     def __init__(self, inner):
         self.inner = inner
@@ -80,21 +785,114 @@ class ScopeMiddleWare:
         return await self.inner(scope, receive, send)
 
 
+@pytest.mark.asyncio
+class TestAuthMiddleware:
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        self.application = TokenAuthMiddleware(AsyncWebsocketConsumer.as_asgi(), ["secret"])
+
+    async def connect(self, path: str, headers=None) -> bool:
+        communicator = WebsocketCommunicator(self.application, path, headers=headers)
+        connected, _ = await communicator.connect()
+        await communicator.disconnect()
+        return connected
+
+    async def test_token_as_bearer_header(self):
+        assert await self.connect("/ws/file-transfer/", headers=[(b"authorization", b"Bearer secret")])
+
+    async def test_token_as_query_parameter(self):
+        assert await self.connect("/ws/file-transfer/?token=secret")
+
+    async def test_missing_or_wrong_token_is_denied(self):
+        assert not await self.connect("/ws/file-transfer/")
+        assert not await self.connect("/ws/file-transfer/?token=other")
+        assert not await self.connect("/ws/file-transfer/", headers=[(b"authorization", b"Basic secret")])
+
+    async def test_modes(self, settings):
+        inner = AsyncWebsocketConsumer.as_asgi()
+        settings.WEBSOCKET_AUTH = "none"
+        assert get_auth_middleware(inner) is inner
+        settings.WEBSOCKET_AUTH = "session"
+        assert type(get_auth_middleware(inner)) is type(AuthMiddlewareStack(inner))
+        settings.WEBSOCKET_AUTH = "token"
+        settings.WEBSOCKET_AUTH_TOKENS = ["secret"]
+        assert isinstance(get_auth_middleware(inner), TokenAuthMiddleware)
+
+    async def test_misconfigured_modes(self, settings):
+        settings.WEBSOCKET_AUTH = "token"
+        settings.WEBSOCKET_AUTH_TOKENS = []
+        with pytest.raises(ImproperlyConfigured):
+            get_auth_middleware(AsyncWebsocketConsumer.as_asgi())
+        settings.WEBSOCKET_AUTH = "other"
+        with pytest.raises(ImproperlyConfigured):
+            get_auth_middleware(AsyncWebsocketConsumer.as_asgi())
+
+
+class TestChunkSizer:
+    @pytest.fixture(autouse=True)
+    def setup(self, monkeypatch):
+        monkeypatch.setattr(ChunkSizer, "active_transfers", 1)
+        self.sizer = ChunkSizer(
+            min_size=16 * 1024,
+            initial_size=64 * 1024,
+            max_size=1024 * 1024,
+            target_duration=0.1,
+            memory_budget=64 * 1024 * 1024,
+        )
+
+    def test_initial_size_before_throughput_is_observed(self):
+        assert self.sizer.recommend(10 * 1024 * 1024) == 64 * 1024
+
+    def test_recommendation_follows_throughput(self):
+        self.sizer.observe(64 * 1024, now=0)
+        self.sizer.observe(64 * 1024, now=0.25)
+
+        # 256KB/s sent in chunks of 100ms, rounded down to a power of two.
+        assert self.sizer.recommend(10 * 1024 * 1024) == 16 * 1024
+
+        # A faster chunk moves the average towards its rate instead of replacing it.
+        self.sizer.observe(64 * 1024, now=0.26)
+        assert self.sizer.recommend(10 * 1024 * 1024) == 128 * 1024
+
+    def test_idle_time_is_not_measured(self):
+        self.sizer.observe(64 * 1024, now=0)
+        self.sizer.pause()
+        self.sizer.observe(64 * 1024, now=60)
+
+        assert self.sizer.throughput is None
+
+    def test_recommendation_shrinks_with_server_load(self, monkeypatch):
+        monkeypatch.setattr(ChunkSizer, "active_transfers", 256)
+        self.sizer.observe(1024 * 1024, now=0)
+        self.sizer.observe(1024 * 1024, now=0.01)
+
+        assert self.sizer.recommend(10 * 1024 * 1024, window=4) == 64 * 1024
+
+    def test_recommendation_is_capped_by_file_size(self):
+        assert self.sizer.recommend(1000) == 1000
+
+    def test_max_message_size_fits_a_base64_chunk(self):
+        chunk_message = json.dumps({"type": MessageType.CHUNK.value, "chunk": "A" * (4 * (1024 * 1024 + 2) // 3)})
+        assert len(chunk_message) <= self.sizer.max_message_size
+
+
 @pytest.mark.asyncio
 class TestFileTransferConsumer:
     @pytest.fixture(autouse=True)
-    async def setup(self):
+    async def setup(self, settings, tmp_path):
+        settings.FILE_SAVE_DIRECTORY = str(tmp_path)
+        settings.FILE_POSTPROCESSORS = {}
         self.save_file_mock = patch("file_listener.consumers.FileTransferHandler.save_file")
         self.save_file_mock.start()
 
-        application = URLRouter(
+        self.application = URLRouter(
             [
                 re_path(r"^ws/file_transfer/$", ScopeMiddleWare(FileTransferConsumer.as_asgi())),
             ]
         )
         self.consumer = FileTransferConsumer()
         self.consumer.scope = {"client": ("127.0.0.1", 1234)}
-        self.communicator = WebsocketCommunicator(application, "/ws/file_transfer/")
+        self.communicator = WebsocketCommunicator(self.application, "/ws/file_transfer/")
         connected, _ = await self.communicator.connect()
         assert connected
 
@@ -126,6 +924,57 @@ class TestFileTransferConsumer:
 
         assert response["type"] == MessageType.META_RECEIVED.value
         assert response["message"] == "Ready to receive file"
+        assert response["chunk_size"] == 100
+        assert response["max_chunk_size"] == settings.CHUNK_SIZE_MAX
+
+    async def test_oversize_chunk_is_rejected_before_decoding(self, settings):
+        settings.CHUNK_SIZE_MAX = 1024
+        communicator = WebsocketCommunicator(self.application, "/ws/file_transfer/")
+        await communicator.connect()
+        await communicator.send_json_to(
+            {"type": MessageType.META.value, "file_name": "test.txt", "file_size": 4096, "binary": True}
+        )
+        meta_response = await communicator.receive_json_from()
+        assert meta_response["max_chunk_size"] == 1024
+
+        with patch("file_listener.consumers.json.loads", wraps=json.loads) as loads_mock:
+            chunk = base64.b64encode(b"0" * 2048).decode("utf-8")
+            await communicator.send_to(text_data=f'{{"type": "{MessageType.CHUNK.value}", "chunk": "{chunk}"}}')
+            response = await communicator.receive_json_from()
+        assert response["type"] == MessageType.ERROR.value
+        assert "maximum size" in response["message"]
+        assert all(chunk not in call.args[0] for call in loads_mock.call_args_list)
+
+        await communicator.send_to(bytes_data=build_binary_chunk(meta_response["transfer_id"], 0, b"0" * 2048))
+        response = await communicator.receive_json_from()
+        assert response["type"] == MessageType.ERROR.value
+        assert "maximum chunk size" in response["message"]
+        await communicator.disconnect()
+
+    async def test_chunk_size_is_adjusted_mid_transfer(self, settings):
+        settings.CHUNK_SIZE_INITIAL = 16 * 1024
+        settings.CHUNK_SIZE_MIN = 16 * 1024
+        communicator = WebsocketCommunicator(self.application, "/ws/file_transfer/")
+        await communicator.connect()
+        await communicator.send_json_to(
+            {"type": MessageType.META.value, "file_name": "test.txt", "file_size": 1024 * 1024, "binary": True}
+        )
+        meta_response = await communicator.receive_json_from()
+        assert meta_response["chunk_size"] == 16 * 1024
+
+        transfer_id = meta_response["transfer_id"]
+        for offset in (0, 16 * 1024):
+            await communicator.send_to(bytes_data=build_binary_chunk(transfer_id, offset, b"0" * 16 * 1024))
+        responses = [await communicator.receive_json_from() for _ in range(3)]
+
+        assert [response["type"] for response in responses] == [
+            MessageType.CHUNK_RECEIVED.value,
+            MessageType.CHUNK_SIZE.value,
+            MessageType.CHUNK_RECEIVED.value,
+        ]
+        assert responses[1]["chunk_size"] > meta_response["chunk_size"]
+        assert responses[1]["transfer_id"] == transfer_id
+        await communicator.disconnect()
 
     async def test_file_chunk_handler(self):
         # Send file meta first
@@ -142,6 +991,464 @@ class TestFileTransferConsumer:
 
         assert response["type"] == MessageType.FILE_RECEIVED.value
         assert "test.txt received successfully" in response["message"]
+        assert response["detected_type"] == "txt"
+
+    async def test_binary_chunk_handler(self):
+        await self.communicator.send_json_to(
+            {"type": MessageType.META.value, "file_name": "test.txt", "file_size": 10, "binary": True}
+        )
+        meta_response = await self.communicator.receive_json_from()
+        assert meta_response["binary"] is True
+
+        transfer_id = meta_response["transfer_id"]
+        await self.communicator.send_to(bytes_data=build_binary_chunk(transfer_id, 0, b"01234"))
+        response = await self.communicator.receive_json_from()
+        assert response["type"] == MessageType.CHUNK_RECEIVED.value
+
+        await self.communicator.send_to(bytes_data=build_binary_chunk(transfer_id, 5, b"56789"))
+        response = await self.communicator.receive_json_from()
+        assert response["type"] == MessageType.FILE_RECEIVED.value
+
+    async def test_compressed_binary_chunks(self):
+        received_bytes = get_sample("file_transfer_received_bytes_total", encoding="binary")
+        compressed_bytes = get_sample("file_transfer_compressed_bytes_total", compression="deflate")
+        await self.communicator.send_json_to(
+            {
+                "type": MessageType.META.value,
+                "file_name": "test.txt",
+                "file_size": 20000,
+                "binary": True,
+                "compression": "deflate",
+            }
+        )
+        meta_response = await self.communicator.receive_json_from()
+        assert meta_response["compression"] == "deflate"
+
+        data = b"0123456789" * 2000
+        chunk = zlib.compress(data)
+        await self.communicator.send_to(
+            bytes_data=build_binary_chunk(meta_response["transfer_id"], 0, chunk, crc32=zlib.crc32(data))
+        )
+        response = await self.communicator.receive_json_from()
+        assert response["type"] == MessageType.FILE_RECEIVED.value
+        assert get_sample("file_transfer_received_bytes_total", encoding="binary") == received_bytes + len(data)
+        compressed_bytes += len(chunk)
+        assert get_sample("file_transfer_compressed_bytes_total", compression="deflate") == compressed_bytes
+
+    async def test_transfer_metrics(self):
+        received_bytes = get_sample("file_transfer_received_bytes_total", encoding="binary")
+        saved_uploads = get_sample("file_transfer_uploads_total", outcome="saved")
+        await self.communicator.send_json_to(
+            {"type": MessageType.META.value, "file_name": "test.txt", "file_size": 10, "binary": True}
+        )
+        meta_response = await self.communicator.receive_json_from()
+        await self.communicator.send_to(bytes_data=build_binary_chunk(meta_response["transfer_id"], 0, b"0123456789"))
+        await self.communicator.receive_json_from()
+
+        assert get_sample("file_transfer_received_bytes_total", encoding="binary") == received_bytes + 10
+        assert get_sample("file_transfer_uploads_total", outcome="saved") == saved_uploads + 1
+
+    async def test_compact_acks(self):
+        await self.communicator.send_json_to(
+            {
+                "type": MessageType.META.value,
+                "file_name": "test.txt",
+                "file_size": 10,
+                "binary": True,
+                "compact_acks": True,
+            }
+        )
+        meta_response = await self.communicator.receive_json_from()
+        assert meta_response["compact_acks"] is True
+
+        transfer_id = meta_response["transfer_id"]
+        await self.communicator.send_to(bytes_data=build_binary_chunk(transfer_id, 0, b"01234"))
+        ack = parse_ack(await self.communicator.receive_from())
+        assert (ack.transfer_id, ack.seq, ack.offset) == (transfer_id, 0, 5)
+
+        await self.communicator.send_to(bytes_data=build_binary_chunk(transfer_id, 5, b"56789"))
+        response = await self.communicator.receive_json_from()
+        assert response["type"] == MessageType.FILE_RECEIVED.value
+
+    async def test_compact_acks_without_binary_mode(self):
+        await self.communicator.send_json_to(
+            {"type": MessageType.META.value, "file_name": "test.txt", "file_size": 10, "compact_acks": True}
+        )
+        response = await self.communicator.receive_json_from()
+
+        assert response["type"] == MessageType.ERROR.value
+        assert "binary mode" in response["message"]
+
+    async def test_binary_chunk_without_negotiation(self):
+        await self.communicator.send_json_to(
+            {"type": MessageType.META.value, "file_name": "test.txt", "file_size": 10}
+        )
+        meta_response = await self.communicator.receive_json_from()
+
+        await self.communicator.send_to(bytes_data=build_binary_chunk(meta_response["transfer_id"], 0, b"01234"))
+        response = await self.communicator.receive_json_from()
+        assert response["type"] == MessageType.ERROR.value
+
+    async def test_resume_upload_after_reconnect(self):
+        await self.communicator.send_json_to(
+            {"type": MessageType.META.value, "file_name": "test.txt", "file_size": 10}
+        )
+        meta_response = await self.communicator.receive_json_from()
+        assert meta_response["offset"] == 0
+
+        chunk = base64.b64encode(b"01234").decode("utf-8")
+        await self.communicator.send_json_to({"type": MessageType.CHUNK.value, "chunk": chunk})
+        await self.communicator.receive_json_from()
+        await self.communicator.disconnect()
+
+        self.communicator = WebsocketCommunicator(self.application, "/ws/file_transfer/")
+        await self.communicator.connect()
+        await self.communicator.send_json_to(
+            {
+                "type": MessageType.META.value,
+                "file_name": "test.txt",
+                "file_size": 10,
+                "upload_id": meta_response["upload_id"],
+            }
+        )
+        response = await self.communicator.receive_json_from()
+
+        assert response["type"] == MessageType.META_RECEIVED.value
+        assert response["upload_id"] == meta_response["upload_id"]
+        assert response["offset"] == 5
+
+    async def test_resume_upload_carried_by_another_connection(self):
+        await self.communicator.send_json_to(
+            {"type": MessageType.META.value, "file_name": "test.txt", "file_size": 10, "binary": True}
+        )
+        meta_response = await self.communicator.receive_json_from()
+        await self.communicator.send_to(bytes_data=build_binary_chunk(meta_response["transfer_id"], 0, b"01234"))
+        await self.communicator.receive_json_from()
+
+        # Another worker would be reached the same way, through the channel layer.
+        communicator = WebsocketCommunicator(self.application, "/ws/file_transfer/")
+        await communicator.connect()
+        await communicator.send_json_to(
+            {
+                "type": MessageType.META.value,
+                "file_name": "test.txt",
+                "file_size": 10,
+                "binary": True,
+                "upload_id": meta_response["upload_id"],
+            }
+        )
+        response = await communicator.receive_json_from()
+        assert response["type"] == MessageType.META_RECEIVED.value
+        assert response["offset"] == 5
+
+        takeover_response = await self.communicator.receive_json_from()
+        assert takeover_response["type"] == MessageType.ERROR.value
+        assert takeover_response["transfer_id"] == meta_response["transfer_id"]
+        await self.communicator.send_to(bytes_data=build_binary_chunk(meta_response["transfer_id"], 5, b"56789"))
+        assert "No file transfer in progress" in (await self.communicator.receive_json_from())["message"]
+
+        await communicator.send_to(bytes_data=build_binary_chunk(response["transfer_id"], 5, b"56789"))
+        assert (await communicator.receive_json_from())["type"] == MessageType.FILE_RECEIVED.value
+        await communicator.disconnect()
+
+    async def test_chunk_refused_after_losing_upload_lock(self):
+        await self.communicator.send_json_to(
+            {"type": MessageType.META.value, "file_name": "test.txt", "file_size": 10, "binary": True}
+        )
+        meta_response = await self.communicator.receive_json_from()
+        lock = UploadLock(settings.UPLOAD_LOCK_KEY_PREFIX, meta_response["upload_id"], "other", timeout=30)
+        await get_redis().delete(lock.key)
+        await lock.acquire()
+
+        with patch("file_listener.locks.time.monotonic", return_value=float("inf")):
+            await self.communicator.send_to(bytes_data=build_binary_chunk(meta_response["transfer_id"], 0, b"01234"))
+            response = await self.communicator.receive_json_from()
+
+        assert response["type"] == MessageType.ERROR.value
+        assert "continued on another connection" in response["message"]
+        assert await get_redis().get(lock.key) == b"other"
+
+    async def test_upload_completes_after_pausing_past_lock_timeout(self, settings):
+        settings.UPLOAD_LOCK_TIMEOUT = 0.2
+        settings.TRANSFER_REAP_INTERVAL = 0
+        await self.communicator.send_json_to(
+            {"type": MessageType.META.value, "file_name": "test.txt", "file_size": 10, "binary": True}
+        )
+        meta_response = await self.communicator.receive_json_from()
+        await self.communicator.send_to(bytes_data=build_binary_chunk(meta_response["transfer_id"], 0, b"01234"))
+        assert (await self.communicator.receive_json_from())["type"] == MessageType.CHUNK_RECEIVED.value
+
+        await asyncio.sleep(0.5)
+        await self.communicator.send_to(bytes_data=build_binary_chunk(meta_response["transfer_id"], 5, b"56789"))
+        assert (await self.communicator.receive_json_from())["type"] == MessageType.FILE_RECEIVED.value
+
+    async def test_idle_transfers_keep_their_lock(self, settings):
+        settings.UPLOAD_LOCK_TIMEOUT = 0.3
+        settings.TRANSFER_REAP_INTERVAL = 0.05
+        await self.communicator.send_json_to({"type": MessageType.META.value, "file_name": "test.txt", "file_size": 10})
+        meta_response = await self.communicator.receive_json_from()
+
+        await asyncio.sleep(0.6)
+        lock_key = f"{settings.UPLOAD_LOCK_KEY_PREFIX}{meta_response['upload_id']}"
+        assert await get_redis().get(lock_key) is not None
+        assert await self.communicator.receive_nothing()
+
+    async def test_disconnect_cleanup_survives_redis_failures(self):
+        communicator = WebsocketCommunicator(self.application, "/ws/file_transfer/")
+        await communicator.connect()
+        transfers, reserved_size = AdmissionController.transfers, AdmissionController.reserved_size
+        active_transfers = ChunkSizer.active_transfers
+        active_connections = get_sample("file_transfer_active_connections")
+        suspended_uploads = get_sample("file_transfer_uploads_total", outcome="suspended")
+        for _ in range(2):
+            await communicator.send_json_to({"type": MessageType.META.value, "file_name": "test.txt", "file_size": 10})
+            await communicator.receive_json_from()
+
+        with patch("file_listener.consumers.UploadLock.release", side_effect=ConnectionError("Redis is down")):
+            with patch("file_listener.handlers.FileTransferHandler.save_progress", side_effect=ConnectionError):
+                await communicator.disconnect()
+
+        assert (AdmissionController.transfers, AdmissionController.reserved_size) == (transfers, reserved_size)
+        assert ChunkSizer.active_transfers == active_transfers
+        assert get_sample("file_transfer_active_connections") == active_connections - 1
+        assert get_sample("file_transfer_uploads_total", outcome="suspended") == suspended_uploads + 2
+
+    async def test_upload_lock_released_when_transfer_fails_to_start(self):
+        reserved_size = AdmissionController.reserved_size
+        with patch("file_listener.handlers.FileTransferHandler.save_progress", side_effect=ConnectionError("down")):
+            await self.communicator.send_json_to(
+                {"type": MessageType.META.value, "file_name": "test.txt", "file_size": 10}
+            )
+            response = await self.communicator.receive_json_from()
+
+        assert response["type"] == MessageType.ERROR.value
+        assert await get_redis().keys(f"{settings.UPLOAD_LOCK_KEY_PREFIX}*") == []
+        assert AdmissionController.reserved_size == reserved_size
+
+    async def test_file_meta_with_invalid_file_size(self):
+        reserved_size = AdmissionController.reserved_size
+        for file_size in [-(10**12), 10.5, "10"]:
+            await self.communicator.send_json_to(
+                {"type": MessageType.META.value, "file_name": "test.txt", "file_size": file_size}
+            )
+            response = await self.communicator.receive_json_from()
+            assert response["type"] == MessageType.ERROR.value
+            assert "Invalid file size" in response["message"]
+        assert AdmissionController.reserved_size == reserved_size
+
+    async def test_file_meta_deferred_over_budget(self, settings):
+        settings.ADMISSION_NODE_MAX_SIZE = 15
+        communicator = WebsocketCommunicator(self.application, "/ws/file_transfer/")
+        await communicator.connect()
+        await communicator.send_json_to({"type": MessageType.META.value, "file_name": "test.txt", "file_size": 10})
+        meta_response = await communicator.receive_json_from()
+        deferred = get_sample("file_transfer_deferrals_total", reason="node_size")
+
+        await communicator.send_json_to({"type": MessageType.META.value, "file_name": "test.txt", "file_size": 10})
+        response = await communicator.receive_json_from()
+        assert response["type"] == MessageType.META_DEFERRED.value
+        assert (response["reason"], response["retry_after"]) == ("node_size", settings.ADMISSION_RETRY_AFTER)
+        assert get_sample("file_transfer_deferrals_total", reason="node_size") == deferred + 1
+
+        chunk = base64.b64encode(b"0123456789").decode("utf-8")
+        await communicator.send_json_to(
+            {"type": MessageType.CHUNK.value, "chunk": chunk, "transfer_id": meta_response["transfer_id"]}
+        )
+        assert (await communicator.receive_json_from())["type"] == MessageType.FILE_RECEIVED.value
+        await communicator.send_json_to({"type": MessageType.META.value, "file_name": "test.txt", "file_size": 10})
+        assert (await communicator.receive_json_from())["type"] == MessageType.META_RECEIVED.value
+        await communicator.disconnect()
+        assert AdmissionController.reserved_size == 0
+
+    async def test_watch_upload_progress(self, settings):
+        settings.UPLOAD_PROGRESS_SAVE_INTERVAL = 5
+        await self.communicator.send_json_to(
+            {"type": MessageType.META.value, "file_name": "test.txt", "file_size": 10, "binary": True}
+        )
+        meta_response = await self.communicator.receive_json_from()
+
+        watcher = WebsocketCommunicator(self.application, "/ws/file_transfer/")
+        await watcher.connect()
+        await watcher.send_json_to({"type": MessageType.WATCH.value, "upload_id": meta_response["upload_id"]})
+        response = await watcher.receive_json_from()
+        assert response == {
+            "type": MessageType.UPLOAD_PROGRESS.value,
+            "upload_id": meta_response["upload_id"],
+            "status": "progress",
+            "received_size": 0,
+            "file_size": 10,
+        }
+
+        for offset, data in ((0, b"01234"), (5, b"56789")):
+            await self.communicator.send_to(bytes_data=build_binary_chunk(meta_response["transfer_id"], offset, data))
+        updates = [await watcher.receive_json_from() for _ in range(2)]
+        assert [(update["status"], update["received_size"]) for update in updates] == [("progress", 5), ("saved", 10)]
+        await watcher.disconnect()
+
+    async def test_saved_file_is_post_processed(self, settings):
+        settings.FILE_POSTPROCESSORS = {"txt": "file_listener.processors.text_info"}
+        self.save_file_mock.stop()
+        communicator = WebsocketCommunicator(self.application, "/ws/file_transfer/")
+        await communicator.connect()
+        await communicator.send_json_to({"type": MessageType.META.value, "file_name": "test.txt", "file_size": 6})
+        meta_response = await communicator.receive_json_from()
+        chunk = base64.b64encode(b"a\nb\nc\n").decode("utf-8")
+        await communicator.send_json_to({"type": MessageType.CHUNK.value, "chunk": chunk})
+        assert (await communicator.receive_json_from())["type"] == MessageType.FILE_RECEIVED.value
+
+        updates = [await communicator.receive_json_from(timeout=10) for _ in range(3)]
+        assert [update["type"] for update in updates] == [MessageType.FILE_PROCESSED.value] * 3
+        assert [update["status"] for update in updates] == ["queued", "started", "done"]
+        assert updates[2]["upload_id"] == meta_response["upload_id"]
+        assert updates[2]["result"] == {"encoding": "ascii", "lines": 3}
+        await communicator.disconnect()
+        PostProcessingQueue.poller.cancel()
+        await asyncio.gather(PostProcessingQueue.poller, return_exceptions=True)
+
+    async def test_stalled_transfer_is_suspended(self, settings):
+        settings.TRANSFER_REAP_INTERVAL = 0.05
+        settings.TRANSFER_IDLE_TIMEOUT = 0.1
+        communicator = WebsocketCommunicator(self.application, "/ws/file_transfer/")
+        await communicator.connect()
+        stalled_uploads = get_sample("file_transfer_uploads_total", outcome="stalled")
+        await communicator.send_json_to({"type": MessageType.META.value, "file_name": "test.txt", "file_size": 10})
+        meta_response = await communicator.receive_json_from()
+        await communicator.send_json_to(
+            {"type": MessageType.CHUNK.value, "chunk": base64.b64encode(b"01234").decode("utf-8")}
+        )
+        await communicator.receive_json_from()
+
+        response = await communicator.receive_json_from(timeout=2)
+        assert response["type"] == MessageType.ERROR.value
+        assert response["transfer_id"] == meta_response["transfer_id"]
+        assert "Transfer stalled" in response["message"]
+        assert get_sample("file_transfer_uploads_total", outcome="stalled") == stalled_uploads + 1
+        progress = await cache.aget(f"{settings.UPLOAD_PROGRESS_KEY_PREFIX}{meta_response['upload_id']}")
+        assert progress["received_size"] == 5
+        await communicator.disconnect()
+
+    async def test_reaping_only_runs_with_transfers(self, settings):
+        settings.TRANSFER_REAP_INTERVAL = 0.05
+        consumer = FileTransferConsumer()
+        assert consumer.reaping is None
+
+        file_handler = FileTransferHandler("test.txt", 10)
+        consumer.add_transfer(file_handler)
+        assert not consumer.reaping.done()
+        consumer.transfers.clear()
+        ChunkSizer.active_transfers -= 1
+        ACTIVE_TRANSFERS.dec()
+        await asyncio.wait_for(consumer.reaping, timeout=1)
+
+    async def test_watch_unknown_upload(self):
+        await self.communicator.send_json_to({"type": MessageType.WATCH.value, "upload_id": "0" * 32})
+        response = await self.communicator.receive_json_from()
+        assert response["status"] == "unknown"
+
+    async def test_watched_uploads_limit(self, settings):
+        settings.FILE_MAX_CONCURRENT_TRANSFERS = 1
+        settings.FILE_MAX_WATCHED_UPLOADS = 2
+        for upload_id in ("0" * 32, "1" * 32, "0" * 32, "2" * 32):
+            await self.communicator.send_json_to({"type": MessageType.WATCH.value, "upload_id": upload_id})
+        responses = [await self.communicator.receive_json_from() for _ in range(4)]
+
+        assert [response.get("status") for response in responses[:3]] == ["unknown"] * 3
+        assert responses[3]["type"] == MessageType.ERROR.value
+        assert "at most 2 are allowed" in responses[3]["message"]
+
+    async def test_windowed_chunk_acknowledgements(self, settings):
+        settings.TRANSFER_ACK_EVERY = 2
+        await self.communicator.send_json_to(
+            {"type": MessageType.META.value, "file_name": "test.txt", "file_size": 10, "window": True}
+        )
+        meta_response = await self.communicator.receive_json_from()
+        assert meta_response["window"] == settings.TRANSFER_WINDOW_SIZE
+
+        for seq, data in enumerate([b"01", b"23", b"4"]):
+            chunk = base64.b64encode(data).decode("utf-8")
+            await self.communicator.send_json_to({"type": MessageType.CHUNK.value, "chunk": chunk, "seq": seq})
+
+        response = await self.communicator.receive_json_from()
+        assert (response["type"], response["seq"], response["offset"]) == (MessageType.CHUNK_RECEIVED.value, 1, 4)
+
+        response = await self.communicator.receive_json_from()
+        assert (response["seq"], response["offset"]) == (2, 5)
+
+    async def test_interleaved_transfers(self):
+        transfer_ids = []
+        for file_name in ["first.txt", "second.txt"]:
+            await self.communicator.send_json_to(
+                {"type": MessageType.META.value, "file_name": file_name, "file_size": 4}
+            )
+            transfer_ids.append((await self.communicator.receive_json_from())["transfer_id"])
+
+        for data in [b"01", b"23"]:
+            for transfer_id in reversed(transfer_ids):
+                chunk = base64.b64encode(data).decode("utf-8")
+                await self.communicator.send_json_to(
+                    {"type": MessageType.CHUNK.value, "chunk": chunk, "transfer_id": transfer_id}
+                )
+                response = await self.communicator.receive_json_from()
+                assert response["transfer_id"] == transfer_id
+
+        assert response["type"] == MessageType.FILE_RECEIVED.value
+        assert "first.txt received successfully" in response["message"]
+
+    async def test_concurrent_transfers_limit(self, settings):
+        settings.FILE_MAX_CONCURRENT_TRANSFERS = 1
+        for _ in range(2):
+            await self.communicator.send_json_to(
+                {"type": MessageType.META.value, "file_name": "test.txt", "file_size": 10}
+            )
+        await self.communicator.receive_json_from()
+        response = await self.communicator.receive_json_from()
+
+        assert response["type"] == MessageType.ERROR.value
+        assert "Too many concurrent transfers" in response["message"]
+
+    async def test_chunk_error_reports_transfer_id(self):
+        await self.communicator.send_json_to(
+            {"type": MessageType.META.value, "file_name": "test.txt", "file_size": 10}
+        )
+        transfer_id = (await self.communicator.receive_json_from())["transfer_id"]
+
+        chunk = base64.b64encode(b"0123").decode("utf-8")
+        await self.communicator.send_json_to({"type": MessageType.CHUNK.value, "chunk": chunk, "offset": 5})
+        response = await self.communicator.receive_json_from()
+
+        assert response["type"] == MessageType.ERROR.value
+        assert response["transfer_id"] == transfer_id
+
+    async def test_file_meta_with_stored_digest_skips_transfer(self, tmp_path):
+        sha256 = hashlib.sha256(b"0123456789").hexdigest()
+        (tmp_path / "stored.txt").write_bytes(b"0123456789")
+        ContentAddressedStore(str(tmp_path)).store(str(tmp_path / "stored.txt"), sha256, "stored.txt")
+
+        await self.communicator.send_json_to(
+            {"type": MessageType.META.value, "file_name": "test.txt", "file_size": 10, "sha256": sha256}
+        )
+        response = await self.communicator.receive_json_from()
+
+        assert response["type"] == MessageType.FILE_RECEIVED.value
+        assert response["deduplicated"]
+        assert response["sha256"] == sha256
+        assert (tmp_path / "test.txt").read_bytes() == b"0123456789"
+
+    async def test_mismatched_content_aborts_transfer(self):
+        await self.communicator.send_json_to(
+            {"type": MessageType.META.value, "file_name": "test.txt", "file_size": 1024}
+        )
+        await self.communicator.receive_json_from()
+
+        chunk = base64.b64encode(b"%PDF-1.7\x00" + b"0" * SNIFF_SIZE).decode("utf-8")
+        await self.communicator.send_json_to({"type": MessageType.CHUNK.value, "chunk": chunk})
+        response = await self.communicator.receive_json_from()
+        assert response["type"] == MessageType.ERROR.value
+        assert "does not match its extension" in response["message"]
+
+        await self.communicator.send_json_to({"type": MessageType.CHUNK.value, "chunk": chunk})
+        response = await self.communicator.receive_json_from()
+        assert "No file transfer in progress" in response["message"]
 
     async def test_invalid_message_type(self):
         await self.communicator.send_json_to({"type": "INVALID_TYPE", "data": "some data"})
@@ -150,10 +1457,16 @@ class TestFileTransferConsumer:
         assert response["type"] == MessageType.ERROR.value
         assert "Invalid message type" in response["message"]
 
+    async def test_rejections_are_counted_by_reason(self):
+        rejections = get_sample("file_transfer_rejections_total", reason="invalid_json")
+        await self.communicator.send_to(text_data="{")
+        await self.communicator.receive_json_from()
+
+        assert get_sample("file_transfer_rejections_total", reason="invalid_json") == rejections + 1
+
     async def test_rate_limit_exceeded(self):
-        cache.set(
-            f"{settings.RATE_LIMIT_KEY_PREFIX}{self.consumer.scope["client"][0]}",
-            (settings.RATE_LIMIT_PER_PERIOD + 1, timezone.now()),
+        await get_redis().set(
+            f"{settings.RATE_LIMIT_KEY_PREFIX}{self.consumer.scope["client"][0]}", settings.RATE_LIMIT_PER_PERIOD
         )
         with pytest.raises(RateLimitExceededError):
             await self.consumer.limit_rate()
@@ -163,11 +1476,264 @@ class TestFileTransferConsumer:
 
     async def test_reset_limit_rate_request_count(self):
         key = f"{settings.RATE_LIMIT_KEY_PREFIX}{self.consumer.scope["client"][0]}"
-        cache.set(
-            key,
-            (settings.RATE_LIMIT_PER_PERIOD + 1, timezone.now() - timedelta(seconds=60)),
-        )
+        await get_redis().set(key, settings.RATE_LIMIT_PER_PERIOD, px=10)
+        await asyncio.sleep(0.05)
         await self.consumer.limit_rate()
 
-        cached_count, _ = cache.get(key)
-        assert cached_count == 1
+        assert int(await get_redis().get(key)) == 1
+        assert 0 < await get_redis().ttl(key) <= settings.RATE_LIMIT_PERIOD
+
+
+@pytest.mark.asyncio
+class TestSpoolReaper:
+    @pytest.fixture(autouse=True)
+    async def setup(self, tmp_path):
+        self.directory = tmp_path
+        self.reaper = SpoolReaper(str(tmp_path), max_age=60, interval=10)
+        SpoolReaper.sweep_at = 0.0
+        yield
+        cache.clear()
+
+    def create_spool(self, upload_id: str, age: int) -> str:
+        path = self.directory / f".{upload_id}.part"
+        path.write_bytes(b"data")
+        mtime = time.time() - age
+        os.utime(path, (mtime, mtime))
+        return path
+
+    async def test_removes_abandoned_spools(self):
+        abandoned = self.create_spool("a" * 32, 120)
+        recent = self.create_spool("b" * 32, 0)
+        unrelated = self.directory / "test.txt"
+        unrelated.write_bytes(b"data")
+        os.utime(unrelated, (0, 0))
+
+        assert await self.reaper.sweep() == 1
+        assert not abandoned.exists()
+        assert recent.exists()
+        assert unrelated.exists()
+
+    async def test_keeps_resumable_spools(self):
+        resumable = self.create_spool("c" * 32, 120)
+        await cache.aset(f"{settings.UPLOAD_PROGRESS_KEY_PREFIX}{'c' * 32}", {"received_size": 4})
+
+        assert await self.reaper.sweep() == 0
+        assert resumable.exists()
+
+    async def test_sweeps_once_per_interval(self):
+        await self.reaper.sweep()
+        abandoned = self.create_spool("d" * 32, 120)
+
+        assert await self.reaper.sweep() == 0
+        assert abandoned.exists()
+
+
+@pytest.mark.asyncio
+class TestUploadLock:
+    @pytest.fixture(autouse=True)
+    async def setup(self):
+        self.lock = UploadLock("test_upload_lock_", "a" * 32, "worker-1", timeout=30)
+        self.other_lock = UploadLock("test_upload_lock_", "a" * 32, "worker-2", timeout=30)
+        yield
+        cache.clear()
+
+    async def test_acquire_returns_current_owner(self):
+        assert await self.lock.acquire() is None
+        assert await self.lock.acquire() is None
+        assert await self.other_lock.acquire() == "worker-1"
+
+    async def test_release_only_by_owner(self):
+        await self.lock.acquire()
+        await self.other_lock.release()
+        assert await self.other_lock.acquire() == "worker-1"
+
+        await self.lock.release()
+        assert await self.other_lock.acquire() is None
+
+    async def test_renew_fails_once_taken_over(self):
+        await self.lock.acquire()
+        await get_redis().delete(self.lock.key)
+        await self.other_lock.acquire()
+        self.lock.renew_at = 0
+
+        assert not await self.lock.renew()
+
+    async def test_renew_takes_expired_lock_again(self):
+        await self.lock.acquire()
+        await get_redis().delete(self.lock.key)
+        self.lock.renew_at = 0
+
+        assert await self.lock.renew()
+        assert await self.other_lock.acquire() == "worker-1"
+
+    async def test_renew_is_local_until_due(self):
+        await self.lock.acquire()
+        await get_redis().delete(self.lock.key)
+
+        assert await self.lock.renew()
+
+
+@pytest.mark.asyncio
+class TestAdmissionController:
+    @pytest.fixture(autouse=True)
+    async def setup(self, monkeypatch, tmp_path):
+        monkeypatch.setattr(AdmissionController, "transfers", 0)
+        monkeypatch.setattr(AdmissionController, "reserved_size", 0)
+        self.options = {
+            "key_prefix": "test_admission_",
+            "node_id": "node",
+            "directory": str(tmp_path),
+            "max_transfers": 2,
+            "max_size": 100,
+            "node_max_transfers": 10,
+            "node_max_size": 1000,
+            "disk_free_min": 0,
+            "timeout": 30,
+            "retry_after": 5,
+        }
+        self.controller = AdmissionController(**self.options)
+        yield
+        cache.clear()
+
+    async def test_process_budgets(self):
+        await self.controller.reserve(60)
+        with pytest.raises(AdmissionDeferredError) as error:
+            await self.controller.reserve(50)
+        assert (error.value.reason, error.value.retry_after) == ("process_size", 5)
+
+        await self.controller.reserve(40)
+        with pytest.raises(AdmissionDeferredError) as error:
+            await self.controller.reserve(0)
+        assert error.value.reason == "process_transfers"
+
+    async def test_release_returns_the_budget(self):
+        reservation = await self.controller.reserve(100)
+        await self.controller.release(reservation)
+
+        assert (AdmissionController.transfers, AdmissionController.reserved_size) == (0, 0)
+        await self.controller.reserve(100)
+
+    async def test_node_budget_is_shared_by_processes(self, monkeypatch):
+        node_controller = AdmissionController(**{**self.options, "max_size": 1000, "node_max_size": 100})
+        await node_controller.reserve(60)
+        # Another process of the node starts with its own counters.
+        monkeypatch.setattr(AdmissionController, "transfers", 0)
+        monkeypatch.setattr(AdmissionController, "reserved_size", 0)
+
+        with pytest.raises(AdmissionDeferredError) as error:
+            await node_controller.reserve(50)
+        assert error.value.reason == "node_size"
+        assert (AdmissionController.transfers, AdmissionController.reserved_size) == (0, 0)
+
+    async def test_free_disk_space(self):
+        controller = AdmissionController(**{**self.options, "disk_free_min": 1 << 60})
+        with pytest.raises(AdmissionDeferredError) as error:
+            await controller.reserve(1)
+        assert error.value.reason == "disk"
+
+    async def test_allocated_reservations_leave_the_disk_budget(self, monkeypatch):
+        controller = AdmissionController(**{**self.options, "max_size": 1000})
+        monkeypatch.setattr("file_listener.admission.get_free_disk_space", lambda directory: 100)
+        reservation = await controller.reserve(60)
+        # The spool of the first transfer is preallocated, the free disk space doesn't include it anymore.
+        monkeypatch.setattr("file_listener.admission.get_free_disk_space", lambda directory: 40)
+        with pytest.raises(AdmissionDeferredError) as error:
+            await controller.reserve(40)
+        assert error.value.reason == "disk"
+
+        await controller.allocate(reservation)
+        await controller.reserve(40)
+
+    async def test_expired_reservations_are_dropped(self, monkeypatch):
+        controller = AdmissionController(**{**self.options, "node_max_transfers": 1, "timeout": 0.001})
+        await controller.reserve(10)
+        await asyncio.sleep(0.01)
+        monkeypatch.setattr(AdmissionController, "transfers", 0)
+
+        await controller.reserve(10)
+
+
+@pytest.mark.asyncio
+class TestRateLimiter:
+    @pytest.fixture(autouse=True)
+    async def setup(self):
+        self.rate_limiter = RateLimiter("test_rate_limit_", limit=5, period=60)
+        yield
+        cache.clear()
+
+    async def test_concurrent_messages_are_counted_exactly(self):
+        results = await asyncio.gather(*(self.rate_limiter.allow("127.0.0.1") for _ in range(20)))
+
+        assert results.count(True) == 5
+        assert int(await get_redis().get("test_rate_limit_127.0.0.1")) == 20
+
+    async def test_identifiers_are_limited_independently(self):
+        for _ in range(5):
+            assert await self.rate_limiter.allow("127.0.0.1")
+        assert not await self.rate_limiter.allow("127.0.0.1")
+        assert await self.rate_limiter.allow("127.0.0.2")
+
+
+@pytest.mark.asyncio
+class TestLeasedRateLimiter:
+    @pytest.fixture(autouse=True)
+    async def setup(self):
+        self.rate_limiter = LeasedRateLimiter("test_rate_limit_", limit=10, period=60, lease_size=4)
+        yield
+        cache.clear()
+
+    async def test_spends_leased_tokens_locally(self):
+        with patch("file_listener.rate_limit.LEASE_TOKENS", wraps=LEASE_TOKENS) as mock_lease:
+            for _ in range(8):
+                assert await self.rate_limiter.allow("127.0.0.1")
+
+        assert mock_lease.call_count == 2
+        assert int(await get_redis().get("test_rate_limit_127.0.0.1")) == 8
+
+    async def test_leases_never_exceed_the_limit(self):
+        other_limiter = LeasedRateLimiter("test_rate_limit_", limit=10, period=60, lease_size=4)
+        results = [await limiter.allow("127.0.0.1") for _ in range(8) for limiter in (self.rate_limiter, other_limiter)]
+
+        assert results.count(True) == 10
+
+    async def test_release_returns_unspent_tokens(self):
+        await self.rate_limiter.allow("127.0.0.1")
+        await self.rate_limiter.release("127.0.0.1")
+
+        assert int(await get_redis().get("test_rate_limit_127.0.0.1")) == 1
+
+
+class TestTokenBucket:
+    def test_burst_is_not_delayed(self):
+        bucket = TokenBucket(rate=1000, burst=500)
+        assert bucket.consume(500) == 0
+
+    def test_sustained_rate_is_delayed(self):
+        bucket = TokenBucket(rate=1000, burst=500)
+        bucket.consume(500)
+        assert bucket.consume(500) == pytest.approx(0.5, abs=0.01)
+
+
+@pytest.mark.asyncio
+class TestBandwidthShaper:
+    @pytest.fixture(autouse=True)
+    async def setup(self):
+        yield
+        cache.clear()
+
+    async def test_ip_rate_is_shared_between_connections(self):
+        shapers = [BandwidthShaper("test_bandwidth_", 1000, 500, 0, 0) for _ in range(2)]
+
+        assert await shapers[0].throttle("127.0.0.1", 500) == 0
+        assert await shapers[1].throttle("127.0.0.1", 500) == pytest.approx(0.5, abs=0.01)
+        assert await shapers[1].throttle("127.0.0.2", 500) == 0
+
+    async def test_connection_rate_is_applied(self):
+        shaper = BandwidthShaper("test_bandwidth_", 0, 0, 1000, 500)
+        await shaper.throttle("127.0.0.1", 1000)
+
+        assert await shaper.throttle("127.0.0.1", 100) == pytest.approx(0.6, abs=0.01)
+
+    async def test_disabled_shaper_does_not_delay(self):
+        shaper = BandwidthShaper("test_bandwidth_", 0, 0, 0, 0)
+        assert await shaper.throttle("127.0.0.1", 10 * 1024 * 1024) == 0
@@ -1,5 +1,17 @@
+from django.conf import settings
+from django.http import HttpResponse
 from django.shortcuts import render
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, generate_latest, multiprocess
 
 
 def index(request):
     return render(request, "file_listener/index.html")
+
+
+def metrics(request):
+    registry = REGISTRY
+    if settings.PROMETHEUS_MULTIPROC_DIR:
+        # Every server process writes its values to the directory, whichever one is scraped reports them all.
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry, settings.PROMETHEUS_MULTIPROC_DIR)
+    return HttpResponse(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
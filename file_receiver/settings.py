@@ -1,6 +1,8 @@
 import json
 import os
+import socket
 from pathlib import Path
+from typing import Any
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 SECRET_KEY = os.environ.get("DJANGO_SECRET_KEY")
@@ -14,11 +16,98 @@ REDIS_URL = os.environ.get("REDIS_URL", "")
 FILE_MAX_SIZE = int(os.environ.get("FILE_MAX_SIZE", 10)) * 1024 * 1024
 FILE_ALLOWED_EXTENSIONS = json.loads(os.environ.get("FILE_ALLOWED_EXTENSIONS", '["txt"]'))
 FILE_SAVE_DIRECTORY = os.environ.get("FILE_SAVE_DIRECTORY", "uploaded_files")
+# Partially received uploads, on storage shared by every worker so that any of them can resume an upload.
+# Empty means FILE_SAVE_DIRECTORY, which lets uploads saved locally be moved into place with a rename.
+FILE_SPOOL_DIRECTORY = os.environ.get("FILE_SPOOL_DIRECTORY", "")
+FILE_SPOOL_PREALLOCATE = os.environ.get("FILE_SPOOL_PREALLOCATE", "True") == "True"
+FILE_STORAGE_BACKEND = os.environ.get("FILE_STORAGE_BACKEND", "file_listener.storage.LocalStorage")
+FILE_STORAGE_S3_BUCKET = os.environ.get("FILE_STORAGE_S3_BUCKET", "")
+FILE_STORAGE_S3_PREFIX = os.environ.get("FILE_STORAGE_S3_PREFIX", "")
+FILE_STORAGE_S3_ENDPOINT_URL = os.environ.get("FILE_STORAGE_S3_ENDPOINT_URL", "")
+FILE_STORAGE_S3_PART_SIZE = int(os.environ.get("FILE_STORAGE_S3_PART_SIZE", 8)) * 1024 * 1024
+FILE_STORAGE_S3_MAX_CONCURRENCY = int(os.environ.get("FILE_STORAGE_S3_MAX_CONCURRENCY", 4))
+FILE_DEDUPLICATE = os.environ.get("FILE_DEDUPLICATE", "True") == "True"
+FILE_VERIFY_CONTENT = os.environ.get("FILE_VERIFY_CONTENT", "True") == "True"
+FILE_IO_MAX_WORKERS = int(os.environ.get("FILE_IO_MAX_WORKERS", 4))
+FILE_MAX_CONCURRENT_TRANSFERS = int(os.environ.get("FILE_MAX_CONCURRENT_TRANSFERS", 8))
+FILE_MAX_WATCHED_UPLOADS = int(os.environ.get("FILE_MAX_WATCHED_UPLOADS", 32))
+FILE_MAX_CONNECTION_PENDING_SIZE = int(os.environ.get("FILE_MAX_CONNECTION_PENDING_SIZE", 100)) * 1024 * 1024
+
+# Resumable Upload Settings
+UPLOAD_PROGRESS_KEY_PREFIX = "upload_progress_"
+UPLOAD_PROGRESS_TIMEOUT = int(os.environ.get("UPLOAD_PROGRESS_TIMEOUT", 24 * 60 * 60))
+UPLOAD_PROGRESS_SAVE_INTERVAL = int(os.environ.get("UPLOAD_PROGRESS_SAVE_INTERVAL", 1024 * 1024))
+UPLOAD_LOCK_KEY_PREFIX = "upload_lock_"
+UPLOAD_LOCK_TIMEOUT = int(os.environ.get("UPLOAD_LOCK_TIMEOUT", 30))
+UPLOAD_TAKEOVER_TIMEOUT = int(os.environ.get("UPLOAD_TAKEOVER_TIMEOUT", 5000))
+# Stalled transfers are suspended, a value of 0 disables the check (idle timeout and reap interval in seconds,
+# throughput floor in KB/s).
+TRANSFER_IDLE_TIMEOUT = int(os.environ.get("TRANSFER_IDLE_TIMEOUT", 60))
+TRANSFER_MIN_THROUGHPUT = int(os.environ.get("TRANSFER_MIN_THROUGHPUT", 0)) * 1024
+TRANSFER_REAP_INTERVAL = int(os.environ.get("TRANSFER_REAP_INTERVAL", 10))
+
+# Admission Control Settings, budgets of the declared sizes of the transfers in flight
+ADMISSION_KEY_PREFIX = "admission_"
+ADMISSION_NODE_ID = os.environ.get("ADMISSION_NODE_ID", socket.gethostname())
+ADMISSION_MAX_TRANSFERS = int(os.environ.get("ADMISSION_MAX_TRANSFERS", 256))
+ADMISSION_MAX_SIZE = int(os.environ.get("ADMISSION_MAX_SIZE", 1024)) * 1024 * 1024
+ADMISSION_NODE_MAX_TRANSFERS = int(os.environ.get("ADMISSION_NODE_MAX_TRANSFERS", 1024))
+ADMISSION_NODE_MAX_SIZE = int(os.environ.get("ADMISSION_NODE_MAX_SIZE", 4096)) * 1024 * 1024
+ADMISSION_DISK_FREE_MIN = int(os.environ.get("ADMISSION_DISK_FREE_MIN", 100)) * 1024 * 1024
+ADMISSION_RETRY_AFTER = int(os.environ.get("ADMISSION_RETRY_AFTER", 5))
+
+# Post-processing Settings, FILE_POSTPROCESSORS maps file extensions to the dotted path of their processor
+POSTPROCESS_KEY_PREFIX = "postprocess_"
+FILE_POSTPROCESSORS = json.loads(
+    os.environ.get(
+        "FILE_POSTPROCESSORS",
+        json.dumps(
+            {
+                "png": "file_listener.processors.image_info",
+                "jpg": "file_listener.processors.image_info",
+                "jpeg": "file_listener.processors.image_info",
+                "gif": "file_listener.processors.image_info",
+                "pdf": "file_listener.processors.pdf_info",
+                "txt": "file_listener.processors.text_info",
+            }
+        ),
+    )
+)
+POSTPROCESS_MAX_WORKERS = int(os.environ.get("POSTPROCESS_MAX_WORKERS", 2))
+POSTPROCESS_MAX_JOBS = int(os.environ.get("POSTPROCESS_MAX_JOBS", 4))
+POSTPROCESS_JOB_TIMEOUT = int(os.environ.get("POSTPROCESS_JOB_TIMEOUT", 300))
+POSTPROCESS_MAX_ATTEMPTS = int(os.environ.get("POSTPROCESS_MAX_ATTEMPTS", 3))
+
+# Sliding Window Settings
+TRANSFER_WINDOW_SIZE = int(os.environ.get("TRANSFER_WINDOW_SIZE", 16))
+TRANSFER_ACK_EVERY = int(os.environ.get("TRANSFER_ACK_EVERY", 4))
+TRANSFER_ACK_INTERVAL = int(os.environ.get("TRANSFER_ACK_INTERVAL", 50))
+
+# Chunk Size Settings, sizes are in KB and the target duration in milliseconds
+CHUNK_SIZE_MIN = int(os.environ.get("CHUNK_SIZE_MIN", 16)) * 1024
+CHUNK_SIZE_INITIAL = int(os.environ.get("CHUNK_SIZE_INITIAL", 64)) * 1024
+CHUNK_SIZE_MAX = int(os.environ.get("CHUNK_SIZE_MAX", 1024)) * 1024
+CHUNK_TARGET_DURATION = int(os.environ.get("CHUNK_TARGET_DURATION", 100))
+CHUNK_MEMORY_BUDGET = int(os.environ.get("CHUNK_MEMORY_BUDGET", 64)) * 1024 * 1024
 
 # Rate Limit Settings
 RATE_LIMIT_KEY_PREFIX = "rate_limit_"
 RATE_LIMIT_PERIOD = int(os.environ.get("RATE_LIMIT_PERIOD", 60))
 RATE_LIMIT_PER_PERIOD = int(os.environ.get("RATE_LIMIT_PER_PERIOD", 1000))
+RATE_LIMIT_LEASE_SIZE = int(os.environ.get("RATE_LIMIT_LEASE_SIZE", 1))
+
+# Bandwidth Settings, rates are in bytes per second and 0 disables the limit
+BANDWIDTH_KEY_PREFIX = "bandwidth_"
+BANDWIDTH_IP_RATE = int(os.environ.get("BANDWIDTH_IP_RATE", 0))
+BANDWIDTH_IP_BURST = int(os.environ.get("BANDWIDTH_IP_BURST", 1024 * 1024))
+BANDWIDTH_CONNECTION_RATE = int(os.environ.get("BANDWIDTH_CONNECTION_RATE", 0))
+BANDWIDTH_CONNECTION_BURST = int(os.environ.get("BANDWIDTH_CONNECTION_BURST", 1024 * 1024))
+
+# WebSocket Settings, WEBSOCKET_AUTH is one of none, session or token
+WEBSOCKET_AUTH = os.environ.get("WEBSOCKET_AUTH", "none")
+WEBSOCKET_AUTH_TOKENS = json.loads(os.environ.get("WEBSOCKET_AUTH_TOKENS", "[]"))
+# Socket only workers leave the admin, auth, sessions and messages apps out, they serve uploads, metrics and the page.
+SOCKET_ONLY = os.environ.get("SOCKET_ONLY", "False") == "True"
 
 
 # Application definition
@@ -46,7 +135,7 @@ MIDDLEWARE = [
 
 ROOT_URLCONF = "file_receiver.urls"
 
-TEMPLATES = [
+TEMPLATES: list[dict[str, Any]] = [
     {
         "BACKEND": "django.template.backends.django.DjangoTemplates",
         "DIRS": [],
@@ -62,6 +151,19 @@ TEMPLATES = [
     },
 ]
 
+if SOCKET_ONLY:
+    INSTALLED_APPS = ["daphne", "file_listener", "django.contrib.staticfiles"]
+    MIDDLEWARE = [
+        "django.middleware.security.SecurityMiddleware",
+        "django.middleware.common.CommonMiddleware",
+        "django.middleware.csrf.CsrfViewMiddleware",
+        "django.middleware.clickjacking.XFrameOptionsMiddleware",
+    ]
+    TEMPLATES[0]["OPTIONS"]["context_processors"] = [
+        "django.template.context_processors.debug",
+        "django.template.context_processors.request",
+    ]
+
 WSGI_APPLICATION = "file_receiver.wsgi.application"
 
 
@@ -119,6 +221,11 @@ CHANNEL_LAYERS = {
     },
 }
 
+# Logging Settings, LOG_FORMAT is one of simple, verbose or json
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "simple")
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+LOG_CHUNK_SAMPLE_RATE = int(os.environ.get("LOG_CHUNK_SAMPLE_RATE", 100))
+
 LOGGING = {
     "version": 1,
     "disable_existing_loggers": False,
@@ -131,19 +238,32 @@ LOGGING = {
             "format": "{levelname} {message}",
             "style": "{",
         },
+        "json": {
+            "()": "file_listener.logs.JsonFormatter",
+        },
     },
     "handlers": {
         "console": {
             "level": "DEBUG",
             "class": "logging.StreamHandler",
-            "formatter": "simple",
+            "formatter": LOG_FORMAT,
+        },
+        # Records are written to the console from a background thread, logging never blocks the event loop on stdout.
+        "queue": {
+            "class": "logging.handlers.QueueHandler",
+            "handlers": ["console"],
+            "listener": "file_listener.logs.QueueListener",
+            "respect_handler_level": True,
         },
     },
     "loggers": {
         "django": {
-            "handlers": ["console"],
-            "level": "INFO",
+            "handlers": ["queue"],
+            "level": LOG_LEVEL,
             "propagate": True,
         },
     },
 }
+
+# Metrics Settings, the directory every server process writes its metrics to, empty keeps them in memory.
+PROMETHEUS_MULTIPROC_DIR = os.environ.get("PROMETHEUS_MULTIPROC_DIR", "")
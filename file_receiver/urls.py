@@ -1,7 +1,14 @@
-from django.contrib import admin
+from django.conf import settings
 from django.urls import path, include
 
+from file_listener import views
+
 urlpatterns = [
-    path("admin/", admin.site.urls),
+    path("metrics", views.metrics, name="metrics"),
     path("", include("file_listener.urls")),
 ]
+
+if "django.contrib.admin" in settings.INSTALLED_APPS:
+    from django.contrib import admin
+
+    urlpatterns.insert(0, path("admin/", admin.site.urls))